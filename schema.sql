@@ -17,6 +17,7 @@ create table users (
     `admin` bool not null,
     `name` varchar(50) not null,
     `image` varchar(500) not null,
+    `legacy_id` varchar(50) not null default '',
     `created_at` real not null,
     unique key `idx_email` (`email`),
     key `idx_created_at` (`created_at`),
@@ -31,6 +32,7 @@ create table blogs (
     `name` varchar(50) not null,
     `summary` varchar(200) not null,
     `content` mediumtext not null,
+    `comment_count` bigint not null default 0,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
     primary key (`id`)
@@ -45,5 +47,27 @@ create table comments (
     `content` mediumtext not null,
     `created_at` real not null,
     key `idx_created_at` (`created_at`),
+    key `idx_blog_id_created_at` (`blog_id`, `created_at`),
     primary key (`id`)
-) engine=innodb default charset=utf8;
\ No newline at end of file
+) engine=innodb default charset=utf8;
+
+create table jobs (
+    `id` varchar(50) not null,
+    `name` varchar(50) not null,
+    `args` mediumtext not null,
+    `status` varchar(20) not null,
+    `attempts` bigint not null,
+    `run_at` real not null,
+    `error` text not null,
+    `created_at` real not null,
+    `updated_at` real not null,
+    key `idx_status_run_at` (`status`, `run_at`),
+    primary key (`id`)
+) engine=innodb default charset=utf8;
+
+create table counters (
+    `name` varchar(50) not null,
+    `obj_id` varchar(50) not null,
+    `value` bigint not null,
+    primary key (`name`, `obj_id`)
+) engine=innodb default charset=utf8;
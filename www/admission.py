@@ -0,0 +1,212 @@
+import logging, asyncio, heapq, itertools, math, time
+from collections import OrderedDict
+from aiohttp import web
+
+import metrics
+from config import configs
+
+# 准入控制和限流middleware
+# 1. 准入控制：限制同时处理的请求数（max_inflight），不同优先级的请求最多能占用的份额不同，
+#    前台页面（high）可以用满，普通API（normal）和管理员列表API（low）只能用一部分，保证页面浏览优先；
+#    超出份额的请求按优先级排队，排队超时或队列已满则返回503
+# 2. 限流：按客户端IP和登录用户分别做令牌桶限流，超出返回429并带上Retry-After；
+#    令牌桶保存在有上限的LRU字典里，被淘汰的桶相当于重新装满，内存占用固定
+
+HIGH, NORMAL, LOW = 'high', 'normal', 'low'
+_RANKS = {HIGH: 0, NORMAL: 1, LOW: 2}
+
+# 路由优先级：(方法, 路径前缀, 优先级)，按顺序匹配第一条；方法为None表示任意方法，优先级为None表示不做准入控制
+ROUTE_PRIORITIES = (
+    (None, '/static/', None),
+    (None, '/manage/', LOW),
+    ('GET', '/api/comments', LOW),
+    ('GET', '/api/users', LOW),
+    ('GET', '/api/slow_queries', LOW),
+    ('GET', '/api/metrics', None),
+    ('GET', '/api/diagnostics', None),  # 过载时也要能诊断
+    ('GET', '/api/live/', None),  # SSE长连接不占用处理名额，连接数由live.max_subscribers限制
+    ('GET', '/feed.atom', LOW),  # 订阅和爬虫
+    ('GET', '/sitemap.xml', LOW),
+    ('GET', '/sitemap-', LOW),
+    (None, '/api/', NORMAL),
+    ('GET', '/', HIGH),
+)
+
+ADMITTED = metrics.counter('admission_admitted', 'Requests admitted.')
+QUEUED = metrics.counter('admission_queued', 'Requests that had to wait for a slot.')
+SHED = metrics.counter('admission_shed', 'Requests rejected with 503 by admission control.')
+LIMITED_IP = metrics.counter('ratelimit_ip_rejected', 'Requests rejected with 429 by the per-IP limit.')
+LIMITED_USER = metrics.counter('ratelimit_user_rejected', 'Requests rejected with 429 by the per-user limit.')
+QUEUE_WAIT = metrics.histogram('admission_queue_seconds', 'Time spent queued before admission.')
+
+def classify(request):
+    for method, prefix, priority in ROUTE_PRIORITIES:
+        if (method is None or method == request.method) and request.path.startswith(prefix):
+            return priority
+    return NORMAL
+
+# 写操作消耗更多令牌
+def cost(request):
+    return configs.admission.post_cost if request.method == 'POST' else 1
+
+def client_ip(request):
+    if configs.admission.trust_forwarded:  # 部署在反向代理之后时，从X-Forwarded-For取真实IP
+        forwarded = request.headers.get('X-Forwarded-For')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote
+
+# 令牌桶限流器：每个key一个桶，容量burst，每秒补充rate个令牌
+class RateLimiter(object):
+
+    def __init__(self, rate, burst, max_entries=10000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_entries = max_entries
+        self._buckets = OrderedDict()  # key --> (tokens, updated)
+
+    def __len__(self):
+        return len(self._buckets)
+
+    # 尝试取走cost个令牌：成功返回0，否则返回需要等待的秒数
+    def take(self, key, cost=1, now=None):
+        if now is None:
+            now = time.monotonic()
+        cost = min(cost, self.burst)
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            tokens = self.burst
+            while len(self._buckets) >= self.max_entries:  # 淘汰最久未使用的桶
+                self._buckets.popitem(last=False)
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        if tokens >= cost:
+            self._buckets[key] = (tokens - cost, now)
+            return 0
+        self._buckets[key] = (tokens, now)
+        return (cost - tokens) / self.rate
+
+# 按优先级分配的并发控制器
+class AdmissionController(object):
+
+    def __init__(self, max_inflight, shares, max_queue=256, queue_timeout=2.0):
+        self.limits = dict((p, max(1, int(max_inflight * shares[p]))) for p in _RANKS)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.inflight = 0
+        self._waiters = []  # 堆：[rank, seq, priority, future]
+        self._seq = itertools.count()
+
+    def _clean(self):
+        while self._waiters and self._waiters[0][3].done():
+            heapq.heappop(self._waiters)
+
+    # 获取一个处理名额：成功返回True，排队超时或队列已满返回False
+    async def acquire(self, priority):
+        self._clean()
+        rank = _RANKS[priority]
+        if self.inflight < self.limits[priority] and (not self._waiters or self._waiters[0][0] > rank):
+            self.inflight += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            return False
+        QUEUED.inc()
+        fut = asyncio.get_running_loop().create_future()
+        waiter = [rank, next(self._seq), priority, fut]
+        heapq.heappush(self._waiters, waiter)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+            return True
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():  # release()已经分到名额，同时排队超时或请求被取消：归还名额
+                self.release()
+            else:  # 从队列中移除，不再占用max_queue
+                self._remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+        finally:
+            QUEUE_WAIT.observe(time.perf_counter() - start)
+
+    def _remove(self, waiter):
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            return
+        heapq.heapify(self._waiters)
+
+    # 归还名额，并按优先级唤醒排队中的请求
+    def release(self):
+        self.inflight -= 1
+        while True:
+            self._clean()
+            if not self._waiters:
+                return
+            rank, seq, priority, fut = self._waiters[0]
+            if self.inflight >= self.limits[priority]:  # 优先级最高的等待者都不能进入，更低的也不能
+                return
+            heapq.heappop(self._waiters)
+            self.inflight += 1
+            fut.set_result(None)
+
+    def waiting(self):
+        return sum(1 for w in self._waiters if not w[3].done())
+
+_controller = None
+_ip_limiter = None
+_user_limiter = None
+
+metrics.gauge('admission_inflight', 'Requests being processed.', fn=lambda: _controller.inflight if _controller else 0)
+metrics.gauge('admission_waiting', 'Requests queued for admission.', fn=lambda: _controller.waiting() if _controller else 0)
+metrics.gauge('ratelimit_ip_buckets', 'Per-IP token buckets held in memory.', fn=lambda: len(_ip_limiter) if _ip_limiter else 0)
+metrics.gauge('ratelimit_user_buckets', 'Per-user token buckets held in memory.', fn=lambda: len(_user_limiter) if _user_limiter else 0)
+
+def _too_many(wait):
+    return web.HTTPTooManyRequests(headers={'Retry-After': str(max(1, math.ceil(wait)))}, text='Too many requests, please retry later.')
+
+# 准入控制和按IP限流，放在auth_factory之前，避免被拒绝的请求也去数据库查询用户
+# 使用@web.middleware：旧式的middleware工厂每个请求都会被调用一次，状态不能放在工厂里创建
+@web.middleware
+async def admission_middleware(request, handler):
+    priority = classify(request)
+    if priority is None or _controller is None:
+        return (await handler(request))
+    wait = _ip_limiter.take(client_ip(request), cost(request))
+    if wait:
+        LIMITED_IP.inc()
+        logging.info('rate limited ip: %s' % client_ip(request))
+        return _too_many(wait)
+    if not (await _controller.acquire(priority)):
+        SHED.inc()
+        logging.warning('request shed by admission control: %s %s (%s)' % (request.method, request.path, priority))
+        return web.HTTPServiceUnavailable(headers={'Retry-After': '1'}, text='Server busy, please retry later.')
+    ADMITTED.inc()
+    try:
+        return (await handler(request))
+    finally:
+        _controller.release()
+
+# 按登录用户限流，放在auth_factory之后，此时request.__user__已经确定
+@web.middleware
+async def user_rate_middleware(request, handler):
+    user = request.__user__
+    if user is not None and _user_limiter is not None and classify(request) is not None:
+        wait = _user_limiter.take(str(user.id), cost(request))
+        if wait:
+            LIMITED_USER.inc()
+            logging.info('rate limited user: %s' % user.id)
+            return _too_many(wait)
+    return (await handler(request))
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调，每个进程只创建一次并发控制器和令牌桶
+async def start(app):
+    global _controller, _ip_limiter, _user_limiter
+    c = configs.admission
+    _controller = AdmissionController(c.max_inflight, c.shares, c.max_queue, c.queue_timeout)
+    _ip_limiter = RateLimiter(c.ip_rate, c.ip_burst, c.max_buckets)
+    _user_limiter = RateLimiter(c.user_rate, c.user_burst, c.max_buckets)
+
+async def stop(app):
+    global _controller, _ip_limiter, _user_limiter
+    _controller, _ip_limiter, _user_limiter = None, None, None
@@ -1,4 +1,4 @@
-import json, logging, inspect, functools
+import json, logging, inspect, functools, base64
 # 处理分页和API错误,诸如账号登录信息的错误
 
 # 建立Page类来处理分页,可以在page_size更改每页项目的个数
@@ -25,6 +25,18 @@ class Page(object):
 
     __repr__ = __str__
 
+# 游标分页：按(created_at, id)倒序翻页时，用上一页最后一条记录的created_at和id作为游标
+# 游标对客户端不透明，编码为urlsafe base64的JSON
+def encode_cursor(created_at, id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, id]).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        created_at, id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        return float(created_at), id
+    except (ValueError, TypeError):
+        raise APIValueError('cursor', 'Invalid cursor.')
+
 # 以下为API的几类错误代码
 # APIError基类，包含错误类型（必要），数据（可选），信息（可选）
 class APIError(Exception):
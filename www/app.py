@@ -1,13 +1,18 @@
 import logging; logging.basicConfig(level=logging.INFO)
-import asyncio, os, json, time
+import asyncio, os, json, time, signal
 from datetime import datetime
 from aiohttp import web
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, pass_context
 
-import orm
+import orm, ipc, admission, tasks, executors, diagnostics, search, counters, fragments, recent, feeds, export, live, swr, uploads
 from config import configs
 from coroweb import add_routes, add_static
+from admission import admission_middleware, user_rate_middleware
+from diagnostics import diagnostics_middleware
+from swr import swr_middleware
 from handlers import cookie2user, COOKIE_NAME
+from models import set_id_worker, check_id_workers, create_schema
+from prefork import Master, has_reuse_port, create_shared_socket
 
 
 # 初始化jinja2的函数,以便其他函数使用
@@ -19,7 +24,8 @@ def init_jinja2(app, **kw):
         block_end_string = kw.get('block_end_string', '%}'),
         variable_start_string = kw.get('variable_start_string', '{{'),
         variable_end_string = kw.get('variable_end_string', '}}'),
-        auto_reload = kw.get('auto_reload', True)
+        auto_reload = kw.get('auto_reload', True),
+        extensions = kw.get('extensions', ['fragments.FragmentCacheExtension'])  # {% cache key, ttl %}片段缓存
     )
     path = kw.get('path', None)
     if path is None:
@@ -30,7 +36,9 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    fragments.install(env, configs.fragments.maxsize, configs.fragments.ttl)
     app['__templating__'] = env
+    app['__templating_options__'] = (path, options, filters or {})  # 进程池中的子进程用相同的配置创建自己的Environment
 
 
 # 以下是middleware,可以把通用的功能从每个URL处理函数中拿出来集中放到一个地方
@@ -77,7 +85,11 @@ async def auth_factory(app, handler):
 async def response_factory(app, handler):
     async def response(request):
         logging.info('Response handler...')
-        r = await handler(request)  # 拿到url处理函数的返回值
+        try:
+            r = await handler(request)  # 拿到url处理函数的返回值
+        except orm.PoolBusyError as e:  # 数据库连接池繁忙，快速失败，让客户端稍后重试
+            logging.warning('service unavailable: %s' % e)
+            return web.HTTPServiceUnavailable(headers={'Retry-After': '1'}, text='Server busy, please retry later.')
         # 对返回值进行各种分析
         if isinstance(r, web.StreamResponse):  # 若r已经是一个StreamResponse对象，则直接返回r
             return r
@@ -100,16 +112,16 @@ async def response_factory(app, handler):
                 return resp
             else:  #  否则使用jinja2模板
                 r['__user__'] = request.__user__
-                #  得到jinja2模板并传入参数
-                resp = web.Response(body=app['__templating__'].get_template(template).render(**r).encode('utf-8'))
+                #  得到jinja2模板并传入参数，大页面交给进程池渲染
+                resp = web.Response(body=(await executors.render_template(app['__templating__'], template, r)).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
                 return resp
         if isinstance(r, int) and r >= 100 and r < 600:  # r是一个整数
-            return web.Response(r)
+            return web.Response(status=r)
         if isinstance(r, tuple) and len(r) == 2:  # r是一个包含两个元素的元组
             t, m = r
             if isinstance(t, int) and t >= 100 and t < 600:
-                return web.Response(t, str(m))
+                return web.Response(status=t, reason=str(m))
         # default，错误
         resp = web.Response(body=str(r).encode('utf-8'))
         # text/plain：纯文本的形式，浏览器在获取到这种文件时并不会对其进行处理。
@@ -118,7 +130,12 @@ async def response_factory(app, handler):
     return response
 
 # 时间转换（拦截器）
-def datetime_filter(t):
+# 静态导出的页面（模板变量__static__）使用日期，相对时间会让每次导出的内容都不同
+@pass_context
+def datetime_filter(context, t):
+    if context.get('__static__'):
+        dt = datetime.fromtimestamp(t)
+        return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
     delta = int(time.time() - t)
     if delta < 60:
         return u'1分钟前'
@@ -135,24 +152,118 @@ def datetime_filter(t):
 
 
 
-async def init(loop):
-    await orm.create_pool(loop=loop, **configs.db)  # 用配置文件的'db'信息创建数据库连接池
+# 事件循环：configs.server.uvloop为True且安装了uvloop时使用uvloop（可选依赖，需要时 pip install uvloop）
+def new_event_loop():
+    if configs.server.uvloop:
+        try:
+            import uvloop
+            logging.info('using uvloop event loop.')
+            return uvloop.new_event_loop()
+        except ImportError:
+            logging.warning('uvloop is not installed, fall back to asyncio event loop.')
+    return asyncio.new_event_loop()
 
+# 数据库连接池随app启动创建，随app清理关闭
+async def init_db(app):
+    if configs.db.backend == 'sqlite' and configs.db.path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(configs.db.path)), exist_ok=True)
+    await orm.create_pool(**configs.db)  # 用配置文件的'db'信息创建数据库连接池
+    if configs.db.backend == 'sqlite':  # 嵌入式数据库不经过schema.sql，启动时建表（已存在的表不变）
+        await create_schema()
+
+async def close_db(app):
+    await orm.close_pool()
+
+# 创建webapp：注册middlewares、模板、url处理函数和静态文件，不监听端口
+def make_app():
     # request被处理前会经过一系列的middlewares的加工
-    app = web.Application(loop=loop, middlewares=[logger_factory, response_factory, auth_factory])  # 创建webapp
+    # admission_middleware在auth_factory之前：被拒绝的请求不会去数据库查询用户；user_rate_middleware需要auth_factory确定的用户
+    app = web.Application(middlewares=[diagnostics_middleware, logger_factory, swr_middleware, response_factory, admission_middleware, auth_factory, user_rate_middleware])  # 创建webapp
+
+    app.on_startup.append(init_db)
+    app.on_startup.append(admission.start)
+    app.on_startup.append(executors.start)
+    app.on_startup.append(diagnostics.start)
+    app.on_startup.append(tasks.start)
+    app.on_startup.append(search.start)
+    app.on_startup.append(recent.start)
+    app.on_startup.append(feeds.start)
+    app.on_startup.append(counters.start)
+    app.on_startup.append(export.start)
+    app.on_startup.append(live.start)
+    app.on_startup.append(swr.start)
+    app.on_shutdown.append(live.shutdown)  # 先断开SSE长连接，不让它们拖住优雅退出
+    app.on_cleanup.append(live.stop)
+    app.on_cleanup.append(swr.stop)
+    app.on_cleanup.append(export.stop)
+    app.on_cleanup.append(counters.stop)  # 在关闭连接池之前写入剩余的计数
+    app.on_cleanup.append(feeds.stop)
+    app.on_cleanup.append(recent.stop)
+    app.on_cleanup.append(search.stop)
+    app.on_cleanup.append(tasks.stop)  # 先等后台任务执行完，再关闭进程池和连接池
+    app.on_cleanup.append(diagnostics.stop)
+    app.on_cleanup.append(executors.stop)
+    app.on_cleanup.append(admission.stop)
+    app.on_cleanup.append(close_db)
 
     init_jinja2(app, filters=dict(datetime=datetime_filter))  # 初始化jinja2
+    app['__response_factory__'] = response_factory  # 静态导出（export.py）用同一个middleware渲染页面
 
     add_routes(app, 'handlers')  # 批量注册handlers.py里面符合条件的url处理函数
 
+    uploads.add_static(app)  # 上传的图片
     add_static(app)  # 注册静态文件夹
 
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)  # 创建TCP服务
-    logging.info('server started at http://127.0.0.1:9000...')
+    return app
+
+# sock：prefork模式下由主进程共享的监听socket；reuse_port：各worker各自以SO_REUSEPORT监听同一端口
+async def init(sock=None, reuse_port=False):
+    app = make_app()
+    runner = web.AppRunner(app, handle_signals=False, access_log=None)
+    await runner.setup()  # 触发on_startup
+    if sock is not None:
+        site = web.SockSite(runner, sock, shutdown_timeout=configs.server.shutdown_timeout)
+    else:
+        site = web.TCPSite(runner, configs.server.host, configs.server.port, reuse_port=reuse_port, shutdown_timeout=configs.server.shutdown_timeout)  # 创建TCP服务
+    await site.start()
+    logging.info('server started at http://%s:%s (pid %s)...' % (configs.server.host, configs.server.port, os.getpid()))
+    app['__runner__'] = runner
+    return app
+
+# 优雅退出：停止接收新连接，等待进行中的请求处理完（最多shutdown_timeout秒），再触发on_cleanup关闭数据库连接池
+async def shutdown(app):
+    await app['__runner__'].cleanup()
+    logging.info('server stopped (pid %s).' % os.getpid())
+
+# 运行一个服务进程直到收到SIGTERM/SIGINT
+# prefork模式下每个worker有自己的事件循环、连接池和snowflake机器号，并通过ipc接收其他worker的缓存失效通知
+# ready：开始接收连接后调用，通知主进程（滚动重启时主进程等新worker就绪后才让旧worker退出）
+def serve(slot=0, sock=None, prefork=False, ready=None):
+    set_id_worker(configs.ids.worker + slot)
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = loop.run_until_complete(init(sock=sock, reuse_port=prefork and sock is None))
+    if prefork:
+        ipc.start(loop, configs.server.run_dir)
+    if ready is not None:
+        ready()
+    stopping = loop.create_future()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, lambda: stopping.done() or stopping.set_result(None))
+    loop.run_until_complete(stopping)
+    ipc.stop()
+    loop.run_until_complete(shutdown(app))
+    loop.close()
 
-    return srv
+# prefork模式下worker进程的入口
+def run_worker(slot, sock=None, ready=None):
+    serve(slot, sock, prefork=True, ready=ready)
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()  # 创建事件循环对象loop
-    loop.run_until_complete(init(loop))
-    loop.run_forever()
\ No newline at end of file
+    check_id_workers(configs.server.workers)  # 机器号超出范围时worker启动即退出，主进程会不停地重新拉起，在这里提前报错
+    if configs.server.workers > 1:
+        # 不支持SO_REUSEPORT时由主进程创建监听socket，再共享给各worker
+        sock = None if has_reuse_port() else create_shared_socket(configs.server.host, configs.server.port)
+        Master(run_worker, configs.server.workers, sock=sock, shutdown_timeout=configs.server.shutdown_timeout + 5).run()
+    else:
+        serve()
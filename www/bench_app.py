@@ -0,0 +1,169 @@
+import logging; logging.basicConfig(level=logging.WARNING)
+import asyncio, argparse, json, os, random, shutil, tempfile, time
+
+import aiohttp
+
+import orm
+import app as www
+from config import configs
+from models import User, Blog, Comment, next_id, create_schema
+from handlers import user2cookie, COOKIE_NAME
+from bench_http import summarize
+
+# 端到端压力测试：不需要MySQL
+# 用app.init启动真实的app（middlewares、handlers中的url处理函数、jinja2模板、后台任务等），
+# 数据库使用orm的SQLite后端（临时目录中的数据库文件），按参数生成用户、日志和评论，再按比例混合请求各个页面和API
+# 每个接口以及全部请求各输出一行JSON（吞吐量、p50/p90/p99延迟、错误数），便于保存后对比：
+#     python bench_app.py --label before > before.jsonl
+#     python bench_app.py --label after > after.jsonl
+
+# 缺省的请求比例：名称 --> 权重
+MIX = dict(
+    index=30,
+    blog=40,
+    api_blogs=10,
+    api_comments=5,
+    post_comment=10,
+    post_blog=5
+)
+
+########################################################################################################################
+# 测试数据：通过orm写入SQLite数据库文件，每条insert语句写入多行
+
+async def _insert(model, rows, batch=200):
+    columns = model.__fields__ + [model.__primary_key__]
+    for i in range(0, len(rows), batch):
+        chunk = rows[i:i+batch]
+        args = []
+        for r in chunk:
+            args.extend(r[f] for f in columns)
+        await orm.execute('insert into `%s` (%s) values %s' % (model.__table__, ', '.join('`%s`' % f for f in columns), ', '.join(['(%s)' % ', '.join(['?'] * len(columns))] * len(chunk))), args)
+
+# 生成测试数据，返回(管理员, 普通用户列表, 日志id列表)
+async def seed(users, blogs, comments, content_chars):
+    now = time.time()
+    text = ' '.join(['lorem ipsum dolor sit amet'] * (content_chars // 27 + 1))[:content_chars]
+    us = [User(id=next_id(), email='user%s@example.com' % i, passwd='0' * 40, admin=(i == 0), name='user%s' % i, image='about:blank', created_at=now - 86400) for i in range(users)]
+    bs = [Blog(id=next_id(), user_id=us[0].id, user_name=us[0].name, user_image=us[0].image, name='Blog %s' % i, summary=text[:200], content='# Blog %s\n\n%s' % (i, text), comment_count=0, created_at=now - (blogs - i) * 60) for i in range(blogs)]
+    cs = []
+    for i in range(comments):
+        b, u = random.choice(bs), random.choice(us)
+        b.comment_count += 1
+        cs.append(Comment(id=next_id(), blog_id=b.id, user_id=u.id, user_name=u.name, user_image=u.image, content='comment %s on %s' % (i, b.name), created_at=b.created_at + i * 0.001))
+    async with orm.transaction():
+        await _insert(User, us)
+        await _insert(Blog, bs)
+        await _insert(Comment, cs)
+    return us[0], us[1:] or us, [b.id for b in bs]
+
+########################################################################################################################
+# 负载：concurrency个客户端在duration秒内按权重随机选择请求
+
+def _request(name, blog_ids, admin_cookie, user_cookies):
+    if name == 'index':
+        return 'GET', '/?page=%s' % random.choice((1, 1, 1, 2, 3)), None, None
+    if name == 'blog':
+        return 'GET', '/blog/%s' % random.choice(blog_ids), None, None
+    if name == 'api_blogs':
+        return 'GET', '/api/blogs?page=%s' % random.randint(1, 5), None, None
+    if name == 'api_comments':
+        return 'GET', '/api/comments?page=%s' % random.randint(1, 5), None, None
+    if name == 'post_comment':
+        return 'POST', '/api/blogs/%s/comments' % random.choice(blog_ids), dict(content='bench comment %s' % random.random()), random.choice(user_cookies)
+    if name == 'post_blog':
+        return 'POST', '/api/blogs', dict(name='bench blog', summary='bench summary', content='bench content %s' % random.random()), admin_cookie
+    raise ValueError('unknown request: %s' % name)
+
+async def run_mix(base_url, mix, blog_ids, admin_cookie, user_cookies, concurrency, duration):
+    names = list(mix.keys())
+    weights = [mix[n] for n in names]
+    latencies = dict((n, []) for n in names)
+    errors = dict((n, 0) for n in names)
+    deadline = time.perf_counter() + duration
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def client():
+            while time.perf_counter() < deadline:
+                name = random.choices(names, weights)[0]
+                method, path, data, cookie = _request(name, blog_ids, admin_cookie, user_cookies)
+                headers = {'Cookie': '%s=%s' % (COOKIE_NAME, cookie)} if cookie else None
+                start = time.perf_counter()
+                try:
+                    async with session.request(method, base_url + path, json=data, headers=headers, allow_redirects=False) as resp:
+                        body = await resp.read()
+                        failed = resp.status >= 400 or (method == 'POST' and b'"error"' in body[:200])
+                except aiohttp.ClientError:
+                    failed = True
+                if failed:
+                    errors[name] += 1
+                else:
+                    latencies[name].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+########################################################################################################################
+
+def _parse_mix(s):
+    mix = dict()
+    for item in s.split(','):
+        name, _, weight = item.partition('=')
+        if name not in MIX:
+            raise argparse.ArgumentTypeError('unknown request %s, choose from %s' % (name, ', '.join(MIX)))
+        mix[name] = int(weight or 1)
+    return mix
+
+async def main(args):
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix='bench-app-')
+    configs.db.backend, configs.db.path = 'sqlite', os.path.join(workdir, 'bench.db')
+    await orm.create_pool(**configs.db)
+    await create_schema()
+    admin, users, blog_ids = await seed(args.users, args.blogs, args.comments, args.content_chars)
+    await orm.close_pool()
+
+    # 单一客户端压测时关闭按IP/用户的限流，只保留并发控制
+    if not args.keep_rate_limits:
+        configs.admission.ip_rate = configs.admission.ip_burst = 10 ** 9
+        configs.admission.user_rate = configs.admission.user_burst = 10 ** 9
+    configs.search.snapshot = ''
+    configs.export.dir = ''
+    configs.server.host, configs.server.port = '127.0.0.1', args.port
+    app = await www.init()  # app的init_db按configs.db打开同一个数据库文件
+    try:
+        base_url = 'http://127.0.0.1:%s' % args.port
+        admin_cookie = await user2cookie(admin, 86400)
+        user_cookies = [(await user2cookie(u, 86400)) for u in users[:50]]
+        if args.warmup > 0:
+            await run_mix(base_url, args.mix, blog_ids, admin_cookie, user_cookies, args.concurrency, args.warmup)
+        latencies, errors, elapsed = await run_mix(base_url, args.mix, blog_ids, admin_cookie, user_cookies, args.concurrency, args.duration)
+    finally:
+        await www.shutdown(app)
+        shutil.rmtree(workdir, ignore_errors=True)
+    params = dict(users=args.users, blogs=args.blogs, comments=args.comments, concurrency=args.concurrency, backend=configs.db.backend)
+    for name in args.mix:
+        r = summarize(args.label, name, latencies[name], errors[name], elapsed)
+        r.update(params)
+        print(json.dumps(r))
+    r = summarize(args.label, 'total', sum(latencies.values(), []), sum(errors.values()), elapsed)
+    r.update(params)
+    print(json.dumps(r))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end load test of the app against an embedded SQLite database.')
+    parser.add_argument('--label', default='default', help='name of this run')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--blogs', type=int, default=500)
+    parser.add_argument('--comments', type=int, default=5000)
+    parser.add_argument('--content-chars', type=int, default=3000, help='length of each blog body')
+    parser.add_argument('--mix', type=_parse_mix, default=MIX, help='weighted requests, e.g. index=3,blog=5,post_comment=1')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep-rate-limits', action='store_true', help='keep the per-IP and per-user rate limits')
+    asyncio.run(main(parser.parse_args()))
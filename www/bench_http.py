@@ -0,0 +1,74 @@
+import logging; logging.basicConfig(level=logging.WARNING)
+import asyncio, argparse, json, time
+
+import aiohttp
+
+# HTTP吞吐量测试：以固定并发数持续请求若干url，统计每秒请求数和延迟分布
+# 对比uvloop前后的用法：
+#     1. configs.server.uvloop = False，启动 python app.py，运行 python bench_http.py --label asyncio
+#     2. configs.server.uvloop = True，重启 python app.py，运行 python bench_http.py --label uvloop
+# 每次运行输出一行JSON，便于保存后对比
+
+# 计算百分位延迟（毫秒）
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return round(sorted_values[k] * 1000, 3)
+
+def summarize(label, path, latencies, errors, elapsed):
+    latencies.sort()
+    return dict(
+        label=label,
+        path=path,
+        requests=len(latencies),
+        errors=errors,
+        rps=round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        p50_ms=percentile(latencies, 50),
+        p90_ms=percentile(latencies, 90),
+        p99_ms=percentile(latencies, 99),
+        max_ms=percentile(latencies, 100)
+    )
+
+# 用concurrency个协程在duration秒内不停请求base_url + path
+async def run_path(session, base_url, path, concurrency, duration):
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                async with session.get(base_url + path, allow_redirects=False) as resp:
+                    await resp.read()
+                    if resp.status >= 500:
+                        errors += 1
+                        continue
+            except aiohttp.ClientError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+async def main(args):
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for path in args.paths:
+            await run_path(session, args.url, path, args.concurrency, args.warmup)  # 预热
+            latencies, errors, elapsed = await run_path(session, args.url, path, args.concurrency, args.duration)
+            print(json.dumps(summarize(args.label, path, latencies, errors, elapsed)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure request throughput and latency of a running server.')
+    parser.add_argument('--url', default='http://127.0.0.1:9000')
+    parser.add_argument('--label', default='default', help='name of this run, e.g. asyncio or uvloop')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('paths', nargs='*', default=['/', '/api/blogs'])
+    asyncio.run(main(parser.parse_args()))
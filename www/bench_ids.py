@@ -0,0 +1,68 @@
+import logging; logging.basicConfig(level=logging.WARNING)
+import asyncio, argparse, random, time, json, timeit
+
+import orm
+from config import configs
+from models import Snowflake, uuid_id
+
+# 主键性能对比：旧的50位字符串主键 vs snowflake的bigint主键
+# 在两张临时表上分别测试：id生成速度、插入吞吐量、按主键查找吞吐量、按二级索引（blog_id）查找吞吐量
+# 用法（需要有create/drop权限的数据库账号）：
+#     python bench_ids.py --user root --password xxx --rows 20000
+
+DDL = {
+    'uuid': 'create table `%s` (`id` varchar(50) not null, `blog_id` varchar(50) not null, `created_at` real not null, key `idx_blog_id` (`blog_id`), primary key (`id`)) engine=innodb default charset=utf8',
+    'snowflake': 'create table `%s` (`id` bigint not null, `blog_id` bigint not null, `created_at` real not null, key `idx_blog_id` (`blog_id`), primary key (`id`)) engine=innodb default charset=utf8'
+}
+
+async def bench_kind(kind, gen, rows, batch):
+    table = 'bench_ids_%s' % kind
+    await orm.execute('drop table if exists `%s`' % table, None)
+    await orm.execute(DDL[kind] % table, None)
+    ids = [gen() for _ in range(rows)]
+    blog_ids = [gen() for _ in range(max(rows // 100, 1))]
+    start = time.time()
+    for i in range(0, rows, batch):
+        chunk = ids[i:i+batch]
+        args = []
+        for id in chunk:
+            args.extend([id, random.choice(blog_ids), time.time()])
+        await orm.execute('insert into `%s` (`id`, `blog_id`, `created_at`) values %s' % (table, ', '.join(['(?, ?, ?)'] * len(chunk))), args)
+    insert_time = time.time() - start
+    sample = random.sample(ids, min(rows, 2000))
+    start = time.time()
+    for id in sample:
+        await orm.select('select `id`, `blog_id`, `created_at` from `%s` where `id`=?' % table, [id], 1)
+    lookup_time = time.time() - start
+    start = time.time()
+    for blog_id in blog_ids[:200]:
+        await orm.select('select `id` from `%s` where `blog_id`=?' % table, [blog_id])
+    index_time = time.time() - start
+    rs = await orm.select('select `data_length`, `index_length` from information_schema.tables where table_schema=database() and table_name=?', [table], 1)
+    await orm.execute('drop table `%s`' % table, None)
+    return dict(
+        kind=kind,
+        generate_per_sec=round(100000 / timeit.timeit(gen, number=100000)),
+        insert_rows_per_sec=round(rows / insert_time),
+        pk_lookups_per_sec=round(len(sample) / lookup_time),
+        index_lookups_per_sec=round(min(len(blog_ids), 200) / index_time),
+        data_bytes=rs[0]['data_length'] if rs else None,
+        index_bytes=rs[0]['index_length'] if rs else None
+    )
+
+async def main(loop, args):
+    db = dict(configs.db)
+    db.update(user=args.user, password=args.password)
+    await orm.create_pool(loop=loop, **db)
+    worker = Snowflake(configs.ids.worker)
+    for kind, gen in (('uuid', uuid_id), ('snowflake', worker.next_id)):
+        print(json.dumps(await bench_kind(kind, gen, args.rows, args.batch)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark varchar(50) uuid ids against snowflake bigint ids.')
+    parser.add_argument('--user', default=configs.db.user)
+    parser.add_argument('--password', default=configs.db.password)
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=500)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main(loop, parser.parse_args()))
@@ -0,0 +1,60 @@
+import time
+from collections import OrderedDict
+
+# 有容量上限的进程内LRU缓存，可选过期时间（秒）
+class LRUCache(object):
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key --> (value, expires)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires is not None and expires < time.time():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    # ttl：单独指定这一项的过期时间，缺省使用缓存的ttl
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        self._data[key] = (value, time.time() + ttl if ttl else None)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    # 当前所有的key（包括已过期尚未清理的）
+    def keys(self):
+        return list(self._data)
+
+    # 删除所有满足条件的key
+    def pop_matching(self, predicate):
+        keys = [k for k in self._data if predicate(k)]
+        for k in keys:
+            del self._data[k]
+        return len(keys)
+
+    def clear(self):
+        self._data.clear()
+
+_MISSING = object()
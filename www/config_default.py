@@ -1,11 +1,128 @@
 configs = {
     'debug': True,
     'db': {
+        'backend': 'mysql',  # 'mysql'或'sqlite'（嵌入式数据库，适合小规模部署和测试）
+        'path': '/tmp/awesome/awesome.db',  # sqlite数据库文件
+        'busy_timeout': 5,  # sqlite等待其他进程写锁的最长时间（秒）
         'host': '127.0.0.1',
         'port': 3306,
         'user': 'www-data',
         'password': 'www-data',
-        'db': 'awesome'
+        'db': 'awesome',
+        'maxsize': 10,  # 每个worker进程的连接池大小，数据库总连接数 = workers * maxsize
+        'minsize': 1,
+        'acquire_timeout': 5,  # 等待空闲连接的最长时间（秒），超时返回503
+        'max_waiting': 50,  # 等待连接的请求超过这个数时直接返回503
+        'ping_interval': 60,  # 连接空闲超过这个时间（秒），使用前先ping检查
+        'pool_recycle': 3600,  # 连接使用超过这个时间（秒）后重建
+        'slow_query': 0.2,  # 执行超过这个时间（秒）的语句记入慢查询日志并EXPLAIN，0为关闭
+        'slow_queries': 200,  # 慢查询日志保存的最近语句数
+        'breaker_failures': 5,  # 连续这么多条语句出错或超时后断开熔断器，不再发出新的语句
+        'breaker_latency': 2,  # 执行超过这个时间（秒）的语句计为一次失败
+        'breaker_reset': 5  # 熔断器断开这么多秒后放行一个探测请求
     },
-    'session': {'secret': 'Awesome'}
+    'server': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        'workers': 1,  # 大于1时启用多进程prefork模式
+        'uvloop': False,  # 是否使用uvloop事件循环（需要pip install uvloop）
+        'shutdown_timeout': 10,  # 优雅退出时等待进行中请求的最长时间（秒）
+        'run_dir': '/tmp/awesome'  # 进程间缓存失效通知socket所在目录
+    },
+    'session': {'secret': 'Awesome'},
+    'admission': {
+        'max_inflight': 64,  # 每个worker同时处理的请求数上限
+        'shares': {'high': 1.0, 'normal': 0.75, 'low': 0.25},  # 各优先级最多可占用的并发份额
+        'max_queue': 256,  # 排队等待的请求数上限
+        'queue_timeout': 2.0,  # 排队的最长时间（秒）
+        'ip_rate': 20,  # 每个IP每秒补充的令牌数
+        'ip_burst': 60,  # 每个IP的令牌桶容量
+        'user_rate': 10,  # 每个登录用户每秒补充的令牌数
+        'user_burst': 30,
+        'post_cost': 5,  # POST请求消耗的令牌数
+        'max_buckets': 10000,  # 内存中最多保存的令牌桶数
+        'trust_forwarded': False  # 是否信任X-Forwarded-For（部署在反向代理之后时打开）
+    },
+    'tasks': {
+        'workers': 4,  # 每个worker进程执行后台任务的协程数
+        'queue_size': 1000,  # 内存队列长度，超出的durable任务留在jobs表中等待轮询
+        'retries': 3,  # 每个任务最多执行次数
+        'retry_delay': 5,  # 第一次重试的延迟（秒），之后每次翻倍
+        'poll_interval': 5,  # 轮询jobs表的间隔（秒）
+        'stale_timeout': 300,  # running状态超过这个时间（秒）视为执行它的进程已崩溃，重新执行
+        'shutdown_timeout': 10  # 退出时等待队列中任务执行完的最长时间（秒）
+    },
+    'executors': {
+        'processes': 2,  # 渲染markdown和大模板的进程池大小，0为在事件循环线程内渲染
+        'start_method': 'forkserver',  # 进程池子进程的启动方式：forkserver, spawn 或 fork
+        'markdown_offload_chars': 4000,  # 超过这个长度的markdown交给进程池渲染
+        'template_offload_items': 20,  # 列表参数元素总数达到这个值的模板交给进程池渲染：一整页评论（comments.page_size）的日志详情页渲染约2ms，首页6篇日志不交给进程池
+        'threads': 0,  # 哈希计算的线程池大小，0为直接计算（短字符串的SHA1只需几微秒，放到线程池反而更慢）
+        'lag_interval': 0.1  # 事件循环延迟的采样间隔（秒）
+    },
+    'diagnostics': {
+        'slow_callback': 0.1,  # 事件循环被阻塞超过这个时间（秒）时记录调用栈和当时的路由，0为关闭看门狗
+        'slow_callbacks': 100,  # 保存最近的慢回调个数
+        'stack_depth': 30,  # 慢回调记录的调用栈最多帧数
+        'profile_interval': 0.005,  # profiler的采样间隔（秒）
+        'profile_max_seconds': 60  # profiler最长采样时间（秒）
+    },
+    'comments': {
+        'page_size': 20  # 日志详情页每次加载的评论数
+    },
+    'search': {
+        'snapshot': '/tmp/awesome/search.snapshot',  # 索引快照文件，为空则每次启动全量构建
+        'batch_size': 500,  # 构建索引时每次从数据库读取的记录数
+        'page_size': 10
+    },
+    'export': {
+        'dir': '',  # 静态导出目录，不为空时在日志或评论写入后增量导出受影响的页面
+        'concurrency': 8,  # 同时渲染的页面数
+        'debounce': 2  # 合并多少秒内的写入后再导出
+    },
+    'feeds': {
+        'base_url': '',  # feed和sitemap中链接使用的站点地址（如https://example.com），部署时必须设置，为空则使用server.host和server.port
+        'title': 'Pancake',
+        'entries': 20,  # /feed.atom包含的最新日志数
+        'stream_threshold': 5000,  # sitemap中的url超过这个数时分块流式发送
+        'sitemap_max_urls': 50000  # 每个sitemap最多包含的url数，超过时/sitemap.xml改为sitemap索引（协议上限为50000）
+    },
+    'live': {
+        'max_subscribers': 10000,  # 每个worker进程最多保持的SSE连接数
+        'buffer': 64,  # 每个连接最多积压的事件数，超出则断开这个连接
+        'heartbeat': 15,  # 心跳间隔（秒），代理不会因空闲断开连接，已断开的客户端也能及时清理
+        'write_timeout': 10,  # 一次写出超过这个时间（秒）视为慢客户端
+        'retry': 3  # 客户端断线后的重连间隔（秒）
+    },
+    'swr': {
+        'ttl': 5,  # 匿名用户访问的首页和日志详情页缓存多少秒内直接返回，之后返回旧页面并在后台刷新，0为关闭
+        'max_stale': 86400,  # 数据库不可用时旧页面最多还能返回多少秒
+        'budget': 1,  # 没有缓存时渲染页面的最长等待时间（秒），超过返回503，渲染在后台继续
+        'maxsize': 2000  # 最多缓存的页面数
+    },
+    'uploads': {
+        'dir': '/tmp/awesome/uploads',  # 上传图片的存储目录（按内容寻址）
+        'url': '/static/uploads/',  # 上传图片的url前缀
+        'max_bytes': 5 * 1024 * 1024,  # 单个文件的最大字节数
+        'max_pixels': 40 * 1000 * 1000,  # 图片的最大像素数（宽×高），防止很小的文件解码后占用大量内存
+        'chunk_size': 65536,  # 读取请求体和写入文件的块大小
+        'avatar_sizes': (120, 50),  # 头像缩略图的宽度，最大的一个作为用户头像
+        'image_sizes': (800,),  # 日志图片缩略图的宽度
+        'default_avatar': '/static/img/avatar.svg'  # 新注册用户的头像
+    },
+    'recent': {
+        'size': 120  # 首页内存索引保存的最新日志数，超出的页查询数据库
+    },
+    'fragments': {
+        'maxsize': 512,  # 模板片段缓存最多保存的片段数
+        'ttl': 300  # {% cache %}未指定ttl时的过期时间（秒）
+    },
+    'counters': {
+        'flush_interval': 5,  # 浏览量等写回式计数器的写入间隔（秒）
+        'batch_size': 500  # 每条insert语句最多写入的计数器个数
+    },
+    'ids': {
+        'kind': 'uuid',  # 主键生成方式：'uuid'（50位字符串）或'snowflake'（时间有序的bigint，需先运行migrate_ids.py）
+        'worker': 0  # snowflake起始机器号，prefork时各worker依次为worker ~ worker+2*workers-1，不能超过31
+    }
 }
\ No newline at end of file
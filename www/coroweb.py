@@ -146,6 +146,17 @@ class RequestHandler(object):
             return dict(error=e.error, data=e.data, message=e.message)
 
 
+# 把普通函数（或返回协程的函数，如被@get/@post装饰的async函数）包装为协程函数，代替已被移除的asyncio.coroutine
+def as_coroutine(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kw):
+        r = fn(*args, **kw)
+        if inspect.isawaitable(r):
+            r = await r
+        return r
+    return wrapper
+
+
 # 编写一个add_route函数，用来注册一个URL处理函数，验证函数是否有包含URL的方法与路径信息，以及将函数变为协程。
 def add_route(app, fn):
     # 获得函数的__method__和__route__
@@ -156,10 +167,13 @@ def add_route(app, fn):
     # 判断fn是否为协程或生成器
     if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
         # 将fn变为协程
-        fn = asyncio.coroutine(fn)
+        fn = as_coroutine(fn)
     logging.info('add route %s %s => %s(%s)' % (method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
-    # 通过app.router.add_route注册fn
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    # 通过app.router.add_route注册fn，aiohttp要求url处理函数是协程函数，因此用协程函数包装RequestHandler对象
+    handler = RequestHandler(app, fn)
+    async def request_handler(request):
+        return await handler(request)
+    app.router.add_route(method, path, request_handler)
 
 
 # 批量注册：定义add_routes函数，自动注册handler模块的所有符合条件的URL函数
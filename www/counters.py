@@ -0,0 +1,108 @@
+import logging, asyncio, time
+
+import orm, metrics
+from config import configs
+
+# 写回式（write-behind）计数器：浏览量这类每个请求都要+1的计数先在本进程内存中累加，
+# 定时用一条多行的upsert（MySQL的insert ... on duplicate key update）批量写入counters表，退出时把剩余的增量全部写完
+# 读取时返回数据库中的值加上本进程尚未写入的增量；其他worker尚未写入的增量最多延迟flush_interval秒可见
+# 用法：
+#     counters.incr(counters.BLOG_VIEWS, blog.id)
+#     views = await counters.get_many(counters.BLOG_VIEWS, [blog.id for blog in blogs])
+
+BLOG_VIEWS = 'blog_views'
+
+_pending = dict()  # (name, obj_id) --> 尚未写入的增量
+_flusher = None
+_lock = None
+
+PENDING = metrics.gauge('counters_pending', 'Counter keys with increments not yet written.', fn=lambda: len(_pending))
+FLUSHES = metrics.counter('counters_flushes', 'Batched counter writes.')
+FLUSHED = metrics.counter('counters_flushed_keys', 'Counter keys written by batched flushes.')
+FLUSH_ERRORS = metrics.counter('counters_flush_errors', 'Batched counter writes that failed and were kept for retry.')
+FLUSH_TIME = metrics.histogram('counters_flush_seconds', 'Time spent writing one batch of counters.')
+
+def incr(name, obj_id, n=1):
+    key = (name, str(obj_id))
+    _pending[key] = _pending.get(key, 0) + n
+
+def pending(name, obj_id):
+    return _pending.get((name, str(obj_id)), 0)
+
+async def get(name, obj_id):
+    return (await get_many(name, [obj_id]))[str(obj_id)]
+
+# 批量读取：返回{obj_id: 数据库中的值 + 本进程的增量}，obj_id统一转为字符串
+async def get_many(name, obj_ids):
+    stored = await get_stored(name, obj_ids)
+    return dict((i, v + pending(name, i)) for i, v in stored.items())
+
+# 批量读取数据库中的值（不含本进程的增量）：{obj_id: 值}，供自行缓存计数的调用方（如recent）使用
+async def get_stored(name, obj_ids):
+    ids = list(dict.fromkeys(str(i) for i in obj_ids))
+    if not ids:
+        return {}
+    rs = await orm.select('select `obj_id`, `value` from `counters` where `name`=? and `obj_id` in (%s)' % ', '.join(['?'] * len(ids)), [name] + ids)
+    stored = dict((r['obj_id'], r['value']) for r in rs)
+    return dict((i, stored.get(i, 0)) for i in ids)
+
+# 把内存中的增量写入数据库：先整体取出再写，写入期间新的incr()累加到新的字典中；写入失败的增量合并回去等待下次写入
+async def flush():
+    global _pending
+    if not _pending:
+        return 0
+    async with _lock:
+        if not _pending:
+            return 0
+        batch, _pending = _pending, dict()
+        items = list(batch.items())
+        size = configs.counters.batch_size
+        for i in range(0, len(items), size):
+            chunk = items[i:i+size]
+            args = []
+            for (name, obj_id), n in chunk:
+                args.extend((name, obj_id, n))
+            start = time.perf_counter()
+            try:
+                await orm.execute(orm.upsert_sql('counters', ('name', 'obj_id', 'value'), len(chunk), keys=('name', 'obj_id'), increments=('value',)), args)
+            except BaseException as e:
+                FLUSH_ERRORS.inc()
+                for key, n in items[i:]:
+                    _pending[key] = _pending.get(key, 0) + n
+                if isinstance(e, Exception):
+                    logging.warning('counter flush failed, %s keys kept for retry: %s' % (len(items) - i, e))
+                raise
+            finally:
+                FLUSH_TIME.observe(time.perf_counter() - start)
+            FLUSHES.inc()
+            FLUSHED.inc(len(chunk))
+        return len(items)
+
+async def _flush_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush()
+        except Exception:
+            pass  # 已在flush()中记录，增量保留到下次
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调
+async def start(app):
+    global _flusher, _lock
+    _lock = asyncio.Lock()
+    _flusher = asyncio.ensure_future(_flush_periodically(configs.counters.flush_interval))
+
+# 退出前把剩余的增量全部写入，必须在关闭连接池之前执行
+async def stop(app):
+    global _flusher
+    if _flusher is not None:
+        async with _lock:  # 不在写入的中途取消，避免已提交的增量被合并回去重复写入
+            _flusher.cancel()
+        await asyncio.gather(_flusher, return_exceptions=True)
+        _flusher = None
+    try:
+        n = await flush()
+        if n:
+            logging.info('counters drained: %s keys written.' % n)
+    except Exception as e:
+        logging.error('counters drain failed, %s keys lost: %s' % (len(_pending), e))
@@ -0,0 +1,150 @@
+import logging, asyncio, os, sys, threading, time, traceback
+from collections import Counter, deque
+
+from aiohttp import web
+
+import metrics, executors
+from config import configs
+
+# 诊断：找出是什么阻塞了事件循环（markdown、jinja2、json编码、日志……），仅管理员可见
+# 1. 事件循环延迟：executors中的定时器持续测量（loop_lag_seconds），这里只读取
+# 2. 慢回调：看门狗线程发现事件循环超过slow_callback秒没有触发延迟定时器时，抓取事件循环线程的调用栈
+#    和当时正在执行的请求路由，事件循环恢复后把阻塞时长、路由和调用栈记入环形缓冲
+# 3. 采样profiler：按需启动一个线程，每interval秒抓取一次事件循环线程的调用栈，持续seconds秒，
+#    输出折叠栈（collapsed stacks，每行"路由;帧;帧... 次数"），可直接交给flamegraph.pl或speedscope生成火焰图
+# 平时只有看门狗线程每隔几十毫秒比较一次时间戳，profiler不采样时没有任何开销
+
+SLOW_CALLBACKS = metrics.counter('diagnostics_slow_callbacks', 'Times the event loop was blocked longer than the slow callback threshold.')
+PROFILES = metrics.counter('diagnostics_profiles', 'Sampling profiler runs.')
+
+_loop = None
+_loop_thread = None  # 事件循环线程的id
+_routes = dict()  # task --> 正在处理的请求路由
+_slow = deque(maxlen=100)  # 最近的慢回调
+_watchdog = None
+_stopping = None
+_profiling = False
+
+# 请求的路由：'GET /blog/{id}'，没有匹配到路由时使用请求路径
+def route_name(request):
+    resource = request.match_info.route.resource
+    return '%s %s' % (request.method, resource.canonical if resource is not None else request.path)
+
+# 记录每个请求由哪个task处理，看门狗和profiler据此知道事件循环当前在处理哪个路由
+@web.middleware
+async def diagnostics_middleware(request, handler):
+    task = asyncio.current_task()
+    _routes[task] = route_name(request)
+    try:
+        return (await handler(request))
+    finally:
+        _routes.pop(task, None)
+
+# 在其他线程中读取事件循环正在执行的task对应的路由，不在task中（普通回调）或空闲时返回None
+def _active_route():
+    try:
+        task = asyncio.current_task(_loop)
+    except RuntimeError:
+        return None
+    return _routes.get(task, '(task)') if task is not None else None
+
+def _frame_name(frame):
+    return '%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+
+# 折叠栈：从最外层到最内层的帧名用分号连接
+def _collapse(frame, route):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    names.append(route or '(idle)')
+    return ';'.join(reversed(names))
+
+########################################################################################################################
+# 慢回调：看门狗线程
+
+def _watch(interval, threshold):
+    blocked = None  # (阻塞前的心跳时间, 路由, 调用栈)
+    while not _stopping.wait(min(threshold / 2, 0.05)):
+        tick = executors.last_tick
+        if tick == 0:
+            continue
+        if blocked is None:
+            if time.monotonic() - tick - interval >= threshold:
+                frame = sys._current_frames().get(_loop_thread)
+                stack = traceback.format_stack(frame, limit=configs.diagnostics.stack_depth) if frame is not None else []
+                blocked = (tick, _active_route(), [line.rstrip() for line in stack])
+        elif tick != blocked[0]:  # 事件循环恢复了
+            duration = tick - blocked[0] - interval
+            SLOW_CALLBACKS.inc()
+            _slow.append(dict(at=time.time() - (time.monotonic() - blocked[0]), duration=round(duration, 6), route=blocked[1], stack=blocked[2]))
+            logging.warning('event loop blocked for %.3fs in %s' % (duration, blocked[1] or '(no request)'))
+            blocked = None
+
+def slow_callbacks():
+    return list(reversed(_slow))
+
+########################################################################################################################
+# 采样profiler
+
+def _sample(seconds, interval):
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(_loop_thread)
+        if frame is not None:
+            stacks[_collapse(frame, _active_route())] += 1
+        del frame
+        time.sleep(interval)
+    return stacks
+
+def is_profiling():
+    return _profiling
+
+# 采样seconds秒，返回折叠栈 --> 采样次数；同一时间只运行一个profiler
+async def profile(seconds, interval):
+    global _profiling
+    if _profiling:
+        raise RuntimeError('profiler is already running')
+    _profiling = True
+    PROFILES.inc()
+    try:
+        return (await asyncio.get_running_loop().run_in_executor(None, _sample, seconds, interval))
+    finally:
+        _profiling = False
+
+def format_collapsed(stacks):
+    return ''.join('%s %s\n' % (stack, n) for stack, n in stacks.most_common())
+
+########################################################################################################################
+
+# 事件循环延迟和慢回调的概况
+def report():
+    return dict(
+        loop_lag=executors.LOOP_LAG.snapshot(),
+        loop_lag_max=executors.LOOP_LAG_MAX.snapshot(),
+        slow_callback_threshold=configs.diagnostics.slow_callback,
+        slow_callbacks=slow_callbacks(),
+        inflight=sorted(_routes.values()),
+        profiling=_profiling
+    )
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调，在executors.start之后启动
+async def start(app):
+    global _loop, _loop_thread, _slow, _watchdog, _stopping
+    c = configs.diagnostics
+    _loop = asyncio.get_running_loop()
+    _loop_thread = threading.get_ident()
+    _slow = deque(maxlen=c.slow_callbacks)
+    if c.slow_callback > 0:
+        _stopping = threading.Event()
+        _watchdog = threading.Thread(target=_watch, args=(configs.executors.lag_interval, c.slow_callback), name='loop-watchdog', daemon=True)
+        _watchdog.start()
+
+async def stop(app):
+    global _watchdog, _stopping
+    if _watchdog is not None:
+        _stopping.set()
+        await asyncio.get_running_loop().run_in_executor(None, _watchdog.join)
+        _watchdog, _stopping = None, None
+    _routes.clear()
@@ -0,0 +1,127 @@
+import logging, asyncio, time, multiprocessing, pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import markdown
+from jinja2 import Environment, FileSystemLoader
+
+import metrics, fragments
+from config import configs
+
+# 把CPU密集的工作移出事件循环线程：
+#     进程池：markdown渲染、大模板渲染（纯Python代码，线程无法绕过GIL）
+#     线程池：密码/cookie的哈希计算
+# 进程池为0时全部在事件循环线程内直接执行，行为与原来一致
+# 另外持续测量事件循环的延迟（loop lag），用来对比开启进程池前后的效果
+
+_process_pool = None
+_thread_pool = None
+_lag_monitor = None
+last_tick = 0.0  # 延迟定时器最近一次触发的时间（time.monotonic()），diagnostics的看门狗线程据此判断事件循环是否被阻塞
+
+LOOP_LAG = metrics.histogram('loop_lag_seconds', 'Extra delay of a periodic timer on the event loop.')
+LOOP_LAG_MAX = metrics.gauge('loop_lag_max_seconds', 'Largest event loop lag seen in the last monitor window.')
+OFFLOADED = metrics.counter('executor_process_tasks', 'Calls run in the process pool.')
+OFFLOAD_TIME = metrics.histogram('executor_process_seconds', 'Round-trip time of process pool calls.')
+INLINE_MARKDOWN = metrics.counter('executor_inline_markdown', 'Markdown renders run on the event loop.')
+
+# 以下函数在进程池的子进程中执行
+
+_env = None
+
+def _init_process(path, options, filters):
+    global _env
+    _env = Environment(loader=FileSystemLoader(path), **options)
+    _env.filters.update(filters)
+
+# cached：主进程缓存中已有的片段；返回(页面, 新渲染的片段)
+def _render_template(name, context, cached):
+    _env.fragment_cache = fragments.PoolFragments(cached)
+    try:
+        return _env.get_template(name).render(**context), _env.fragment_cache.rendered
+    finally:
+        _env.fragment_cache = None
+
+########################################################################################################################
+
+async def run_in_process(fn, *args):
+    if _process_pool is None:
+        return fn(*args)
+    OFFLOADED.inc()
+    start = time.perf_counter()
+    try:
+        return (await asyncio.get_running_loop().run_in_executor(_process_pool, fn, *args))
+    finally:
+        OFFLOAD_TIME.observe(time.perf_counter() - start)
+
+async def run_in_thread(fn, *args):
+    if _thread_pool is None:
+        return fn(*args)
+    return (await asyncio.get_running_loop().run_in_executor(_thread_pool, fn, *args))
+
+# 渲染markdown：短文本直接渲染（进程间传输的开销比渲染本身还大），长文本交给进程池
+async def render_markdown(text):
+    if _process_pool is None or len(text) < configs.executors.markdown_offload_chars:
+        INLINE_MARKDOWN.inc()
+        return markdown.markdown(text)
+    return (await run_in_process(markdown.markdown, text))
+
+# 估算模板参数的规模：所有列表参数的元素个数之和
+def _context_items(context):
+    return sum(len(v) for v in context.values() if isinstance(v, (list, tuple)))
+
+# 渲染模板：列表元素较多的页面（例如一整页评论的日志详情页）交给进程池，参数无法pickle时退回到事件循环线程内渲染
+# 进程池渲染同样使用片段缓存：已缓存的片段传给子进程，子进程新渲染的片段写回缓存；页面的片段全部命中时直接在本线程渲染
+async def render_template(env, name, context):
+    if _process_pool is not None and _context_items(context) >= configs.executors.template_offload_items:
+        keys = fragments.keys(env, name, context)
+        cached = fragments.lookup(keys)
+        if not keys or len(cached) < len(keys):
+            generation = fragments.generation()
+            try:
+                html, rendered = await run_in_process(_render_template, name, context, cached)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                logging.warning('render %s in process failed, render inline: %s' % (name, e))
+            else:
+                fragments.store(rendered, generation)
+                return html
+    return env.get_template(name).render(**context)
+
+# 定时器的实际触发时间与预期时间之差就是事件循环被阻塞的时间
+async def _monitor_lag(interval):
+    global last_tick
+    loop = asyncio.get_running_loop()
+    window_max, window_start = 0.0, loop.time()
+    while True:
+        last_tick = time.monotonic()
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - expected)
+        LOOP_LAG.observe(lag)
+        window_max = max(window_max, lag)
+        if loop.time() - window_start >= 10:
+            LOOP_LAG_MAX.set(round(window_max, 6))
+            window_max, window_start = 0.0, loop.time()
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调
+async def start(app):
+    global _process_pool, _thread_pool, _lag_monitor
+    c = configs.executors
+    if c.processes > 0:
+        path, options, filters = app['__templating_options__']
+        _process_pool = ProcessPoolExecutor(c.processes, mp_context=multiprocessing.get_context(c.start_method), initializer=_init_process, initargs=(path, options, filters))
+        logging.info('process pool started with %s processes.' % c.processes)
+    if c.threads > 0:
+        _thread_pool = ThreadPoolExecutor(c.threads, thread_name_prefix='hash')
+    _lag_monitor = asyncio.ensure_future(_monitor_lag(c.lag_interval))
+
+async def stop(app):
+    global _process_pool, _thread_pool, _lag_monitor, last_tick
+    if _lag_monitor is not None:
+        _lag_monitor.cancel()
+        _lag_monitor = None
+        last_tick = 0.0
+    loop = asyncio.get_running_loop()
+    for pool in (_process_pool, _thread_pool):
+        if pool is not None:
+            await loop.run_in_executor(None, pool.shutdown)
+    _process_pool, _thread_pool = None, None
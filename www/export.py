@@ -0,0 +1,261 @@
+import logging, asyncio, argparse, fcntl, hashlib, json, os, tempfile, time
+
+import orm, metrics, executors, recent, handlers
+from config import configs
+from apis import Page
+from models import Blog, Comment
+from tasks import task, defer
+
+# 静态导出：把公开页面写成静态文件，流量高峰时交给CDN或静态文件服务器
+#     /              --> index.html
+#     /?page=N       --> page/N/index.html（CDN需要把?page=N改写到这个路径）
+#     /blog/{id}     --> blog/{id}/index.html
+# 页面由handlers中的url处理函数生成，经app的response_factory渲染，与线上以匿名用户访问看到的内容一致，
+# 只是模板变量__static__为True：时间显示为日期而不是"N分钟前"，不显示浏览量，否则每次导出的内容都不同
+# 每个页面的sha1记录在输出目录的.manifest.json中，内容没有变化的页面不重写；
+# 多个worker可能同时导出，manifest在文件锁内重新读取、合并本次的修改后原子替换
+# 全量导出：python export.py [--out DIR]
+# 增量导出：configs.export.dir不为空时，app在日志或评论写入后（合并debounce秒内的写入）重新导出受影响的日志页，
+#     以及这些日志所在的列表页（新增或删除日志时还有它之后的各页，因为后面的日志都会移动位置）
+
+MANIFEST = '.manifest.json'
+MANIFEST_LOCK = '.manifest.lock'
+
+WRITTEN = metrics.counter('export_pages_written', 'Exported pages written because their content changed.')
+SKIPPED = metrics.counter('export_pages_skipped', 'Exported pages skipped because their content hash did not change.')
+EXPORT_ERRORS = metrics.counter('export_errors', 'Pages that failed to export.')
+
+_app = None
+_dirty = dict()  # 等待增量导出的blog id --> [created_at, 是否新增或删除了这篇日志]
+_timer = None
+
+# 匿名用户的请求：response_factory渲染模板时只用到__user__
+class _ExportRequest(object):
+    __user__ = None
+
+class Exporter(object):
+
+    def __init__(self, app, out, concurrency=8):
+        self.app = app
+        self.out = out
+        self.sem = asyncio.Semaphore(concurrency)
+        self.path = os.path.join(out, MANIFEST)
+        self.manifest = _read_manifest(self.path)
+        self.changes = dict()  # 本次导出修改的页面 --> sha1，删除的页面为None
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+
+    # 用response_factory渲染url处理函数fn(**kw)的返回值
+    async def render(self, fn, **kw):
+        async def handler(request):
+            r = await fn(**kw)
+            r['__static__'] = True
+            return r
+        response = await self.app['__response_factory__'](self.app, handler)
+        resp = await response(_ExportRequest())
+        if resp.status != 200:
+            raise ValueError('%s returned %s' % (fn.__name__, resp.status))
+        return resp.body
+
+    async def export(self, name, fn, **kw):
+        async with self.sem:
+            try:
+                body = await self.render(fn, **kw)
+            except Exception as e:
+                self.failed += 1
+                EXPORT_ERRORS.inc()
+                logging.warning('export %s failed: %s' % (name, e))
+                return
+            digest = hashlib.sha1(body).hexdigest()
+            target = os.path.join(self.out, name)
+            if self.manifest.get(name) == digest and os.path.exists(target):
+                self.skipped += 1
+                SKIPPED.inc()
+                return
+            await asyncio.get_running_loop().run_in_executor(None, _write, target, body)
+            self.manifest[name] = self.changes[name] = digest
+            self.written += 1
+            WRITTEN.inc()
+
+    def remove(self, name):
+        self.manifest.pop(name, None)
+        self.changes[name] = None
+        try:
+            os.unlink(os.path.join(self.out, name))
+        except OSError:
+            pass
+
+    async def save(self):
+        await asyncio.get_running_loop().run_in_executor(None, _merge_manifest, self.out, self.changes)
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+# 在文件锁内读取最新的manifest，合并changes后原子替换，其他进程同时导出的结果不会丢失
+def _merge_manifest(out, changes):
+    os.makedirs(out, exist_ok=True)
+    with open(os.path.join(out, MANIFEST_LOCK), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(out, MANIFEST)
+        manifest = _read_manifest(path)
+        for name, digest in changes.items():
+            if digest is None:
+                manifest.pop(name, None)
+            else:
+                manifest[name] = digest
+        _write(path, json.dumps(manifest, sort_keys=True).encode('utf-8'))
+
+# 原子写入：先写临时文件再替换，CDN回源时不会读到写了一半的文件
+def _write(path, body):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def _blog_name(id):
+    return 'blog/%s/index.html' % id
+
+def _page_name(n):
+    return 'page/%s/index.html' % n
+
+# 导出列表页（pages为None时导出所有列表页），删除日志数减少后多出来的列表页
+async def _export_index(exporter, pages=None):
+    p = Page(await handlers.count_blogs(), 1)
+    if pages is None:
+        pages = range(1, p.page_count + 1)
+    pages = [n for n in pages if n <= p.page_count]
+    jobs = [exporter.export(_page_name(n), handlers.index, page=str(n)) for n in pages]
+    if 1 in pages or p.page_count == 0:
+        jobs.append(exporter.export('index.html', handlers.index, page='1'))
+    await asyncio.gather(*jobs)
+    for name in [k for k in exporter.manifest if k.startswith('page/')]:
+        if int(name.split('/')[1]) > max(p.page_count, 1):
+            exporter.remove(name)
+
+# 全量导出
+async def export_all(app, out, concurrency=8):
+    start = time.time()
+    exporter = Exporter(app, out, concurrency)
+    ids = [str(r['id']) for r in (await orm.select('select `id` from `blogs`', None))]
+    await asyncio.gather(_export_index(exporter), *[exporter.export(_blog_name(id), handlers.blog_page, id=id) for id in ids])
+    exported = set(_blog_name(id) for id in ids)
+    for name in [k for k in exporter.manifest if k.startswith('blog/') and k not in exported]:
+        exporter.remove(name)
+    await exporter.save()
+    logging.info('exported %s pages to %s in %.2fs: %s written, %s unchanged, %s failed' % (exporter.written + exporter.skipped + exporter.failed, out, time.time() - start, exporter.written, exporter.skipped, exporter.failed))
+    return exporter
+
+# 日志所在的列表页：列表按(created_at, id)倒序，同一时间的日志可能跨两页，返回(第一页, 最后一页)
+async def _pages_of(created_at):
+    size = Page(0).page_size
+    before = await Blog.findNumber('count(id)', '`created_at`>?', [created_at])
+    until = await Blog.findNumber('count(id)', '`created_at`>=?', [created_at])
+    return before // size + 1, max(until - 1, before) // size + 1
+
+# 增量导出：changes为[(blog id, created_at, 是否新增或删除了这篇日志)]
+# 导出这些日志的详情页（已删除的日志删除对应文件），以及它们所在的列表页；新增或删除日志时之后的列表页都要重新导出
+async def export_blogs(app, out, changes, concurrency=8):
+    exporter = Exporter(app, out, concurrency)
+    changes = dict((str(id), (created_at, moved)) for id, created_at, moved in changes)
+    ids = list(changes)
+    exists = dict()
+    if ids:
+        exists = dict((str(b.id), b.created_at) for b in (await Blog.findAll('`id` in (%s)' % ', '.join(['?'] * len(ids)), ids, fields=('created_at',))))
+    for id in ids:
+        if id not in exists:
+            exporter.remove(_blog_name(id))
+    pages = set()
+    last = Page(await handlers.count_blogs()).page_count
+    for id, (created_at, moved) in changes.items():
+        created_at = exists.get(id, created_at)
+        if created_at is None:  # 其他进程删除的日志，不知道位置
+            continue
+        first, until = await _pages_of(created_at)
+        pages.update(range(first, max(last, until) + 1 if moved else until + 1))
+    await asyncio.gather(_export_index(exporter, sorted(pages)), *[exporter.export(_blog_name(id), handlers.blog_page, id=id) for id in exists])
+    await exporter.save()
+    logging.info('incremental export of %s blogs and %s list pages: %s written, %s unchanged, %s failed' % (len(ids), len(pages), exporter.written, exporter.skipped, exporter.failed))
+    return exporter
+
+########################################################################################################################
+# 增量导出：监听写入，合并一段时间内的写入后交给后台任务执行
+
+@task('export_pages', retries=1)
+async def export_pages(*, changes):
+    if _app is not None:
+        (await export_blogs(_app, configs.export.dir, changes, configs.export.concurrency))
+
+def _on_blog(event, blog):
+    _mark(blog.id, blog.created_at, event != 'update')
+
+def _on_comment(event, comment):
+    _mark(comment.blog_id, None, False)
+
+def _mark(blog_id, created_at, moved):
+    global _timer
+    change = _dirty.setdefault(str(blog_id), [None, False])
+    change[0] = created_at or change[0]
+    change[1] = change[1] or moved
+    if _timer is None:
+        _timer = asyncio.get_running_loop().call_later(configs.export.debounce, _flush)
+
+def _flush():
+    global _timer
+    _timer = None
+    changes = [[id, created_at, moved] for id, (created_at, moved) in _dirty.items()]
+    _dirty.clear()
+    asyncio.ensure_future(defer('export_pages', durable=False, changes=changes))
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调，configs.export.dir为空时不做增量导出
+async def start(app):
+    global _app
+    if not configs.export.dir:
+        return
+    _app = app
+    orm.listen(Blog, _on_blog)
+    orm.listen(Comment, _on_comment)
+    logging.info('incremental static export to %s enabled.' % configs.export.dir)
+
+async def stop(app):
+    global _app, _timer
+    if _app is None:
+        return
+    orm.unlisten(Blog, _on_blog)
+    orm.unlisten(Comment, _on_comment)
+    if _timer is not None:
+        _timer.cancel()
+        _timer = None
+    _dirty.clear()
+    _app = None
+
+########################################################################################################################
+
+async def main(args):
+    from app import make_app, init_db, close_db
+    app = make_app()
+    await init_db(app)
+    await executors.start(app)
+    await recent.start(app)
+    try:
+        await export_all(app, args.out, args.concurrency)
+    finally:
+        await recent.stop(app)
+        await executors.stop(app)
+        await close_db(app)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the public pages as static files.')
+    parser.add_argument('--out', default=configs.export.dir or 'dist', help='output directory')
+    parser.add_argument('--concurrency', type=int, default=configs.export.concurrency, help='pages rendered at the same time')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,228 @@
+import logging, asyncio, hashlib, math, time
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+from aiohttp import web
+
+import orm, ipc, metrics, executors, recent
+from config import configs
+from models import Blog
+
+# /feed.atom和/sitemap.xml：
+# 结果以编码后的bytes缓存，带ETag，客户端带If-None-Match时返回304
+# 增量生成：Atom的每个<entry>、sitemap的每个<url>单独缓存，日志变化时只重新生成这一项，再重新拼接整个文档
+# sitemap中的url数超过stream_threshold时分块流式发送，不拼接成一整块bytes
+# url数超过sitemap_max_urls（sitemap协议规定最多50000个）时/sitemap.xml改为sitemap索引，
+# 按发表时间从旧到新分成/sitemap-1.xml, /sitemap-2.xml...，新日志只改变最后一个
+# 链接使用configs.feeds.base_url，不使用请求的Host头：缓存由所有访问者共享，伪造的Host不能写进缓存
+
+BUILDS = metrics.counter('feeds_builds', 'Feed and sitemap documents rebuilt.')
+NOT_MODIFIED = metrics.counter('feeds_not_modified', 'Feed and sitemap requests answered with 304.')
+
+_base = None  # 链接使用的站点地址，启动时确定
+_entries = dict()  # blog id --> Atom <entry>的bytes
+_feed = None  # (bytes, etag)
+_urls = None  # blog id --> (created_at, sitemap <url>的bytes)，None表示尚未从数据库加载
+_sitemaps = dict()  # 编号（0为/sitemap.xml）--> (chunks, etag, 总长度)
+_version = 0  # 每次日志变化加1，生成期间发生了变化的结果不放入缓存
+_lock = None
+
+def _iso(t):
+    return datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+def _etag(chunks):
+    h = hashlib.sha1()
+    for c in chunks:
+        h.update(c)
+    return '"%s"' % h.hexdigest()
+
+# 没有配置base_url时使用服务监听的地址，只适合本地开发
+def base_url():
+    c = configs.feeds
+    if c.base_url:
+        return c.base_url.rstrip('/')
+    return 'http://%s:%s' % (configs.server.host, configs.server.port)
+
+# 日志变化：只丢弃这一篇的缓存
+def _on_blog(event, blog):
+    _changed(str(blog.id), event, blog)
+    ipc.publish_peers('feeds', id=str(blog.id), event=event)
+
+def _on_peer_change(id, event):
+    _changed(id, event, None)
+
+def _changed(id, event, blog):
+    global _feed, _urls, _sitemaps, _version
+    _version += 1
+    _entries.pop(id, None)
+    _feed = None
+    if _urls is None or event == 'update':  # sitemap只用到id和created_at，修改日志不影响
+        return
+    if event == 'remove':
+        _urls.pop(id, None)
+    elif blog is not None:
+        _urls[id] = (blog.created_at, _url_bytes(blog.id, blog.created_at))
+    else:  # 其他worker新增的日志，下次生成sitemap时重新读取id列表
+        _urls = None
+    _sitemaps = dict()
+
+########################################################################################################################
+# Atom
+
+def _entry_bytes(blog, html):
+    link = '%s/blog/%s' % (_base, blog.id)
+    return ('<entry>\n'
+            '<title>%s</title>\n'
+            '<link href=%s/>\n'
+            '<id>%s</id>\n'
+            '<published>%s</published>\n'
+            '<updated>%s</updated>\n'
+            '<author><name>%s</name></author>\n'
+            '<summary>%s</summary>\n'
+            '<content type="html">%s</content>\n'
+            '</entry>\n' % (escape(blog.name), quoteattr(link), escape(link), _iso(blog.created_at), _iso(blog.created_at), escape(blog.user_name), escape(blog.summary), escape(html))).encode('utf-8')
+
+async def _build_feed():
+    global _entries
+    n = configs.feeds.entries
+    blogs = recent.page(0, n)
+    if blogs is None:
+        blogs = await Blog.findAll(orderBy='`created_at` desc, `id` desc', limit=n, fields=('user_name', 'name', 'summary', 'created_at'))
+    # 只读取并渲染缓存中没有的日志正文
+    version = _version
+    entries = dict(_entries)
+    missing = [str(b.id) for b in blogs if str(b.id) not in entries]
+    if missing:
+        for blog in (await Blog.findAll('`id` in (%s)' % ', '.join(['?'] * len(missing)), missing)):
+            entries[str(blog.id)] = _entry_bytes(blog, (await executors.render_markdown(blog.content)))
+    ids = [str(b.id) for b in blogs if str(b.id) in entries]
+    if version == _version:  # 生成期间没有日志变化才更新缓存，同时丢弃已经不在feed中的日志
+        _entries = dict((id, entries[id]) for id in ids)
+    updated = _iso(blogs[0].created_at if blogs else time.time())
+    head = ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+            '<title>%s</title>\n'
+            '<link href=%s/>\n'
+            '<link rel="self" href=%s/>\n'
+            '<id>%s/</id>\n'
+            '<updated>%s</updated>\n' % (escape(configs.feeds.title), quoteattr(_base + '/'), quoteattr(_base + '/feed.atom'), escape(_base), updated)).encode('utf-8')
+    chunks = [head] + [entries[id] for id in ids] + [b'</feed>\n']
+    BUILDS.inc()
+    return b''.join(chunks), _etag(chunks)
+
+########################################################################################################################
+# sitemap
+
+def _url_bytes(id, created_at):
+    return ('<url><loc>%s/blog/%s</loc><lastmod>%s</lastmod></url>\n' % (escape(_base), id, _iso(created_at))).encode('utf-8')
+
+async def _load_urls():
+    rs = await orm.select('select `id`, `created_at` from `blogs`', None)
+    return dict((str(r['id']), (r['created_at'], _url_bytes(r['id'], r['created_at']))) for r in rs)
+
+# 读取期间有日志变化（_changed在_urls为None时无法更新）时重新读取，连续三次都有变化则这次使用读到的结果但不缓存
+async def _sitemap_urls():
+    global _urls
+    urls, attempts = _urls, 0
+    while urls is None:
+        version = _version
+        urls = await _load_urls()
+        attempts += 1
+        if version == _version:
+            _urls = urls
+        elif attempts < 3:
+            urls = None
+    return urls
+
+# 生成第part个sitemap（0为/sitemap.xml），不存在时返回None
+async def _build_sitemap(part):
+    urls = await _sitemap_urls()
+    home = (0, ('<url><loc>%s/</loc></url>\n' % escape(_base)).encode('utf-8'))
+    items = [home] + sorted(urls.values())
+    size = configs.feeds.sitemap_max_urls
+    parts = math.ceil(len(items) / size)
+    if part == 0 and parts > 1:
+        head = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n').encode('utf-8')
+        body = [('<sitemap><loc>%s/sitemap-%s.xml</loc><lastmod>%s</lastmod></sitemap>\n' % (escape(_base), i, _iso(items[min(i * size, len(items)) - 1][0]))).encode('utf-8') for i in range(1, parts + 1)]
+        chunks = [head] + body + [b'</sitemapindex>\n']
+    else:
+        if part > parts or (part > 0 and parts == 1):
+            return None
+        start = (part - 1) * size if part else 0
+        head = ('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n').encode('utf-8')
+        chunks = [head] + [u for _, u in items[start:start + size]] + [b'</urlset>\n']
+    BUILDS.inc()
+    return chunks, _etag(chunks), sum(len(c) for c in chunks)
+
+########################################################################################################################
+
+def _not_modified(request, etag):
+    if request.headers.get('If-None-Match') == etag:
+        NOT_MODIFIED.inc()
+        return web.Response(status=304, headers={'ETag': etag})
+    return None
+
+async def feed_response(request):
+    global _feed
+    async with _lock:  # 同时到达的请求只生成一次
+        body, etag = _feed or (None, None)
+        if body is None:
+            version = _version
+            body, etag = await _build_feed()
+            if version == _version:
+                _feed = (body, etag)
+    r = _not_modified(request, etag)
+    if r is not None:
+        return r
+    return web.Response(body=body, content_type='application/atom+xml', charset='utf-8', headers={'ETag': etag})
+
+# part：0为/sitemap.xml，url较多时其余为/sitemap-<part>.xml
+async def sitemap_response(request, part=0):
+    async with _lock:
+        cached = _sitemaps.get(part)
+        if cached is None:
+            version = _version
+            cached = await _build_sitemap(part)
+            if cached is None:
+                raise web.HTTPNotFound()
+            if version == _version:
+                _sitemaps[part] = cached
+    chunks, etag, length = cached
+    r = _not_modified(request, etag)
+    if r is not None:
+        return r
+    if len(chunks) <= configs.feeds.stream_threshold:
+        return web.Response(body=b''.join(chunks), content_type='application/xml', charset='utf-8', headers={'ETag': etag})
+    # 大sitemap：按约64KB一块写出，不在内存中再拼接一份完整的文档
+    resp = web.StreamResponse(headers={'ETag': etag, 'Content-Type': 'application/xml; charset=utf-8'})
+    resp.content_length = length
+    await resp.prepare(request)
+    buf, size = [], 0
+    for c in chunks:
+        buf.append(c)
+        size += len(c)
+        if size >= 65536:
+            await resp.write(b''.join(buf))
+            buf, size = [], 0
+    if buf:
+        await resp.write(b''.join(buf))
+    await resp.write_eof()
+    return resp
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调
+async def start(app):
+    global _lock, _base
+    _lock = asyncio.Lock()
+    _base = base_url()
+    if not configs.feeds.base_url:
+        logging.warning('configs.feeds.base_url is not set, feed and sitemap links use %s' % _base)
+    orm.listen(Blog, _on_blog)
+    ipc.subscribe('feeds', _on_peer_change)
+
+async def stop(app):
+    global _base, _entries, _feed, _urls, _sitemaps
+    orm.unlisten(Blog, _on_blog)
+    ipc.unsubscribe('feeds', _on_peer_change)
+    _base, _entries, _feed, _urls, _sitemaps = None, dict(), None, None, dict()
@@ -0,0 +1,120 @@
+import logging
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+import ipc, metrics
+from cache import LRUCache
+
+# 模板片段缓存：页面整体因__user__不同无法缓存时，把对所有人都一样的部分（日志列表、正文、评论列表）缓存起来
+# 模板中的用法（ttl可省略，缺省使用configs.fragments.ttl）：
+#     {% cache 'blog:' ~ blog.id ~ ':article', 600 %} ... {% endcache %}
+# 写入日志/评论后由url处理函数按key前缀失效，并经ipc通知其他worker：
+#     fragments.invalidate('blog:%s:' % blog.id, 'blogs:')
+# 缓存块内不能使用__user__等因请求而不同的变量；静态导出的页面（__static__）不读写缓存
+# 进程池中渲染模板时（见executors.render_template），主进程先按模板中的key取出已缓存的片段一起传给子进程，
+# 子进程只渲染未命中的片段并把它们带回，由主进程写入缓存
+
+_store = None
+_generation = 0  # 每次失效加一：子进程渲染期间发生过失效时，带回的片段可能已经过期，不写入缓存
+
+metrics.gauge('fragment_cache_size', 'Template fragments in the cache.', fn=lambda: len(_store) if _store else 0)
+metrics.gauge('fragment_cache_hits', 'Template fragment cache hits.', fn=lambda: _store.hits if _store else 0)
+metrics.gauge('fragment_cache_misses', 'Template fragment cache misses.', fn=lambda: _store.misses if _store else 0)
+
+class FragmentCacheExtension(Extension):
+
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None, fragment_keys=dict())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        # 记下key表达式，渲染前可以在主进程中算出模板用到的key（见keys()）
+        if parser.name is not None:
+            self.environment.fragment_keys.setdefault(parser.name, {})[lineno] = self.environment.from_string(nodes.Template([nodes.Output([args[0]])]))
+        return nodes.CallBlock(self.call_method('_cache_support', [nodes.ContextReference()] + args), [], [], body).set_lineno(lineno)
+
+    def _cache_support(self, context, key, ttl, caller):
+        store = self.environment.fragment_cache
+        if store is None or context.get('__static__'):
+            return caller()
+        key = str(key)
+        rv = store.get(key)
+        if rv is None:
+            rv = caller()
+            store.set(key, rv, ttl)
+        return rv
+
+# 在Environment上安装缓存（由app.init_jinja2调用），并订阅其他worker的失效通知
+def install(env, maxsize=512, ttl=300):
+    global _store
+    _store = LRUCache(maxsize=maxsize, ttl=ttl)
+    env.fragment_cache = _store
+    ipc.subscribe('fragments', _on_invalidate)
+
+def _on_invalidate(prefixes):
+    global _generation
+    _generation += 1
+    if _store is None:
+        return
+    n = _store.pop_matching(lambda k: k.startswith(tuple(prefixes)))
+    if n:
+        logging.debug('invalidated %s template fragments: %s' % (n, ', '.join(prefixes)))
+
+# 删除key以prefixes中任一前缀开头的片段（本进程和其他worker）
+def invalidate(*prefixes):
+    ipc.publish('fragments', prefixes=list(prefixes))
+
+def generation():
+    return _generation
+
+# 用context算出模板name中{% cache %}的key，算不出来的（例如循环中的变量）跳过
+def keys(env, name, context):
+    env.get_template(name)  # 确保模板已经解析过
+    L = []
+    for t in env.fragment_keys.get(name, {}).values():
+        try:
+            L.append(t.render(**context))
+        except Exception:
+            pass
+    return L
+
+# 本进程缓存中已有的片段：key --> 片段
+def lookup(keys):
+    if _store is None:
+        return {}
+    found = dict()
+    for key in keys:
+        rv = _store.get(key)
+        if rv is not None:
+            found[key] = rv
+    return found
+
+# 把子进程渲染的片段写入缓存；generation为交给子进程时的generation()，之后发生过失效则丢弃
+def store(rendered, generation):
+    if _store is None or generation != _generation:
+        return
+    for key, (rv, ttl) in rendered.items():
+        _store.set(key, rv, ttl)
+
+# 进程池子进程中使用的缓存：只读主进程传来的片段，新渲染的片段记在rendered中带回主进程
+class PoolFragments(object):
+
+    def __init__(self, cached):
+        self.cached = cached
+        self.rendered = dict()  # key --> (片段, ttl)
+
+    def get(self, key):
+        return self.cached.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.rendered[key] = (value, ttl)
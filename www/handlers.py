@@ -1,10 +1,12 @@
-import re, time, json, logging, hashlib, base64, asyncio
-import markdown  # markdown 处理日志文本的一种格式语法
+import re, time, json, logging, hashlib, asyncio
 from aiohttp import web
 
+import orm, metrics, executors, diagnostics, search, counters, fragments, recent, feeds, live, swr, uploads
+from cache import LRUCache
 from coroweb import get, post
-from apis import Page, APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
-from models import User, Comment, Blog, next_id
+from tasks import task, defer
+from apis import Page, encode_cursor, decode_cursor, APIError, APIValueError, APIResourceNotFoundError, APIPermissionError
+from models import User, Comment, Blog, BLOG_LIST_FIELDS, next_id
 from config import configs
 
 COOKIE_NAME = 'awesession'  # cookie名
@@ -26,10 +28,21 @@ _COOKIE_KEY = configs.session.secret  # cookie密令：用于加密cookie
 #     修改日志：POST /api/blogs/:blog_id
 #     删除日志：POST /api/blogs/:blog_id/delete
 #     获取评论：GET /api/comments
+#     获取日志的评论：GET /api/blogs/:blog_id/comments
 #     创建评论：POST /api/blogs/:blog_id/comments
 #     删除评论：POST /api/comments/:comment_id/delete
+#     日志评论的实时推送（SSE）：GET /api/live/blogs/:blog_id
+#     所有评论的实时推送（SSE）：GET /api/live/comments
 #     创建新用户：POST /api/users
+#     上传头像：POST /api/users/avatar
+#     上传日志图片：POST /api/images
 #     获取用户：GET /api/users
+#     运行指标：GET /api/metrics
+#     慢查询日志：GET /api/slow_queries
+#     事件循环诊断：GET /api/diagnostics
+#     采样profiler：GET /api/diagnostics/profile
+#     重新统计计数器：POST /api/counters/reconcile
+#     站内搜索：GET /api/search
 
 # 管理员页面包括：
 #     评论列表管理页：GET /manage/comments
@@ -37,6 +50,7 @@ _COOKIE_KEY = configs.session.secret  # cookie密令：用于加密cookie
 #     创建日志管理页：GET /manage/blogs/create
 #     修改日志管理页：GET /manage/blogs/
 #     用户列表管理页：GET /manage/users
+#     慢查询管理页：GET /manage/slow_queries
 
 # 用户浏览页面包括：
 #     注册页：GET /register
@@ -63,14 +77,21 @@ def get_page_index(page_str):
         p = 1
     return p
 
+# SHA1摘要，configs.executors.threads大于0时在线程池中计算
+def _sha1(s):
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+async def sha1_hexdigest(s):
+    return (await executors.run_in_thread(_sha1, s))
+
 # 计算返回给客户端的加密cookie：传入一个当前登录用户user和max_age（用来计算出失效时间），返回一个加密好的cookie字符串
-def user2cookie(user, max_age):
+async def user2cookie(user, max_age):
     # build cookie string by: id-expires-sha1，通过id，失效时间，sha1摘要算法创建cookie字符串
     # expires：失效时间
     expires = str(int(time.time() + max_age))
     s = '%s-%s-%s-%s' % (user.id, user.passwd, expires, _COOKIE_KEY)  # s字符串：user.id,, user.passwd, expires, _COOKIE_KEY
     # L包含三个元素：user.id, expires, 经过sha1摘要算法加密的s字符串，互相之间用'-'连接起来变成一个字符串并返回
-    L = [user.id, expires, hashlib.sha1(s.encode('utf-8')).hexdigest()]
+    L = [str(user.id), expires, (await sha1_hexdigest(s))]
     return '-'.join(L)
 
 # 解密cookie：传入一个cookie字符串进行验证，cookie验证通过，返回该user信息，验证失败返回None
@@ -88,7 +109,7 @@ async def cookie2user(cookie_str):  # 传入一个cookie字符串
         if user is None:
             return None
         s = '%s-%s-%s-%s' % (uid, user.passwd, expires, _COOKIE_KEY)  # 构造当前s字符串：user.id,, user.passwd, expires, _COOKIE_KEY
-        if sha1 != hashlib.sha1(s.encode('utf-8')).hexdigest():  # 若传入的s字符串与当前构造的s字符串不相等
+        if sha1 != (await sha1_hexdigest(s)):  # 若传入的s字符串与当前构造的s字符串不相等
             logging.info('invalid sha1')
             return None
         user.passwd = '******'
@@ -102,6 +123,90 @@ def text2html(text):
     lines = map(lambda s: '<p>%s</p>' % s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;'), filter(lambda s: s.strip() != '', text.split('\n')))
     return ''.join(lines)
 
+# markdown渲染结果缓存：key --> (原文, html)，原文变化时重新渲染
+# 长文本在进程池中渲染，不阻塞事件循环
+_markdown_cache = LRUCache(maxsize=2048)
+
+async def render_markdown(key, text):
+    cached = _markdown_cache.get(key)
+    if cached is not None and cached[0] == text:
+        return cached[1]
+    html = await executors.render_markdown(text)
+    _markdown_cache.set(key, (text, html))
+    return html
+
+# 按游标分页读取某篇日志的评论（最新的在前），返回(评论列表, 下一页游标)，没有更多评论时游标为None
+# 使用(blog_id, created_at)索引，翻到多深每页的代价都一样
+async def find_blog_comments(blog_id, cursor=None, size=20):
+    where = '`blog_id`=?'
+    args = [blog_id]
+    if cursor:
+        created_at, cid = decode_cursor(cursor)
+        where = where + ' and (`created_at`<? or (`created_at`=? and `id`<?))'
+        args.extend([created_at, created_at, cid])
+    comments = await Comment.findAll(where, args, orderBy='`created_at` desc, `id` desc', limit=size + 1)
+    next_cursor = None
+    if len(comments) > size:
+        comments = comments[:size]
+        next_cursor = encode_cursor(comments[-1].created_at, comments[-1].id)
+    htmls = await asyncio.gather(*[render_markdown(('comment', c.id), c.content) for c in comments])
+    for c, html in zip(comments, htmls):
+        c.html_content = html
+    return comments, next_cursor
+
+# 日志总数和日志列表的一页：先查recent的内存索引，索引未加载或这一页超出了索引范围时查询数据库
+async def count_blogs():
+    num = recent.count()
+    if num is None:
+        num = await Blog.findNumber('count(id)')
+    return num
+
+# with_views：同时取出浏览量（blog.views），内存索引命中时浏览量也从内存中读取，不查询数据库
+async def find_blog_page(p, with_views=False):
+    blogs = recent.page(p.offset, p.limit)
+    if blogs is not None:
+        if with_views:
+            for blog in blogs:
+                blog.views = recent.views(blog.id)
+        return blogs
+    blogs = await Blog.findAll(orderBy='`created_at` desc, `id` desc', limit=(p.offset, p.limit), fields=BLOG_LIST_FIELDS)
+    if with_views and blogs:
+        views = await counters.get_many(counters.BLOG_VIEWS, [blog.id for blog in blogs])
+        for blog in blogs:
+            blog.views = views[str(blog.id)]
+    return blogs
+
+########################################################################################################################
+
+# 后台任务：写入完成后由tasks队列执行
+
+# 预渲染日志正文，日志详情页打开时直接使用缓存
+@task('render_blog')
+async def render_blog(*, id):
+    blog = await Blog.find(id)
+    if blog is not None:
+        (await render_markdown(('blog', blog.id), blog.content))
+
+# 按comments表重新统计所有日志的评论数，修正计数器可能出现的偏差（例如直接在数据库中删除了评论）
+@task('reconcile_comment_counts')
+async def reconcile_comment_counts():
+    rows = await orm.execute('update `blogs` set `comment_count`=(select count(*) from `comments` where `comments`.`blog_id`=`blogs`.`id`)', None)
+    logging.info('reconciled comment counts: %s blogs changed' % rows)
+    if rows:
+        fragments.invalidate('blogs:')
+        recent.reload_all()
+
+_DELETED_USER = '(该用户已被删除)'
+
+# 在被删除用户的所有评论中标记该用户已被删除
+@task('relabel_user_comments')
+async def relabel_user_comments(*, user_id):
+    # 任务可能被重复执行（提交后进程崩溃），已经加过标记的评论不再追加
+    rows = await orm.execute('update `comments` set `user_name`=%s where `user_id`=? and `user_name` not like ?' % orm.concat('`user_name`', '?'), [_DELETED_USER, user_id, '%' + _DELETED_USER])
+    logging.info('relabeled %s comments of deleted user %s' % (rows, user_id))
+    if rows:
+        fragments.invalidate('blog:')  # 评论分布在各篇日志中，直接清空所有日志的片段
+
 ########################################################################################################################
 
 # 后端API --> 用户登录验证API
@@ -117,15 +222,16 @@ async def authenticate(*, email, passwd):  # 传入用户输入的email和passwd
     user = users[0]  # 取第一条记录（一般也只有一条记录：email的设置了unique key）
     # check passwd：
     # 密码是利用(id:passwd)通过SHA1摘要算法转换加密后存在数据库的
-    sha1 = hashlib.sha1()
-    sha1.update(user.id.encode('utf-8'))
-    sha1.update(b':')
-    sha1.update(passwd.encode('utf-8'))
-    if user.passwd != sha1.hexdigest():
-        raise APIValueError('passwd', 'Invalid Password | 密码错误')
+    sha1_passwd = await sha1_hexdigest('%s:%s' % (user.id, passwd))
+    if user.passwd != sha1_passwd:
+        # 主键迁移（migrate_ids.py）前注册的用户，密码摘要仍以旧id计算：验证通过后改用新id重新计算
+        if not user.legacy_id or user.passwd != (await sha1_hexdigest('%s:%s' % (user.legacy_id, passwd))):
+            raise APIValueError('passwd', 'Invalid Password | 密码错误')
+        user.passwd = sha1_passwd
+        await user.update()
     # authenticate ok, set cookie:认证通过，设置cookie传给客户端
     r = web.Response()  # 创建web.Response对象r
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)  # 传入所需参数设置cookie到r
+    r.set_cookie(COOKIE_NAME, (await user2cookie(user, 86400)), max_age=86400, httponly=True)  # 传入所需参数设置cookie到r
     user.passwd = '******'
     r.content_type = 'application/json'  # 指定r的content_type
     r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')  # 将user进行json序列化并放入r的body
@@ -142,6 +248,16 @@ async def api_comments(*, page='1'):
     comments = await Comment.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
     return dict(page=p, comments=comments)
 
+# 后端API --> 按游标分页获取某篇日志的评论API
+@get('/api/blogs/{id}/comments')
+async def api_blog_comments(id, *, cursor='', size=''):
+    try:
+        size = min(max(int(size), 1), 100) if size else configs.comments.page_size
+    except ValueError:
+        raise APIValueError('size')
+    comments, next_cursor = await find_blog_comments(id, cursor or None, size)
+    return dict(comments=comments, next=next_cursor)
+
 # 后端API --> 用户发表评论API
 @post('/api/blogs/{id}/comments')
 async def api_create_comment(id, request, *, content):  # 传入日志id，request，评论内容
@@ -155,6 +271,9 @@ async def api_create_comment(id, request, *, content):  # 传入日志id，reque
         raise APIResourceNotFoundError('Blog')
     comment = Comment(blog_id=blog.id, user_id=user.id, user_name=user.name, user_image=user.image, content=content.strip())
     await comment.save()
+    fragments.invalidate('blog:%s:comments' % blog.id, 'blogs:')  # 评论列表和日志列表中的评论数
+    comment.html_content = await render_markdown(('comment', comment.id), comment.content)  # 推送给正在阅读的用户
+    live.publish_comment(comment)
     return comment
 
 # 后端API --> 管理员删除评论API
@@ -165,8 +284,21 @@ async def api_delete_comments(id, request):  # 传入评论id和request
     if c is None:
         raise APIResourceNotFoundError('Comment')
     await c.remove()
+    fragments.invalidate('blog:%s:comments' % c.blog_id, 'blogs:')
+    live.publish_delete(c)
     return dict(id=id)
 
+# 后端API --> 某篇日志的新评论和评论删除的实时推送（Server-Sent Events）
+@get('/api/live/blogs/{id}')
+async def api_live_blog(id, request):
+    return (await live.stream(request, 'blog:%s' % id))
+
+# 后端API --> 所有评论的实时推送，仅管理员可用
+@get('/api/live/comments')
+async def api_live_comments(request):
+    check_admin(request)
+    return (await live.stream(request, live.ALL))
+
 # 后端API --> 获取注册用户信息API
 @get('/api/users')
 async def api_get_users(*, page='1'):  # 传入page表示要获取第几页的已注册用户信息
@@ -200,26 +332,53 @@ async def api_register_user(*, email, name, passwd):  # 传入用户输入的ema
     uid = next_id()  # 生成用户id
     sha1_passwd = '%s:%s' % (uid, passwd)
     # 生成该用户信息
-    user = User(id=uid, name=name.strip(), email=email, passwd=hashlib.sha1(sha1_passwd.encode('utf-8')).hexdigest(), image='http://www.gravatar.com/avatar/%s?d=mm&s=120' % hashlib.md5(email.encode('utf-8')).hexdigest())
+    user = User(id=uid, name=name.strip(), email=email, passwd=(await sha1_hexdigest(sha1_passwd)), image=configs.uploads.default_avatar)
     # 存入数据库
     await user.save()
     # make session cookie:生成cookie传给客户端
     r = web.Response()
-    r.set_cookie(COOKIE_NAME, user2cookie(user, 86400), max_age=86400, httponly=True)
+    r.set_cookie(COOKIE_NAME, (await user2cookie(user, 86400)), max_age=86400, httponly=True)
     user.passwd = '******'
     r.content_type = 'application/json'
     r.body = json.dumps(user, ensure_ascii=False).encode('utf-8')
     return r
 
+# 接收上传的图片，格式或大小不符合要求时返回APIValueError
+# 上传API的url处理函数只接收request，RequestHandler不会用request.post()把整个请求体读入内存
+async def save_upload(request, sizes):
+    try:
+        return (await uploads.save_image(request, sizes))
+    except uploads.UploadError as e:
+        raise APIValueError('file', str(e))
+
+# 后端API --> 上传头像（multipart/form-data，字段名file），最大的缩略图作为当前用户的头像
+@post('/api/users/avatar')
+async def api_upload_avatar(request):
+    if request.__user__ is None:
+        raise APIPermissionError('Please Signin First! | 请先登录！')
+    sizes = configs.uploads.avatar_sizes
+    r = await save_upload(request, sizes)
+    user = await User.find(request.__user__.id)
+    user.image = r['thumbnails'][str(max(sizes))]
+    await user.update()
+    r['image'] = user.image
+    return r
+
+# 后端API --> 上传日志中的图片，返回原图和缩略图的url，由编辑页面插入到markdown中
+@post('/api/images')
+async def api_upload_image(request):
+    check_admin(request)
+    return (await save_upload(request, configs.uploads.image_sizes))
+
 # 后端API --> 获取日志列表API
 @get('/api/blogs')
 async def api_blogs(*, page='1'):
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')
+    num = await count_blogs()
     p = Page(num, page_index)
     if num == 0:
         return dict(page=p, blogs=())
-    blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+    blogs = await find_blog_page(p)
     return dict(page=p, blogs=blogs)
 
 # 后端API --> 获取日志详情API
@@ -241,6 +400,8 @@ async def api_create_blog(request, *, name, summary, content):  # 传入request
     # 生成新的日志信息
     blog = Blog(user_id=request.__user__.id, user_name=request.__user__.name, user_image=request.__user__.image, name=name.strip(), summary=summary.strip(), content=content.strip())
     await blog.save()
+    fragments.invalidate('blogs:')
+    await defer('render_blog', durable=False, id=blog.id)
     return blog
 
 # 后端API --> 编辑日志API
@@ -258,6 +419,8 @@ async def api_update_blog(id, request, *, name, summary, content):
     blog.summary = summary.strip()
     blog.content = content.strip()
     await blog.update()
+    fragments.invalidate('blog:%s:' % blog.id, 'blogs:')
+    await defer('render_blog', durable=False, id=blog.id)
     return blog
 
 # 后端API --> 删除日志API
@@ -266,62 +429,146 @@ async def api_delete_blog(request, *, id):
     check_admin(request)
     blog = await Blog.find(id)
     await blog.remove()
+    fragments.invalidate('blog:%s:' % blog.id, 'blogs:')
     return dict(id=id)
 
 # 后端API --> 删除用户API
 @post('/api/users/{id}/delete')
 async def api_delete_users(id, request):
     check_admin(request)
-    id_buff = id
     user = await User.find(id)
     if user is None:
         raise APIResourceNotFoundError('User')
     await user.remove()
-    # 给被删除的用户在评论中标记该用户已被删除
-    comments = await Comment.findAll('user_id=?',[id])  # 查找该用户发表过的评论
-    if comments:
-        for comment in comments:
-            id = comment.id
-            c = await Comment.find(id)
-            c.user_name = c.user_name + '(该用户已被删除)'
-            await c.update()
-    id = id_buff
+    # 给被删除的用户在评论中标记该用户已被删除：由后台任务一条update完成
+    await defer('relabel_user_comments', user_id=user.id)
     return dict(id=id)
 
+# 后端API --> 站内搜索：在日志和评论中搜索q，kind为'blog'或'comment'时只搜索该类
+@get('/api/search')
+async def api_search(*, q='', kind='', page='1'):
+    if not q or not q.strip():
+        raise APIValueError('q', 'query cannot be empty.')
+    if kind not in ('', search.BLOG, search.COMMENT):
+        raise APIValueError('kind')
+    page_index = get_page_index(page)
+    page_size = configs.search.page_size
+    num, results = search.search(q.strip(), limit=page_size, offset=page_size * (page_index - 1), kind=kind or None)
+    p = Page(num, page_index, page_size)
+    return dict(page=p, results=results, ready=search.is_ready())
+
+# 后端API --> 管理员触发重新统计计数器，由后台任务执行
+@post('/api/counters/reconcile')
+async def api_reconcile_counters(request):
+    check_admin(request)
+    job = await defer('reconcile_comment_counts')
+    return dict(job=job.id)
+
+# 后端API --> 当前worker进程的运行指标（连接池、队列等），仅管理员可见
+@get('/api/metrics')
+async def api_metrics(request, *, prefix=''):
+    check_admin(request)
+    return metrics.snapshot(prefix)
+
+# 后端API --> 当前worker进程的慢查询日志：最近的慢查询和按SQL形状的汇总（带EXPLAIN结果），仅管理员可见
+@get('/api/slow_queries')
+async def api_slow_queries(request):
+    check_admin(request)
+    return orm.slow_queries()
+
+# 后端API --> 当前worker进程的事件循环延迟、最近的慢回调（阻塞时长、当时的路由、调用栈），仅管理员可见
+@get('/api/diagnostics')
+async def api_diagnostics(request):
+    check_admin(request)
+    return diagnostics.report()
+
+# 后端API --> 对当前worker进程的事件循环线程采样seconds秒，返回折叠栈（text/plain，可交给flamegraph.pl生成火焰图），
+# format=json时返回dict，仅管理员可见
+@get('/api/diagnostics/profile')
+async def api_diagnostics_profile(request, *, seconds='5', interval='', format='collapsed'):
+    check_admin(request)
+    c = configs.diagnostics
+    try:
+        seconds = float(seconds)
+        interval = float(interval) if interval else c.profile_interval
+    except ValueError:
+        raise APIValueError('seconds', 'seconds and interval must be numbers.')
+    if not (0 < seconds <= c.profile_max_seconds):
+        raise APIValueError('seconds', 'seconds must be in (0, %s].' % c.profile_max_seconds)
+    if not (0.001 <= interval <= 1):
+        raise APIValueError('interval', 'interval must be in [0.001, 1].')
+    if diagnostics.is_profiling():
+        raise APIError('profiler:busy', 'profile', 'Another profile is running.')
+    stacks = await diagnostics.profile(seconds, interval)
+    if format == 'json':
+        return dict(seconds=seconds, interval=interval, samples=sum(stacks.values()), stacks=dict(stacks.most_common()))
+    return web.Response(text=diagnostics.format_collapsed(stacks), content_type='text/plain')
+
 
 ########################################################################################################################
 
 # 用户浏览页面 --> 网站首页
+@swr.cached(params={'page': int})
 @get('/')
 async def index(*, page='1'):  # 传入page表示要获取第几页的blog信息
     page_index = get_page_index(page)
-    num = await Blog.findNumber('count(id)')  # 计算出一共有多少博客
+    num = await count_blogs()  # 计算出一共有多少博客
     p = Page(num, page_index)  # 创建分页对象，不传入page_size则默认page_size=6，即一页显示6条记录
     if num == 0:
         blogs = []
     else:
-        # 筛选出blogs表中对应位置的记录，并按找注册时间（最新的在前）排序
-        blogs = await Blog.findAll(orderBy='created_at desc', limit=(p.offset, p.limit))
+        # 筛选出对应位置的日志，按发表时间（最新的在前）排序；前几页的日志、总数和浏览量都在内存中，不查询数据库
+        blogs = await find_blog_page(p, with_views=True)
     return {
         '__template__': 'blogs.html',
         'page': p,
         'blogs': blogs
     }
 
-# 用户浏览页面 --> 日志详情页面
+def _count_view(request):
+    counters.incr(counters.BLOG_VIEWS, request.match_info['id'])
+
+# 用户浏览页面 --> 日志详情页面，匿名用户的访问由swr缓存返回，浏览量在_count_view中累加
+@swr.cached(on_hit=_count_view)
 @get('/blog/{id}')
 async def get_blog(id):
+    r = await blog_page(id)
+    if not swr.is_refresh():
+        counters.incr(counters.BLOG_VIEWS, id)  # 只在内存中累加，由counters定时批量写入
+        r['blog'].views += 1
+    return r
+
+# 日志详情页的模板参数（静态导出也使用，不计入浏览量）
+async def blog_page(id):
     blog = await Blog.find(id)
-    comments = await Comment.findAll('blog_id=?', [id], orderBy='created_at desc')
-    for c in comments:
-        c.html_content = markdown.markdown(c.content)
-    blog.html_content = markdown.markdown(blog.content)
+    if blog is None:
+        raise APIResourceNotFoundError('Blog')
+    blog.views = await counters.get(counters.BLOG_VIEWS, blog.id)
+    # 只加载第一页评论，后面的评论由页面通过/api/blogs/:blog_id/comments按需加载
+    comments, next_cursor = await find_blog_comments(id, size=configs.comments.page_size)
+    blog.html_content = await render_markdown(('blog', blog.id), blog.content)
     return {
         '__template__': 'blog.html',
         'blog': blog,
-        'comments': comments
+        'comments': comments,
+        'next_cursor': next_cursor
     }
 
+# 订阅和爬虫 --> Atom feed（最新的日志，含渲染后的正文）
+@get('/feed.atom')
+async def feed_atom(request):
+    return (await feeds.feed_response(request))
+
+# 订阅和爬虫 --> sitemap（所有日志的地址）
+@get('/sitemap.xml')
+async def sitemap_xml(request):
+    return (await feeds.sitemap_response(request))
+
+# 订阅和爬虫 --> 日志较多时sitemap索引中的各个sitemap
+@get('/sitemap-{part:\d+}.xml')
+async def sitemap_part_xml(request, *, part):
+    return (await feeds.sitemap_response(request, int(part)))
+
 # 用户浏览页面 --> 注册页面
 @get('/register')
 def register():
@@ -394,4 +641,11 @@ def manage_users(*, page='1'):
         'page_index': get_page_index(page)
     }
 
+# 管理员页面 --> 慢查询页面（当前worker进程）
+@get('/manage/slow_queries')
+def manage_slow_queries():
+    return {
+        '__template__': 'manage_slow_queries.html'
+    }
+
 ########################################################################################################################
\ No newline at end of file
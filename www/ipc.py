@@ -0,0 +1,173 @@
+import logging, os, socket, json, collections
+
+import metrics
+
+# 进程间的缓存失效通知通道
+# 每个worker进程在run_dir下绑定一个Unix数据报socket（worker-<pid>.sock），publish时把消息发给所有其他worker
+# 其他worker的列表只在启动时读取一次目录，之后由加入/退出通知维护：启动时向已有的worker发送加入通知，退出时发送退出通知，
+# 发送时发现对方已经不存在（崩溃退出没有发出通知）则从列表中移除
+# 对方接收队列已满时消息暂存在该worker的待发队列中稍后重发，保持顺序，队列超过MAX_BACKLOG条时丢弃最早的消息
+# 单进程运行（未调用start）时publish只通知本进程的订阅者
+# 用法：
+#     ipc.subscribe('blogs', on_blogs_changed)  # on_blogs_changed(**payload)
+#     ipc.publish('blogs', id=blog.id)
+
+_handlers = dict()  # channel --> [fn]
+_sock = None
+_path = None
+_run_dir = None
+_loop = None
+_peers = set()  # 其他worker的socket路径
+_backlog = dict()  # socket路径 --> 因对方忙而暂存的消息队列
+_retry = None
+
+MAX_MESSAGE_SIZE = 65536
+MAX_BACKLOG = 1000
+RETRY_INTERVAL = 0.05
+_PEERS = '__peers__'  # 内部频道：worker加入/退出通知
+
+DROPPED = metrics.counter('ipc_dropped_messages', 'Messages to other workers dropped because their backlog was full.')
+metrics.gauge('ipc_backlog', 'Messages waiting for a busy worker.', fn=lambda: sum(len(q) for q in _backlog.values()))
+
+# 订阅某个频道，fn为普通函数，收到消息时以fn(**payload)方式调用
+def subscribe(channel, fn):
+    _handlers.setdefault(channel, []).append(fn)
+
+def unsubscribe(channel, fn):
+    fns = _handlers.get(channel, [])
+    if fn in fns:
+        fns.remove(fn)
+
+def _dispatch(channel, payload):
+    for fn in list(_handlers.get(channel, ())):
+        try:
+            fn(**payload)
+        except Exception as e:
+            logging.exception(e)
+
+# 发布消息：先通知本进程的订阅者，再广播给其他worker
+def publish(channel, **payload):
+    _dispatch(channel, payload)
+    publish_peers(channel, **payload)
+
+# 只广播给其他worker（本进程已经自行处理过时使用）
+def publish_peers(channel, **payload):
+    if _sock is None:
+        return
+    data = json.dumps(dict(channel=channel, payload=payload), ensure_ascii=False).encode('utf-8')
+    if len(data) > MAX_MESSAGE_SIZE:
+        logging.warning('ipc message too large, dropped: %s (%s bytes)' % (channel, len(data)))
+        return
+    for path in list(_peers):
+        _send(path, data)
+
+def _send(path, data):
+    queue = _backlog.get(path)
+    if queue is not None:  # 已有暂存的消息，排在它们后面保持顺序
+        if len(queue) >= MAX_BACKLOG:
+            queue.popleft()
+            DROPPED.inc()
+            logging.warning('ipc peer %s is not reading, oldest message dropped' % path)
+        queue.append(data)
+        return
+    try:
+        _sock.sendto(data, path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        _remove_peer(path)
+    except BlockingIOError:
+        _backlog[path] = collections.deque([data])
+        _schedule_retry()
+
+def _schedule_retry():
+    global _retry
+    if _retry is None and _loop is not None:
+        _retry = _loop.call_later(RETRY_INTERVAL, _flush_backlog)
+
+def _flush_backlog():
+    global _retry
+    _retry = None
+    for path, queue in list(_backlog.items()):
+        try:
+            while queue:
+                _sock.sendto(queue[0], path)
+                queue.popleft()
+        except (ConnectionRefusedError, FileNotFoundError):
+            _remove_peer(path)
+            continue
+        except BlockingIOError:
+            continue
+        del _backlog[path]
+    if _backlog:
+        _schedule_retry()
+
+# 对应的worker已经退出：从列表中移除，清理残留的socket文件
+def _remove_peer(path):
+    _peers.discard(path)
+    _backlog.pop(path, None)
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def _on_peers(action, path):
+    if path == _path:
+        return
+    if action == 'join':
+        _peers.add(path)
+    else:
+        _peers.discard(path)
+        _backlog.pop(path, None)
+
+def _on_readable():
+    while True:
+        try:
+            data = _sock.recv(MAX_MESSAGE_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        try:
+            msg = json.loads(data.decode('utf-8'))
+        except ValueError:
+            logging.warning('invalid ipc message: %r' % data[:100])
+            continue
+        if msg['channel'] == _PEERS:
+            _on_peers(**msg['payload'])
+        else:
+            _dispatch(msg['channel'], msg.get('payload', {}))
+
+# 在当前进程的事件循环上开始接收其他worker的消息
+def start(loop, run_dir):
+    global _sock, _path, _run_dir, _loop
+    os.makedirs(run_dir, exist_ok=True)
+    _run_dir = run_dir
+    _path = os.path.join(run_dir, 'worker-%s.sock' % os.getpid())
+    if os.path.exists(_path):
+        os.unlink(_path)
+    _sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    _sock.bind(_path)
+    _sock.setblocking(False)
+    _loop = loop
+    loop.add_reader(_sock.fileno(), _on_readable)
+    # 先绑定再读取目录：同时启动的两个worker至少有一个能在目录中看到对方，另一个通过加入通知得知
+    _peers.clear()
+    _peers.update(os.path.join(run_dir, name) for name in os.listdir(run_dir) if name.endswith('.sock'))
+    _peers.discard(_path)
+    publish_peers(_PEERS, action='join', path=_path)
+    logging.info('ipc channel listening at %s (%s peers)' % (_path, len(_peers)))
+
+def stop():
+    global _sock, _path, _loop, _retry
+    if _sock is None:
+        return
+    publish_peers(_PEERS, action='leave', path=_path)
+    if _retry is not None:
+        _retry.cancel()
+        _retry = None
+    _peers.clear()
+    _backlog.clear()
+    _loop.remove_reader(_sock.fileno())
+    _sock.close()
+    try:
+        os.unlink(_path)
+    except OSError:
+        pass
+    _sock, _path, _loop = None, None, None
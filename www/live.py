@@ -0,0 +1,164 @@
+import logging, asyncio, json
+from collections import deque
+
+from aiohttp import web
+
+import ipc, metrics
+from config import configs
+
+# 评论实时推送（Server-Sent Events），代替客户端轮询/api/comments：
+#     GET /api/live/blogs/{id}：某篇日志的新评论和评论删除
+#     GET /api/live/comments：所有日志的评论（管理员）
+# handlers在评论写入、删除后调用publish，经ipc发给所有worker；每个worker把事件编码一次，放入各订阅者的缓冲
+# 每个连接只占用一个等待中的协程、一个asyncio.Event和一个有上限的缓冲，空闲连接没有定时器：
+#     心跳由一个全局任务每heartbeat秒统一放入所有订阅者的缓冲，写心跳失败的连接（客户端已断开）随之清理
+#     缓冲满了说明客户端读得太慢，直接断开，由EventSource自动重连
+# 事件：
+#     event: comment  data: 评论（带html_content）
+#     event: delete   data: {"id": 评论id, "blog_id": 日志id}
+
+ALL = 'comments'  # 所有评论的频道，日志的频道为'blog:<id>'
+
+SUBSCRIBED = metrics.counter('live_subscribed', 'SSE connections opened.')
+REJECTED = metrics.counter('live_rejected', 'SSE connections rejected because the worker was at max_subscribers.')
+EVICTED = metrics.counter('live_evicted', 'SSE connections closed because the client could not keep up.')
+EVENTS = metrics.counter('live_events', 'Events delivered to subscriber buffers.')
+
+_topics = dict()  # 频道 --> set(Subscriber)
+_count = 0
+_heartbeat = None
+
+metrics.gauge('live_subscribers', 'Open SSE connections.', fn=lambda: _count)
+
+class Subscriber(object):
+
+    __slots__ = ('topic', 'maxsize', 'buf', 'wakeup', 'closed')
+
+    def __init__(self, topic, maxsize):
+        self.topic = topic
+        self.maxsize = maxsize
+        self.buf = deque()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+
+    # 放入一条已编码的事件，缓冲已满则断开这个订阅者
+    def put(self, data):
+        if self.closed:
+            return
+        if len(self.buf) >= self.maxsize:
+            EVICTED.inc()
+            logging.info('evict slow sse subscriber of %s' % self.topic)
+            self.close()
+            return
+        self.buf.append(data)
+        self.wakeup.set()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+def _subscribe(sub):
+    global _count
+    _topics.setdefault(sub.topic, set()).add(sub)
+    _count += 1
+
+def _unsubscribe(sub):
+    global _count
+    subs = _topics.get(sub.topic)
+    if subs is not None and sub in subs:
+        subs.discard(sub)
+        _count -= 1
+        if not subs:
+            del _topics[sub.topic]
+
+def _encode(event, data):
+    return ('event: %s\ndata: %s\n\n' % (event, data)).encode('utf-8')
+
+########################################################################################################################
+# 发布：data为可以json序列化的dict，在本进程编码一次，其他worker通过ipc收到同样的json字符串
+
+def publish(event, blog_id, data):
+    ipc.publish('live', event=event, blog_id=str(blog_id), data=json.dumps(data, ensure_ascii=False))
+
+def _on_message(event, blog_id, data):
+    chunk = _encode(event, data)
+    for topic in ('blog:%s' % blog_id, ALL):
+        for sub in list(_topics.get(topic, ())):
+            sub.put(chunk)
+            EVENTS.inc()
+
+def publish_comment(comment):
+    publish('comment', comment.blog_id, comment)
+
+def publish_delete(comment):
+    publish('delete', comment.blog_id, dict(id=comment.id, blog_id=comment.blog_id))
+
+########################################################################################################################
+
+# 订阅topic：返回已经开始发送的StreamResponse，客户端断开、被断开或服务退出时返回
+async def stream(request, topic):
+    c = configs.live
+    if _count >= c.max_subscribers:
+        REJECTED.inc()
+        return web.HTTPServiceUnavailable(headers={'Retry-After': str(c.retry)}, text='Too many live connections, please retry later.')
+    resp = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    await resp.prepare(request)
+    sub = Subscriber(topic, c.buffer)
+    _subscribe(sub)
+    SUBSCRIBED.inc()
+    stalled = False
+    try:
+        await resp.write(b'retry: %d\n\n' % (c.retry * 1000))  # EventSource断线后的重连间隔（毫秒）
+        while True:
+            await sub.wakeup.wait()
+            sub.wakeup.clear()
+            if sub.closed:
+                break
+            # 把积累的事件一次写出，写不出去（对端不读）超过write_timeout秒视为慢客户端
+            chunk = b''.join(sub.buf)
+            sub.buf.clear()
+            await asyncio.wait_for(resp.write(chunk), c.write_timeout)
+    except (ConnectionResetError, asyncio.TimeoutError):
+        stalled = True
+    finally:
+        _unsubscribe(sub)
+    # 结束响应同样要等对端读走缓冲中的数据：慢客户端或超时未写完时直接断开连接，不让它拖住优雅退出
+    if not stalled:
+        try:
+            await asyncio.wait_for(resp.write_eof(), c.write_timeout)
+            return resp
+        except (ConnectionResetError, asyncio.TimeoutError):
+            pass
+    _drop(request)
+    return resp
+
+def _drop(request):
+    transport = request.transport
+    if transport is not None:
+        transport.abort()
+
+async def _send_heartbeats(interval):
+    while True:
+        await asyncio.sleep(interval)
+        for subs in list(_topics.values()):
+            for sub in list(subs):
+                sub.put(b': ping\n\n')
+
+# 随app启动/关闭：app.on_startup、app.on_shutdown和app.on_cleanup的回调
+# on_shutdown在等待进行中的请求之前执行，先断开所有SSE连接，否则优雅退出要等到shutdown_timeout
+async def start(app):
+    global _heartbeat
+    ipc.subscribe('live', _on_message)
+    _heartbeat = asyncio.ensure_future(_send_heartbeats(configs.live.heartbeat))
+
+async def shutdown(app):
+    for subs in list(_topics.values()):
+        for sub in list(subs):
+            sub.close()
+
+async def stop(app):
+    global _heartbeat
+    ipc.unsubscribe('live', _on_message)
+    if _heartbeat is not None:
+        _heartbeat.cancel()
+        _heartbeat = None
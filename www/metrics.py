@@ -0,0 +1,124 @@
+import bisect, threading
+
+# 进程内的运行指标：计数器（Counter）、瞬时值（Gauge）和直方图（Histogram）
+# 各模块在导入时创建自己的指标，管理员通过GET /api/metrics查看当前worker进程的所有指标
+# 用法：
+#     REQUESTS = metrics.counter('http_requests', 'Total HTTP requests.')
+#     REQUESTS.inc()
+#     metrics.gauge('pool_free', 'Free connections.', fn=lambda: pool.freesize)
+
+_registry = dict()  # name --> metric
+_lock = threading.Lock()
+
+# 默认的直方图分桶（秒），覆盖1毫秒到10秒
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter(object):
+
+    kind = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def snapshot(self):
+        return self.value
+
+class Gauge(object):
+
+    kind = 'gauge'
+
+    # fn：每次读取时调用fn()得到当前值，适合连接池大小这类随时变化的量
+    def __init__(self, name, help='', fn=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def snapshot(self):
+        if self._fn is not None:
+            try:
+                return self._fn()
+            except Exception:
+                return None
+        return self.value
+
+class Histogram(object):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个桶为 +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # 估算百分位：返回第p百分位所在桶的上界
+    def percentile(self, p):
+        if self.count == 0:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return dict(
+            count=self.count,
+            sum=round(self.sum, 6),
+            max=round(self.max, 6),
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            buckets=dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts))
+        )
+
+def _register(cls, name, *args, **kw):
+    with _lock:
+        m = _registry.get(name)
+        if m is None:
+            m = cls(name, *args, **kw)
+            _registry[name] = m
+        elif not isinstance(m, cls):
+            raise ValueError('metric %s already registered as %s' % (name, m.kind))
+        return m
+
+# 获取（不存在则创建）指定名字的指标
+def counter(name, help=''):
+    return _register(Counter, name, help)
+
+def gauge(name, help='', fn=None):
+    return _register(Gauge, name, help, fn)
+
+def histogram(name, help='', buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, help, buckets)
+
+# 所有指标的当前值：name --> value
+def snapshot(prefix=''):
+    return dict((name, m.snapshot()) for name, m in sorted(_registry.items()) if name.startswith(prefix))
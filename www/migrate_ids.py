@@ -0,0 +1,198 @@
+import logging; logging.basicConfig(level=logging.INFO)
+import asyncio, argparse, json, os
+
+import orm, counters
+from config import configs
+from models import Snowflake
+
+# 主键迁移脚本：把users, blogs, comments三张表的varchar(50)主键以及blog_id, user_id引用改为snowflake的bigint
+# 新id由记录的created_at生成，因此迁移后id仍然按创建时间有序
+# 旧id与新id的对应关系保存在id_map表中，方便核对以及给旧链接做跳转
+# users表的旧id保留在legacy_id字段：旧密码的摘要以旧id计算，用户登录时验证通过后再用新id重新计算
+# 以旧id为键的其他数据一并改写：counters表的obj_id、jobs表args中的id；搜索索引的快照直接删除，启动时重新构建
+# 迁移可以重复执行：已经切换到新id的表直接跳过，中途失败后修正问题再次运行即可
+#     1. 为所有未迁移的表生成id_map（任何一条记录无法分配新id时在修改表结构之前报错）
+#     2. 逐表添加new_*字段并从id_map填入新id
+#     3. 逐表用一条alter语句同时删除旧字段、把new_*改名并重建主键，这一步对单张表是原子的
+#     4. 改写counters和jobs.args中的旧id（已经是新id的不再匹配id_map，重复执行无影响），删除搜索索引快照
+# 用法（需要有alter权限的数据库账号，迁移期间网站应停止写入）：
+#     python migrate_ids.py --user root --password xxx [--dry-run]
+# 迁移完成后在config_override.py中设置 'ids': {'kind': 'snowflake', 'worker': 0}
+
+# 需要迁移的表：表名 --> 引用其他表主键的字段及其所引用的表
+TABLES = (
+    ('users', ()),
+    ('blogs', (('user_id', 'users'),)),
+    ('comments', (('blog_id', 'blogs'), ('user_id', 'users'))),
+    ('jobs', ()),
+)
+
+# 迁移后保留旧id的表：表名 --> 保存旧id的字段
+LEGACY_ID = {
+    'users': 'legacy_id',
+}
+
+# counters表中以主键为obj_id的计数器：计数器名 --> 表名
+COUNTERS = (
+    (counters.BLOG_VIEWS, 'blogs'),
+)
+
+# jobs表args中的主键参数：任务名 --> 参数名及其所引用的表
+# render_blog, export_pages等durable=False的任务不写入jobs表，迁移期间网站停止运行，内存中的任务已经不存在
+JOB_ARGS = {
+    'render_blog': (('id', 'blogs'),),
+    'relabel_user_comments': (('user_id', 'users'),),
+}
+
+BATCH_SIZE = 1000
+
+# 表的字段名 --> 类型
+async def _columns(table):
+    rs = await orm.select('select `column_name` as `name`, `data_type` as `type` from information_schema.`columns` where `table_schema`=database() and `table_name`=?', [table])
+    return dict((r['name'], r['type']) for r in rs)
+
+def _migrated(columns):
+    return columns.get('id') == 'bigint'
+
+# 为一张表的旧主键分配新id：按created_at排序，同一毫秒内的记录用序列号区分，序列号用尽后顺延到下一毫秒，
+# 之后的记录从顺延后的毫秒继续分配，保证新id严格递增、不会重复
+def assign_ids(worker, rows):
+    last_ms, seq = None, 0
+    for r in rows:
+        ms = int(r['created_at'] * 1000)
+        if ms < worker.epoch:
+            raise ValueError('created_at of %s is earlier than the snowflake epoch: %s' % (r['id'], r['created_at']))
+        if last_ms is not None and ms <= last_ms:
+            ms, seq = last_ms, seq + 1
+            if seq > Snowflake.SEQUENCE_MASK:
+                ms, seq = ms + 1, 0
+        else:
+            seq = 0
+        last_ms = ms
+        yield r['id'], worker.id_from_time(ms / 1000.0, seq)
+
+# 为未迁移的表重新生成id_map：先删除该表原有的映射，(table_name, new_id)唯一，分配出重复的新id时直接报错
+async def build_id_map(worker, tables):
+    await orm.execute('create table if not exists `id_map` (`old_id` varchar(50) not null, `table_name` varchar(50) not null, `new_id` bigint not null, primary key (`old_id`), unique key `uk_table_new_id` (`table_name`, `new_id`)) engine=innodb default charset=utf8', None)
+    for table in tables:
+        rs = await orm.select('select `id`, `created_at` from `%s` order by `created_at`, `id`' % table, None)
+        batch = list(assign_ids(worker, rs))  # 先检查全部记录，再写入id_map
+        await orm.execute('delete from `id_map` where `table_name`=?', [table])
+        for i in range(0, len(batch), BATCH_SIZE):
+            await _insert_id_map(table, batch[i:i + BATCH_SIZE])
+        logging.info('mapped %s ids for table %s' % (len(batch), table))
+
+async def _insert_id_map(table, batch):
+    sql = 'insert into `id_map` (`old_id`, `table_name`, `new_id`) values %s' % ', '.join(['(?, ?, ?)'] * len(batch))
+    args = []
+    for old_id, new_id in batch:
+        args.extend([old_id, table, new_id])
+    await orm.execute(sql, args)
+
+# 生成把某张表切换到新id的SQL语句：(添加new_*字段, [填入新id], 切换主键)
+# has_legacy：表中是否已有保存旧id的字段（schema.sql新建的users表已有legacy_id），没有时和new_*字段一起添加
+def migrate_table_sql(table, refs, has_legacy=False):
+    columns = ['id'] + [c for c, _ in refs]
+    legacy = LEGACY_ID.get(table)
+    specs = ['add column `new_%s` bigint' % c for c in columns]
+    if legacy and not has_legacy:
+        specs.append("add column `%s` varchar(50) not null default ''" % legacy)
+    add = 'alter table `%s` %s' % (table, ', '.join(specs))
+    targets = [('id', table)] + list(refs)
+    updates = ["update `%s` t join `id_map` m on m.`old_id`=t.`%s` and m.`table_name`='%s' set t.`new_%s`=m.`new_id`" % (table, c, target, c) for c, target in targets]
+    if legacy:
+        updates.append('update `%s` set `%s`=`id`' % (table, legacy))
+    specs = ['drop primary key']
+    specs.extend('drop column `%s`' % c for c in columns)
+    specs.extend('change column `new_%s` `%s` bigint not null' % (c, c) for c in columns)
+    specs.append('add primary key (`id`)')
+    specs.extend('add key `idx_%s` (`%s`)' % (c, c) for c in columns[1:])
+    switch = 'alter table `%s` %s' % (table, ', '.join(specs))
+    return add, updates, switch
+
+async def migrate_table(table, refs):
+    columns = await _columns(table)
+    add, updates, switch = migrate_table_sql(table, refs, LEGACY_ID.get(table) in columns)
+    if 'new_id' not in columns:
+        await orm.execute(add, None)
+    for sql in updates:
+        await orm.execute(sql, None)
+    # 所有记录都填入了新id才切换，否则保留旧字段，修正后重新运行
+    for c in ['id'] + [c for c, _ in refs]:
+        rs = await orm.select('select count(*) `n` from `%s` where `new_%s` is null' % (table, c), None)
+        if rs[0]['n']:
+            raise ValueError('%s rows of %s have no new %s, check id_map and run the migration again' % (rs[0]['n'], table, c))
+    await orm.execute(switch, None)
+    logging.info('table %s switched to snowflake ids' % table)
+
+def remap_counters_sql():
+    return ["update `counters` c join `id_map` m on m.`old_id`=c.`obj_id` and m.`table_name`='%s' set c.`obj_id`=cast(m.`new_id` as char) where c.`name`='%s'" % (table, name) for name, table in COUNTERS]
+
+async def remap_counters():
+    for sql in remap_counters_sql():
+        rows = await orm.execute(sql, None)
+        logging.info('remapped %s counters: %s' % (rows, sql))
+
+# 改写jobs表args中的旧id，找不到对应新id的参数（已经改写过，或引用的记录已删除）保持不变
+async def remap_job_args():
+    names = list(JOB_ARGS)
+    jobs = await orm.select('select `id`, `name`, `args` from `jobs` where `name` in (%s)' % ', '.join(['?'] * len(names)), names)
+    changed = 0
+    for job in jobs:
+        args = json.loads(job['args'])
+        remapped = False
+        for arg, table in JOB_ARGS[job['name']]:
+            old_id = args.get(arg)
+            if not isinstance(old_id, str):
+                continue
+            rs = await orm.select('select `new_id` from `id_map` where `old_id`=? and `table_name`=?', [old_id, table])
+            if rs:
+                args[arg] = rs[0]['new_id']
+                remapped = True
+        if remapped:
+            await orm.execute('update `jobs` set `args`=? where `id`=?', [json.dumps(args, ensure_ascii=False), job['id']])
+            changed = changed + 1
+    logging.info('remapped ids in the args of %s jobs' % changed)
+
+# 快照中的文档仍以旧id为键，删除后启动时从数据库全量构建
+def remove_search_snapshot():
+    path = configs.search.snapshot
+    if path and os.path.exists(path):
+        os.remove(path)
+        logging.info('search snapshot %s removed, the index will be rebuilt on startup' % path)
+
+async def migrate(loop, args):
+    if args.dry_run:
+        for table, refs in TABLES:
+            add, updates, switch = migrate_table_sql(table, refs)
+            for sql in [add] + updates + [switch]:
+                print(sql + ';')
+        for sql in remap_counters_sql():
+            print(sql + ';')
+        print('-- rewrite ids in jobs.args of: %s' % ', '.join(JOB_ARGS))
+        print('-- remove search snapshot: %s' % (configs.search.snapshot or '(none)'))
+        return
+    db = dict(configs.db)
+    db.update(user=args.user, password=args.password)
+    await orm.create_pool(loop=loop, **db)
+    pending = []
+    for table, refs in TABLES:
+        if _migrated(await _columns(table)):
+            logging.info('table %s already migrated, skip' % table)
+        else:
+            pending.append((table, refs))
+    await build_id_map(Snowflake(configs.ids.worker), [table for table, _ in pending])
+    for table, refs in pending:
+        await migrate_table(table, refs)
+    await remap_counters()
+    await remap_job_args()
+    remove_search_snapshot()
+    logging.info('id migration finished, set configs.ids.kind to "snowflake".')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate varchar(50) primary keys to snowflake bigint ids.')
+    parser.add_argument('--user', default=configs.db.user)
+    parser.add_argument('--password', default=configs.db.password)
+    parser.add_argument('--dry-run', action='store_true', help='print the DDL statements without running them')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(migrate(loop, parser.parse_args()))
@@ -1,12 +1,95 @@
-import time, uuid
+import time, uuid, threading
 
 import orm
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, IntegerField, CounterField, FloatField, TextField
+from config import configs
 # import asyncio
 
+# 主键生成方式：'uuid'为原来的50位字符串主键，'snowflake'为时间有序的整数主键（存为bigint）
+_ID_KIND = configs.ids.kind
+
+# 雪花算法ID生成器：时间戳(毫秒) + 机器号 + 序列号，单调递增且按时间有序
+# 总共只用53位（41位时间 + 5位机器号 + 7位序列号），存入bigint的同时保证前端JavaScript的Number不丢失精度
+# 41位毫秒时间从EPOCH起可用约69年，每个worker每毫秒最多生成128个id，超出时借用之后的毫秒
+class Snowflake(object):
+
+    EPOCH = 1577836800000  # 2020-01-01 00:00:00 UTC
+    WORKER_BITS = 5
+    SEQUENCE_BITS = 7
+    MAX_WORKER = (1 << WORKER_BITS) - 1
+    SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+    MAX_DRIFT = 1000  # 序列号用尽时借用之后的毫秒，最多领先系统时钟的毫秒数
+
+    def __init__(self, worker_id=0, epoch=EPOCH):
+        if worker_id < 0 or worker_id > self.MAX_WORKER:
+            raise ValueError('worker id must be between 0 and %s: %s' % (self.MAX_WORKER, worker_id))
+        self.worker_id = worker_id
+        self.epoch = epoch
+        self._last = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def _compose(self, ms, sequence):
+        return ((ms - self.epoch) << (self.WORKER_BITS + self.SEQUENCE_BITS)) | (self.worker_id << self.SEQUENCE_BITS) | sequence
+
+    def next_id(self):
+        with self._lock:
+            now = wall = int(time.time() * 1000)
+            if now < self._last:  # 时钟回拨或借用了之后的毫秒：继续使用上一毫秒，保证单调递增
+                now = self._last
+            if now == self._last:
+                self._sequence = (self._sequence + 1) & self.SEQUENCE_MASK
+                if self._sequence == 0:  # 当前毫秒的序列号用尽，借用下一毫秒，不在事件循环中等待
+                    now = self._last + 1
+                    if now - wall > self.MAX_DRIFT:
+                        raise RuntimeError('snowflake worker %s is generating ids faster than %s per millisecond' % (self.worker_id, self.SEQUENCE_MASK + 1))
+            else:
+                self._sequence = 0
+            self._last = now
+            return self._compose(now, self._sequence)
+
+    # 根据已有记录的created_at生成id（用于迁移旧数据），sequence用于区分同一毫秒内的多条记录
+    def id_from_time(self, t, sequence=0):
+        ms = int(t * 1000)
+        if ms < self.epoch:
+            raise ValueError('time %s is earlier than the snowflake epoch' % t)
+        return self._compose(ms, sequence & self.SEQUENCE_MASK)
+
+    # 从id中取出生成时间（秒）
+    def time_of(self, id):
+        return ((int(id) >> (self.WORKER_BITS + self.SEQUENCE_BITS)) + self.epoch) / 1000.0
+
+_id_worker = Snowflake(configs.ids.worker)
+
+# 启动时检查机器号：prefork时各worker依次使用worker ~ worker+2*workers-1（新旧两代worker的编号不重叠），不能超过MAX_WORKER
+def check_id_workers(workers):
+    if _ID_KIND != 'snowflake':
+        return
+    first = configs.ids.worker
+    last = first + (2 * workers - 1 if workers > 1 else 0)
+    if first < 0 or last > Snowflake.MAX_WORKER:
+        raise ValueError('snowflake worker ids %s ~ %s for %s workers are out of range 0 ~ %s, lower configs.ids.worker or configs.server.workers' % (first, last, workers, Snowflake.MAX_WORKER))
+
+# 设置当前进程的机器号，多进程部署时每个进程必须使用不同的机器号
+def set_id_worker(worker_id):
+    global _id_worker
+    _id_worker = Snowflake(worker_id)
+
+# 原来的50位字符串主键：15位毫秒时间戳 + 32位uuid + '000'
+def uuid_id():
+    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)  #uuid.uuid4().hex --> 将'-'删除
+
 # 生成唯一主键id
 def next_id():
-    return '%015d%s000' % (int(time.time() * 1000), uuid.uuid4().hex)  #uuid.uuid4().hex --> 将'-'删除
+    if _ID_KIND == 'snowflake':
+        return _id_worker.next_id()
+    return uuid_id()
+
+# 主键以及引用其他表主键的字段（如blog_id, user_id），类型随主键生成方式变化
+def id_field(primary_key=False):
+    if _ID_KIND == 'snowflake':
+        return IntegerField(primary_key=primary_key, default=next_id if primary_key else 0)
+    return StringField(primary_key=primary_key, default=next_id if primary_key else None, ddl='varchar(50)')
 
 # 在编写ORM时，给一个Field增加一个default参数可以让ORM自己填入缺省值，非常方便。
 # 并且，缺省值可以作为函数对象传入，在调用save()时自动计算。例如，主键id的缺省值
@@ -22,39 +105,93 @@ def next_id():
 class User(Model):
 
     __table__ = 'users'
+    __unique__ = ('email',)
+    __indexes__ = ('created_at',)
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
+    id = id_field(primary_key=True)
     email = StringField(ddl='varchar(50)')
     passwd = StringField(ddl='varchar(50)')
     admin = BooleanField()  # 是否为管理员
     name = StringField(ddl='varchar(50)')
     image = StringField(ddl='varchar(500)')
+    legacy_id = StringField(ddl='varchar(50)', default='')  # migrate_ids.py迁移前的旧id，旧密码以它计算摘要；未迁移过的用户为空
     created_at = FloatField(default=time.time)
 
 class Blog(Model):
 
     __table__ = 'blogs'
+    __indexes__ = ('created_at',)
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = id_field(primary_key=True)
+    user_id = id_field()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')  # 博客名
     summary = StringField(ddl='varchar(200)')  # 博客概要
-    content = TextField()  # 正文
+    content = TextField(ddl='mediumtext')  # 正文
+    comment_count = CounterField()  # 评论数，随评论的增删在同一事务中原子更新
     created_at = FloatField(default=time.time)
 
+# 列表页用到的日志字段（不含正文）
+BLOG_LIST_FIELDS = ('user_id', 'user_name', 'user_image', 'name', 'summary', 'comment_count', 'created_at')
+
 class Comment(Model):
 
     __table__ = 'comments'
+    __indexes__ = ('created_at', ('blog_id', 'created_at'))
 
-    id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(ddl='varchar(50)')
-    user_id = StringField(ddl='varchar(50)')
+    id = id_field(primary_key=True)
+    blog_id = id_field()
+    user_id = id_field()
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
-    content = TextField()  # 评论内容
+    content = TextField(ddl='mediumtext')  # 评论内容
+    created_at = FloatField(default=time.time)
+
+    # 保存评论的同时在同一事务中给日志的评论数加一
+    async def save(self):
+        async with orm.transaction():
+            rows = await super().save()
+            if rows == 1:
+                await Blog.incr(self.blog_id, 'comment_count', 1)
+        return rows
+
+    async def remove(self):
+        async with orm.transaction():
+            rows = await super().remove()
+            if rows == 1:
+                await Blog.incr(self.blog_id, 'comment_count', -1)
+        return rows
+
+# 后台任务（见tasks.py），args为JSON编码的参数
+class Job(Model):
+
+    __table__ = 'jobs'
+    __indexes__ = (('status', 'run_at'),)
+
+    id = id_field(primary_key=True)
+    name = StringField(ddl='varchar(50)')
+    args = TextField(ddl='mediumtext')
+    status = StringField(ddl='varchar(20)')  # pending, running, failed
+    attempts = IntegerField()
+    run_at = FloatField(default=time.time)  # 最早执行时间
+    error = TextField()
     created_at = FloatField(default=time.time)
+    updated_at = FloatField(default=time.time)
+
+# 建表语句（与schema.sql中的表相同），按当前的存储后端生成
+# counters表（写回式计数器，见counters.py）是联合主键，没有对应的Model
+def schema_statements():
+    L = []
+    for model in (User, Blog, Comment, Job):
+        L.extend(orm.create_table_sql(model))
+    L.extend(orm.backend().create_table('counters', [('name', 'varchar(50)', None), ('obj_id', 'varchar(50)', None), ('value', 'bigint', None)], ('name', 'obj_id')))
+    return L
+
+# 创建所有表（已存在的表不变），用于SQLite等不经过schema.sql初始化的数据库
+async def create_schema():
+    for sql in schema_statements():
+        await orm.execute(sql, None)
 
 # 测试数据库操作
 # if __name__ == '__main__':
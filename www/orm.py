@@ -1,57 +1,648 @@
-import logging, asyncio, aiomysql
+import logging, asyncio, time, contextvars, hashlib, os, re, sqlite3, sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from cache import LRUCache
+
+__pool = None
+_backend = None  # 存储后端，由create_pool根据配置的backend创建，缺省为MySQL
+
+# 连接池的获取超时和背压参数，由create_pool根据配置设置
+_acquire_timeout = 5.0  # 等待空闲连接的最长时间（秒）
+_max_waiting = 50  # 等待连接的请求超过这个数时直接拒绝（快速失败，返回503）
+_ping_interval = 60.0  # 连接空闲超过这个时间（秒），使用前先ping一下，断开则重连
+_waiting = 0
+
+POOL_WAIT = metrics.histogram('db_pool_acquire_seconds', 'Time spent waiting for a pooled connection.')
+POOL_TIMEOUTS = metrics.counter('db_pool_acquire_timeouts', 'Acquires that gave up after acquire_timeout.')
+POOL_REJECTED = metrics.counter('db_pool_rejected', 'Acquires rejected because too many requests were waiting.')
+POOL_PINGS = metrics.counter('db_pool_pings', 'Health-check pings on idle connections.')
+POOL_RECONNECTS = metrics.counter('db_pool_ping_failures', 'Idle connections that failed the health-check ping.')
+metrics.gauge('db_pool_size', 'Open connections.', fn=lambda: __pool.size if __pool else 0)
+metrics.gauge('db_pool_free', 'Idle connections.', fn=lambda: __pool.freesize if __pool else 0)
+metrics.gauge('db_pool_in_use', 'Connections checked out.', fn=lambda: (__pool.size - __pool.freesize) if __pool else 0)
+metrics.gauge('db_pool_waiting', 'Coroutines waiting for a connection.', fn=lambda: _waiting)
+metrics.gauge('db_pool_maxsize', 'Configured maximum pool size.', fn=lambda: __pool.maxsize if __pool else 0)
+QUERY_TIME = metrics.histogram('db_query_seconds', 'Time spent executing statements, excluding the wait for a connection.')
+SLOW_QUERIES = metrics.counter('db_slow_queries', 'Statements slower than the slow query threshold.')
+EXPLAINS = metrics.counter('db_slow_query_explains', 'EXPLAIN plans captured for new slow query shapes.')
+
+# 连接池繁忙：等待连接的请求过多，或等待超时。上层应返回503让客户端稍后重试
+class PoolBusyError(Exception):
+    pass
+
+class PoolTimeoutError(PoolBusyError):
+    pass
+
+# 熔断器断开：数据库不健康，不再发出新的语句
+class CircuitOpenError(PoolBusyError):
+    pass
+
+# 熔断器：连续failures次语句出错（连接断开、超时等，不包括唯一键冲突这类正常的业务错误，也不包括等待连接池超时）或超过latency秒时断开，
+# 断开期间acquire直接抛出CircuitOpenError，不再让请求堆积在变慢的数据库上；
+# reset_timeout秒后放行一个探测请求（半开），探测成功则恢复，失败则继续断开
+class CircuitBreaker(object):
+
+    def __init__(self, failures=5, reset_timeout=5.0, latency=2.0):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.latency = latency
+        self.state = 'closed'
+        self._failed = 0
+        self._opened_at = 0.0
+        self._probe_at = None  # 半开状态下探测请求的放行时间
+
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        now = time.monotonic()
+        if self.state == 'open':
+            if now - self._opened_at < self.reset_timeout:
+                return False
+            self.state = 'half-open'
+            self._probe_at = None
+        # 同一时间只放行一个探测请求，探测请求没有执行语句就结束时，过reset_timeout秒再放行下一个
+        if self._probe_at is None or now - self._probe_at >= self.reset_timeout:
+            self._probe_at = now
+            return True
+        return False
+
+    def success(self):
+        if self.state != 'closed':
+            logging.info('database circuit closed.')
+        self.state = 'closed'
+        self._failed = 0
+
+    def failure(self):
+        self._failed += 1
+        if self.state == 'half-open' or (self.state == 'closed' and self._failed >= self.failures):
+            if self.state == 'closed':
+                BREAKER_OPENED.inc()
+            logging.warning('database circuit open after %s failures.' % self._failed)
+            self.state = 'open'
+            self._opened_at = time.monotonic()
+
+    def record(self, elapsed):
+        if elapsed > self.latency:
+            self.failure()
+        else:
+            self.success()
+
+_breaker = CircuitBreaker()
+
+BREAKER_OPENED = metrics.counter('db_breaker_opened', 'Times the database circuit breaker opened.')
+BREAKER_REJECTED = metrics.counter('db_breaker_rejected', 'Acquires rejected while the database circuit breaker was open.')
+metrics.gauge('db_breaker_open', '1 while the database circuit breaker is open or half-open.', fn=lambda: 0 if _breaker.state == 'closed' else 1)
+
+# 数据库是否健康（熔断器闭合）
+def healthy():
+    return _breaker.state == 'closed'
 
 # 打印SQL语句日志
 def log(sql, args=()):
     logging.info('SQL: %s' % sql)
 
+########################################################################################################################
+# 慢查询日志：select/execute执行超过slow_query秒的语句记入环形缓冲，管理员在/manage/slow_queries查看
+# 每条记录包括归一化后的SQL形状（字面量替换为?，in列表和多行values合并）、参数指纹（不保存参数值）和调用者（orm之外的第一帧）
+# 每种新的SQL形状在后台用空闲连接执行一次EXPLAIN，没有空闲连接时等下次再慢时再试，不和请求抢连接
+
+_slow_query = 0.2  # 慢查询阈值（秒），0为关闭，由create_pool根据配置设置
+_slow = deque(maxlen=200)
+_plans = LRUCache(maxsize=200)  # SQL形状 --> EXPLAIN结果
+_explaining = set()
+
+_LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\b\d+(?:\.\d+)?\b")
+_SPACES = re.compile(r'\s+')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_ROWS = re.compile(r'\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+')
+_EXPLAINABLE = re.compile(r'\s*(select|update|delete)\b', re.I)
+
+# SQL形状：参数不同的同一类语句归为一类
+def sql_shape(sql):
+    shape = _SPACES.sub(' ', _LITERALS.sub('?', sql)).strip()
+    return _ROWS.sub('(...)', _IN_LIST.sub('(...)', shape))
+
+def _fingerprint(args):
+    return hashlib.sha1(repr(list(args or ())).encode('utf-8')).hexdigest()[:12]
+
+# 调用者：跳过orm自身的帧，协程的帧沿await链向上
+def _caller():
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '%s:%s:%s' % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name, frame.f_lineno)
+
+def _observe(sql, args, elapsed, rows):
+    QUERY_TIME.observe(elapsed)
+    if not _slow_query or elapsed < _slow_query or sql.startswith('explain'):
+        return
+    SLOW_QUERIES.inc()
+    shape = sql_shape(sql)
+    _slow.append(dict(at=time.time(), duration=round(elapsed, 6), shape=shape, args=_fingerprint(args), caller=_caller(), rows=rows))
+    logging.warning('slow query (%.3fs): %s' % (elapsed, shape))
+    if shape not in _plans and shape not in _explaining and _EXPLAINABLE.match(sql) and __pool is not None and __pool.freesize > 0:
+        _explaining.add(shape)
+        asyncio.ensure_future(_explain(shape, sql, args))
+
+async def _explain(shape, sql, args):
+    _current_tx.set(None)  # 新task复制了调用者的上下文，不能使用调用者事务中的连接
+    try:
+        _plans.set(shape, await explain(sql, args))
+        EXPLAINS.inc()
+    except PoolBusyError:
+        pass
+    except Exception as e:
+        _plans.set(shape, [dict(error=str(e))])
+    finally:
+        _explaining.discard(shape)
+
+# 最近的慢查询（新的在前）以及按SQL形状汇总（总耗时多的在前），带EXPLAIN结果
+def slow_queries():
+    shapes = dict()
+    for q in _slow:
+        s = shapes.get(q['shape'])
+        if s is None:
+            s = shapes[q['shape']] = dict(shape=q['shape'], count=0, total=0.0, max=0.0, callers=[], plan=_plans.get(q['shape']))
+        s['count'] += 1
+        s['total'] = round(s['total'] + q['duration'], 6)
+        s['max'] = max(s['max'], q['duration'])
+        if q['caller'] not in s['callers']:
+            s['callers'].append(q['caller'])
+    return dict(
+        threshold=_slow_query,
+        queries=list(reversed(_slow)),
+        shapes=sorted(shapes.values(), key=lambda s: s['total'], reverse=True)
+    )
+
+########################################################################################################################
+# 存储后端：连接池的创建、游标、占位符，以及各数据库语法不同的语句（upsert、字符串拼接、EXPLAIN、建表）
+# Model生成的SQL和其他模块中的SQL统一使用'?'占位符和反引号，由后端转换成数据库的写法
+# 连接池对象的接口与aiomysql的连接池一致：acquire()/release(conn)/close()/wait_closed()以及size、freesize、maxsize
+
+class MySQLBackend(object):
+
+    name = 'mysql'
+
+    # 缺省情况下编码设置为utf-8，自动提交事务
+    async def create_pool(self, loop=None, **kw):
+        import aiomysql
+        return (await aiomysql.create_pool(
+            # 连接所需参数
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            db=kw['db'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True),
+            maxsize=kw.get('maxsize', 10),
+            minsize=kw.get('minsize', 1),
+            pool_recycle=kw.get('pool_recycle', -1),  # 连接使用超过这个时间（秒）后关闭重建，-1为不限制
+            loop=loop
+        ))
+
+    # 打开游标，dict_rows为True时每行结果为dict
+    async def cursor(self, conn, dict_rows=False):
+        if dict_rows:
+            import aiomysql
+            return (await conn.cursor(aiomysql.DictCursor))
+        return (await conn.cursor())
+
+    # SQL语句的占位符是'?',而MySQL的占位符是'%s',需要进行转换
+    def format(self, sql):
+        return sql.replace('?', '%s')
+
+    def column_type(self, ddl):
+        return ddl
+
+    # 建表语句：columns为[(列名, 类型, 缺省值或None)]，indexes和unique为列名或列名tuple的列表
+    def create_table(self, table, columns, primary_key, indexes=(), unique=()):
+        lines = [_column_def(name, self.column_type(ddl), default) for name, ddl, default in columns]
+        lines.extend('unique key `%s` (%s)' % (_index_name(cols), _column_list(cols)) for cols in unique)
+        lines.extend('key `%s` (%s)' % (_index_name(cols), _column_list(cols)) for cols in indexes)
+        lines.append('primary key (%s)' % _column_list(primary_key))
+        return ['create table if not exists `%s` (\n    %s\n) engine=innodb default charset=utf8' % (table, ',\n    '.join(lines))]
+
+    # 批量插入rows行，与已有的行主键或唯一键冲突时把increments中的列加到已有的行上
+    def upsert(self, table, columns, rows, keys, increments):
+        return 'insert into `%s` (%s) values %s on duplicate key update %s' % (table, _column_list(columns), _values(columns, rows), ', '.join('`%s`=`%s`+values(`%s`)' % (c, c, c) for c in increments))
+
+    def concat(self, *exprs):
+        return 'concat(%s)' % ', '.join(exprs)
+
+    def explain(self, sql):
+        return 'explain ' + sql
+
+    # 语句的异常是否说明数据库不健康（计入熔断器）
+    def is_failure(self, e):
+        import pymysql
+        return isinstance(e, (pymysql.err.OperationalError, pymysql.err.InterfaceError, OSError, asyncio.TimeoutError))
+
+# 嵌入式SQLite：每个进程一个数据库连接，所有语句在一个专用线程中执行，不阻塞事件循环
+# WAL模式下多个worker进程可以同时读，写入由SQLite的文件锁串行化（在busy_timeout内等待，只阻塞专用线程）
+# 事务期间独占连接，其他协程的语句等事务结束后再执行
+class SQLiteBackend(MySQLBackend):
+
+    name = 'sqlite'
+
+    _TYPES = (('varchar', 'text'), ('mediumtext', 'text'), ('text', 'text'), ('bigint', 'integer'), ('bool', 'integer'), ('real', 'real'))
+
+    async def create_pool(self, loop=None, **kw):
+        pool = SQLitePool(kw.get('path', ':memory:'), kw.get('maxsize', 10), kw.get('busy_timeout', 5))
+        await pool.open()
+        return pool
+
+    async def cursor(self, conn, dict_rows=False):
+        return (await conn.cursor(dict_rows))
+
+    def format(self, sql):
+        return sql
+
+    def column_type(self, ddl):
+        for prefix, t in self._TYPES:
+            if ddl.startswith(prefix):
+                return t
+        raise ValueError('unsupported column type for sqlite: %s' % ddl)
+
+    def create_table(self, table, columns, primary_key, indexes=(), unique=()):
+        lines = [_column_def(name, self.column_type(ddl), default) for name, ddl, default in columns]
+        lines.append('primary key (%s)' % _column_list(primary_key))
+        L = ['create table if not exists `%s` (\n    %s\n)' % (table, ',\n    '.join(lines))]
+        # SQLite的索引名在整个数据库中唯一，加上表名前缀
+        L.extend('create unique index if not exists `%s_%s` on `%s` (%s)' % (table, _index_name(cols), table, _column_list(cols)) for cols in unique)
+        L.extend('create index if not exists `%s_%s` on `%s` (%s)' % (table, _index_name(cols), table, _column_list(cols)) for cols in indexes)
+        return L
+
+    def upsert(self, table, columns, rows, keys, increments):
+        return 'insert into `%s` (%s) values %s on conflict (%s) do update set %s' % (table, _column_list(columns), _values(columns, rows), _column_list(keys), ', '.join('`%s`=`%s`+excluded.`%s`' % (c, c, c) for c in increments))
+
+    def concat(self, *exprs):
+        return ' || '.join(exprs)
+
+    def explain(self, sql):
+        return 'explain query plan ' + sql
+
+    def is_failure(self, e):
+        return isinstance(e, (sqlite3.OperationalError, OSError))  # 例如等待其他进程的写锁超时：database is locked
+
+def _columns(cols):
+    return (cols,) if isinstance(cols, str) else tuple(cols)
+
+def _column_list(cols):
+    return ', '.join('`%s`' % c for c in _columns(cols))
+
+def _column_def(name, column_type, default):
+    return '`%s` %s not null%s' % (name, column_type, '' if default is None else ' default %s' % default)
+
+def _index_name(cols):
+    return 'idx_' + '_'.join(_columns(cols))
+
+def _values(columns, rows):
+    return ', '.join(['(%s)' % create_args_string(len(columns))] * rows)
+
+class SQLitePool(object):
+
+    def __init__(self, path, maxsize=10, busy_timeout=5):
+        self.path = path
+        self.maxsize = maxsize
+        self.size = maxsize
+        self.freesize = maxsize
+        self._busy_timeout = busy_timeout
+        self._slots = asyncio.Semaphore(maxsize)  # 和MySQL连接池一样限制同时借出的连接数，acquire超时和背压的行为一致
+        self._tx_lock = asyncio.Lock()
+        self._thread = ThreadPoolExecutor(1, thread_name_prefix='sqlite')
+        self._db = None
+
+    async def run(self, fn, *args):
+        return (await asyncio.get_running_loop().run_in_executor(self._thread, fn, *args))
+
+    def _open(self):
+        # isolation_level=None：自动提交，事务由begin显式开始
+        db = sqlite3.connect(self.path, timeout=self._busy_timeout, isolation_level=None, check_same_thread=False)
+        db.execute('pragma journal_mode=wal')
+        db.execute('pragma synchronous=normal')
+        return db
+
+    async def open(self):
+        self._db = await self.run(self._open)
+
+    # 在专用线程中执行一条语句，返回(影响的行数, 结果集)
+    def _execute(self, sql, args, dict_rows):
+        cur = self._db.execute(sql, args or ())
+        try:
+            if cur.description is None:
+                return cur.rowcount, []
+            if dict_rows:
+                names = [d[0] for d in cur.description]
+                return cur.rowcount, [dict(zip(names, r)) for r in cur.fetchall()]
+            return cur.rowcount, cur.fetchall()
+        finally:
+            cur.close()
+
+    async def acquire(self):
+        await self._slots.acquire()
+        self.freesize -= 1
+        return SQLiteConnection(self)
+
+    def release(self, conn):
+        self.freesize += 1
+        self._slots.release()
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        if self._db is not None:
+            await self.run(self._db.close)
+            self._db = None
+        self._thread.shutdown(wait=True)
+
+class SQLiteConnection(object):
+
+    last_usage = 0  # 本地文件不需要ping
+
+    def __init__(self, pool):
+        self._pool = pool
+        self._in_tx = False
+
+    async def cursor(self, dict_rows=False):
+        return SQLiteCursor(self, dict_rows)
+
+    async def execute(self, sql, args, dict_rows):
+        if self._in_tx:
+            return (await self._pool.run(self._pool._execute, sql, args, dict_rows))
+        async with self._pool._tx_lock:  # 等待其他协程的事务结束
+            return (await self._pool.run(self._pool._execute, sql, args, dict_rows))
+
+    async def begin(self):
+        await self._pool._tx_lock.acquire()
+        try:
+            # immediate：开始时就取得写锁，避免事务中途升级为写事务时因其他进程在写而失败
+            await self._pool.run(self._pool._execute, 'begin immediate', None, False)
+        except BaseException:
+            self._pool._tx_lock.release()
+            raise
+        self._in_tx = True
+
+    async def commit(self):
+        await self._end('commit')
+
+    async def rollback(self):
+        await self._end('rollback')
+
+    async def _end(self, sql):
+        try:
+            await self._pool.run(self._pool._execute, sql, None, False)
+        finally:
+            self._in_tx = False
+            self._pool._tx_lock.release()
+
+class SQLiteCursor(object):
+
+    def __init__(self, conn, dict_rows):
+        self._conn = conn
+        self._dict_rows = dict_rows
+        self._rows = []
+        self.rowcount = -1
+
+    async def execute(self, sql, args=None):
+        self.rowcount, self._rows = await self._conn.execute(sql, args, self._dict_rows)
+        return self.rowcount
+
+    async def fetchall(self):
+        return self._rows
+
+    async def fetchmany(self, size):
+        return self._rows[:size]
+
+    async def close(self):
+        pass
+
+BACKENDS = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+# 当前的存储后端，尚未创建连接池时为MySQL
+def backend():
+    global _backend
+    if _backend is None:
+        _backend = MySQLBackend()
+    return _backend
+
+# 以下语句各数据库的写法不同，由当前的后端生成
+def upsert_sql(table, columns, rows, keys, increments):
+    return backend().upsert(table, columns, rows, keys, increments)
+
+def concat(*exprs):
+    return backend().concat(*exprs)
+
+# 查询sql的执行计划
+async def explain(sql, args):
+    return (await select(backend().explain(sql), args))
+
+# Model的建表语句：列类型来自Field的ddl，索引来自Model的__indexes__和__unique__
+def create_table_sql(model):
+    columns = []
+    for name, field in model.__mappings__.items():
+        columns.append((field.name or name, field.column_type, 0 if isinstance(field, CounterField) else None))
+    return backend().create_table(model.__table__, columns, model.__primary_key__, getattr(model, '__indexes__', ()), getattr(model, '__unique__', ()))
+
+########################################################################################################################
+
 # 创建全局数据库连接池，由全局变量__pool存储，每个http请求都从池中获得数据库连接
-# 缺省情况下编码设置为utf-8，自动提交事务
-async def create_pool(loop, **kw):  # 传入事件循环对象loop
+# backend：'mysql'（缺省）或'sqlite'，sqlite使用path指定的数据库文件
+async def create_pool(loop=None, **kw):  # 传入事件循环对象loop，缺省为当前运行的事件循环
     logging.info('create database connection pool...')
+    global __pool, _backend, _breaker, _acquire_timeout, _max_waiting, _ping_interval, _slow_query, _slow, _plans
+    _acquire_timeout = kw.get('acquire_timeout', _acquire_timeout)
+    _max_waiting = kw.get('max_waiting', _max_waiting)
+    _ping_interval = kw.get('ping_interval', _ping_interval)
+    _slow_query = kw.get('slow_query', _slow_query)
+    if 'slow_queries' in kw:
+        _slow = deque(_slow, maxlen=kw['slow_queries'])
+        _plans = LRUCache(maxsize=kw['slow_queries'])
+    name = kw.get('backend', 'mysql')
+    if name not in BACKENDS:
+        raise ValueError('unknown database backend: %s' % name)
+    _backend = BACKENDS[name]()
+    _breaker = CircuitBreaker(kw.get('breaker_failures', 5), kw.get('breaker_reset', 5.0), kw.get('breaker_latency', 2.0))
+    __pool = await _backend.create_pool(loop, **kw)
+
+# 关闭连接池：等待正在使用的连接归还后再关闭（进程优雅退出时调用）
+async def close_pool():
     global __pool
-    __pool = await aiomysql.create_pool(
-        # 连接所需参数
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
-        maxsize=kw.get('maxsize', 10),
-        minsize=kw.get('minsize', 1),
-        loop=loop
-    )
+    if __pool is not None:
+        logging.info('close database connection pool...')
+        __pool.close()
+        await __pool.wait_closed()
+        __pool = None
+
+# 从连接池获取一个连接：
+# 等待的请求超过max_waiting时立即抛出PoolBusyError；等待超过acquire_timeout抛出PoolTimeoutError
+# 空闲过久的连接先ping一下，已断开则自动重连
+async def acquire():
+    global _waiting
+    if not _breaker.allow():
+        BREAKER_REJECTED.inc()
+        raise CircuitOpenError('database circuit breaker is open')
+    if _waiting >= _max_waiting:
+        POOL_REJECTED.inc()
+        raise PoolBusyError('too many requests waiting for a database connection: %s' % _waiting)
+    _waiting += 1
+    start = time.perf_counter()
+    try:
+        conn = await asyncio.wait_for(__pool.acquire(), _acquire_timeout)
+    except asyncio.TimeoutError:  # 连接池用尽是负载问题，不是数据库故障，不计入熔断器
+        POOL_TIMEOUTS.inc()
+        raise PoolTimeoutError('timeout acquiring a database connection after %ss' % _acquire_timeout)
+    finally:
+        _waiting -= 1
+        POOL_WAIT.observe(time.perf_counter() - start)
+    if _ping_interval is not None and conn.last_usage and asyncio.get_running_loop().time() - conn.last_usage > _ping_interval:
+        POOL_PINGS.inc()
+        try:
+            await conn.ping(reconnect=True)
+        except BaseException:
+            POOL_RECONNECTS.inc()
+            __pool.release(conn)
+            raise
+    return conn
+
+def release(conn):
+    __pool.release(conn)
+
+# 事务：在同一个连接上执行多条语句，全部成功才提交
+# 用法：
+#     async with orm.transaction():
+#         await comment.save()
+#         await orm.execute('update ...', args)
+# 事务内的select/execute都使用事务的连接；嵌套使用时并入外层事务
+# 事务内触发的模型变更通知在提交后才发出，回滚则丢弃
+_current_tx = contextvars.ContextVar('orm_transaction', default=None)
+
+class Transaction(object):
+
+    def __init__(self):
+        self.conn = None
+        self.pending = []  # 提交后再发出的模型变更通知：(event, instance)
+        self._outer = None
+        self._token = None
+
+    async def __aenter__(self):
+        self._outer = _current_tx.get()
+        if self._outer is not None:
+            return self._outer
+        self.conn = await acquire()
+        try:
+            await self.conn.begin()
+        except BaseException:
+            release(self.conn)
+            raise
+        self._token = _current_tx.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._outer is not None:
+            return False
+        _current_tx.reset(self._token)
+        try:
+            if exc_type is None:
+                await self.conn.commit()
+            else:
+                await self.conn.rollback()
+        finally:
+            release(self.conn)
+        if exc_type is None:
+            for event, instance in self.pending:
+                _dispatch(event, instance)
+        return False
+
+def transaction():
+    return Transaction()
 
 # 封装select语句
 async def select(sql, args, size=None):
     log(sql, args)
-    global __pool  # 引入全局变量__pool
-    with (await __pool) as conn:  # 从连接池获取一个连接
-        cur = await conn.cursor(aiomysql.DictCursor)  # 打开游标
-        # 执行MySQL语句，SQL语句的占位符是'?',而MySQL的占位符是'%s',需要进行转换
-        await cur.execute(sql.replace('?', '%s'), args or ())
-        if size:
-            rs = await cur.fetchmany(size)
-        else:
-            rs = await cur.fetchall()  # 拿到结果集，结果集是一个list，每个元素是一个tuple，对应数据库一行记录。
+    tx = _current_tx.get()
+    conn = tx.conn if tx is not None else (await acquire())  # 事务中使用事务的连接，否则从连接池获取一个连接
+    try:
+        b = backend()
+        cur = await b.cursor(conn, dict_rows=True)  # 打开游标
+        start = time.perf_counter()
+        try:
+            # 执行SQL语句，占位符由后端转换
+            await cur.execute(b.format(sql), args or ())
+            if size:
+                rs = await cur.fetchmany(size)
+            else:
+                rs = await cur.fetchall()  # 拿到结果集，结果集是一个list，每个元素是一个tuple，对应数据库一行记录。
+        except Exception as e:
+            if b.is_failure(e):
+                _breaker.failure()
+            raise
         await cur.close()  # 关闭游标
+        elapsed = time.perf_counter() - start
+        _breaker.record(elapsed)
+        _observe(sql, args, elapsed, len(rs))
         logging.info('rows returned: %s' % len(rs))
         return rs
+    finally:
+        if tx is None:
+            release(conn)
 
 # 封装insert,update,delete语句
 async def execute(sql, args):
     log(sql)
-    with (await __pool) as conn:
+    tx = _current_tx.get()
+    conn = tx.conn if tx is not None else (await acquire())
+    try:
+        b = backend()
+        cur = await b.cursor(conn)
+        start = time.perf_counter()
         try:
-            cur = await conn.cursor()
-            await cur.execute(sql.replace('?', '%s'), args)
-            # 影响的行数
-            affected = cur.rowcount
-            await cur.close()
-        except BaseException as e:
+            await cur.execute(b.format(sql), args)
+        except Exception as e:
+            if b.is_failure(e):
+                _breaker.failure()
             raise
+        # 影响的行数
+        affected = cur.rowcount
+        await cur.close()
+        elapsed = time.perf_counter() - start
+        _breaker.record(elapsed)
+        _observe(sql, args, elapsed, affected)
         return affected
+    finally:
+        if tx is None:
+            release(conn)
+
+# 模型变更监听：Model的save/update/remove成功执行（影响的行数为1）后调用fn(event, instance)，event为'save', 'update'或'remove'
+# 供搜索索引、缓存等进程内结构做增量更新，fn必须是普通函数且不能阻塞
+_listeners = dict()  # Model子类 --> [fn]
+
+def listen(model, fn):
+    _listeners.setdefault(model, []).append(fn)
+
+def unlisten(model, fn):
+    fns = _listeners.get(model, [])
+    if fn in fns:
+        fns.remove(fn)
+
+def _notify(event, instance):
+    tx = _current_tx.get()
+    if tx is not None:  # 事务提交后再通知
+        tx.pending.append((event, instance))
+    else:
+        _dispatch(event, instance)
+
+def _dispatch(event, instance):
+    for fn in list(_listeners.get(type(instance), ())):
+        try:
+            fn(event, instance)
+        except Exception as e:
+            logging.exception(e)
 
 # ORM框架
 # 构造SQL语句占位符'?'
@@ -98,7 +689,10 @@ class ModelMetaclass(type):
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句:
         attrs['__select__'] = 'select `%s`, %s from `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+        # 计数器字段只能通过原子的增减语句修改，不参与整行update，避免用读到的旧值覆盖并发的增量
+        update_fields = [f for f in fields if not isinstance(mappings[f], CounterField)]
+        attrs['__update_fields__'] = update_fields
+        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), update_fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
         return type.__new__(cls, name, bases, attrs)
 
@@ -132,10 +726,18 @@ class Model(dict, metaclass = ModelMetaclass) :
 
     # 定义class方法用于查找
     # 查找全部列
+    # fields：只查询指定的字段（主键总会查询），列表页可以跳过正文这类大字段
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):  # cls：当前调用此方法的类
         # find objects by where clause
-        sql = [cls.__select__]  # 默认select语句
+        fields = kw.get('fields', None)
+        if fields:
+            for f in fields:
+                if f not in cls.__mappings__:
+                    raise ValueError('Invalid field for %s: %s' % (cls.__name__, f))
+            sql = ['select `%s`, %s from `%s`' % (cls.__primary_key__, ', '.join('`%s`' % f for f in fields if f != cls.__primary_key__), cls.__table__)]
+        else:
+            sql = [cls.__select__]  # 默认select语句
         if where:
             sql.append('where')
             sql.append(where)
@@ -182,6 +784,13 @@ class Model(dict, metaclass = ModelMetaclass) :
             return None
         return cls(**rs[0])
 
+    # 原子地增减计数器字段：update ... set f=f+n，不读取旧值
+    @classmethod
+    async def incr(cls, pk, field, n=1):
+        if not isinstance(cls.__mappings__.get(field), CounterField):
+            raise ValueError('Not a counter field of %s: %s' % (cls.__name__, field))
+        return (await execute('update `%s` set `%s`=`%s`+? where `%s`=?' % (cls.__table__, field, field, cls.__primary_key__), [n, pk]))
+
     # 实例方法：插入、更新、删除
     # 向数据库插入新数据
     async def save(self):
@@ -193,14 +802,20 @@ class Model(dict, metaclass = ModelMetaclass) :
         rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warning('failed to insert record: affected rows: %s' % rows)
+        else:
+            _notify('save', self)
+        return rows
 
     # 更新数据
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        args = list(map(self.getValue, self.__update_fields__))
         args.append(self.getValue(self.__primary_key__))
         rows = await execute(self.__update__, args)
         if rows != 1:
             logging.warning('failed to update by primary key: affected rows: %s' % rows)
+        else:
+            _notify('update', self)
+        return rows
 
     # 删除数据
     async def remove(self):
@@ -208,6 +823,9 @@ class Model(dict, metaclass = ModelMetaclass) :
         rows = await execute(self.__delete__, args)
         if rows != 1:
             logging.warning('failed to remove by primary key: affected rows: %s' % rows)
+        else:
+            _notify('remove', self)
+        return rows
 
 # Field类和各种Field子类，负责保存数据库表的一条字段：字段名、字段类型、主键、默认值
 # 各类型基类
@@ -237,6 +855,12 @@ class IntegerField(Field):
     def __init__(self, name=None, primary_key=False, default=0):
         super().__init__(name, 'bigint', primary_key, default)
 
+# 计数器字段（如日志的评论数）：随insert写入初始值，之后只能用Model.incr原子增减
+class CounterField(IntegerField):
+
+    def __init__(self, name=None, default=0):
+        super().__init__(name, False, default)
+
 class FloatField(Field):
 
     def __init__(self, name=None, primary_key=False, default=0.0):
@@ -244,5 +868,5 @@ class FloatField(Field):
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, ddl='text'):
+        super().__init__(name, ddl, False, default)
@@ -0,0 +1,180 @@
+import logging, os, select, signal, socket, time
+
+# 多进程prefork模式：主进程只负责管理，fork出N个worker进程，每个worker运行自己的事件循环和数据库连接池
+# 支持SO_REUSEPORT的系统上每个worker各自监听同一端口，由内核做负载均衡；否则由主进程创建监听socket后共享给各worker
+# 信号：
+#     SIGTERM/SIGINT：通知所有worker优雅退出（停止接收新连接，处理完进行中的请求后退出）
+#     SIGHUP：滚动重启，先启动一批新worker，等它们全部就绪后再让旧worker优雅退出
+# worker异常退出时主进程会自动重新拉起
+# worker编号（决定snowflake机器号）共2*workers个，只分配给没有存活进程的编号：
+# 旧worker优雅退出期间仍占用自己的编号，连续多次SIGHUP时后一次重启等到有足够的空闲编号才开始
+
+# 系统是否支持SO_REUSEPORT
+def has_reuse_port():
+    return hasattr(socket, 'SO_REUSEPORT')
+
+# 创建由所有worker共享的监听socket（不支持SO_REUSEPORT时使用）
+def create_shared_socket(host, port, backlog=128):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+class Master(object):
+
+    # target(slot, sock, ready)：worker进程的入口函数，slot为worker编号（0 ~ 2*workers-1），
+    # worker开始接收连接后调用ready()通知主进程；ready_timeout秒内新worker没有全部就绪则放弃这次滚动重启，保留旧worker
+    def __init__(self, target, workers, sock=None, ready_timeout=30.0, shutdown_timeout=30.0):
+        self._target = target
+        self._workers = workers
+        self._sock = sock
+        self._ready_timeout = ready_timeout
+        self._shutdown_timeout = shutdown_timeout
+        self._children = dict()  # pid --> slot，包括正在优雅退出的旧worker
+        self._current = set()  # 当前这一代worker的pid，异常退出时按原编号重新拉起
+        self._starting = dict()  # 滚动重启中尚未就绪的新worker：就绪通知管道的读端 --> pid
+        self._ready = set()  # 滚动重启中已经就绪的新worker
+        self._ready_deadline = None
+        self._stopping = False
+        self._reload = False
+
+    # 没有存活进程占用的编号
+    def _free_slots(self):
+        used = set(self._children.values())
+        return [slot for slot in range(2 * self._workers) if slot not in used]
+
+    # notify为True时返回就绪通知管道的读端，worker调用ready()时写入一个字节
+    def _spawn(self, slot, notify=False):
+        r, w = os.pipe() if notify else (None, None)
+        pid = os.fork()
+        if pid == 0:  # 子进程
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C由主进程统一处理
+            for fd in list(self._starting) + ([r] if r is not None else []):
+                os.close(fd)
+            def ready():
+                if w is not None:
+                    os.write(w, b'1')
+                    os.close(w)
+            code = 0
+            try:
+                self._target(slot, self._sock, ready)
+            except BaseException as e:
+                logging.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+        logging.info('worker %s started (pid %s)' % (slot, pid))
+        self._children[pid] = slot
+        if w is not None:
+            os.close(w)
+        return pid, r
+
+    def _kill(self, pids, sig=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+    # 滚动重启：在空闲编号上启动新一代worker，就绪后再让旧worker优雅退出（见_check_ready）
+    # 上一次重启还没完成，或旧worker还没退出完、空闲编号不够时返回False，稍后再试
+    def _restart(self):
+        slots = self._free_slots()
+        if self._starting or len(slots) < self._workers:
+            return False
+        logging.info('restarting workers on slots %s...' % slots[:self._workers])
+        for slot in slots[:self._workers]:
+            pid, r = self._spawn(slot, notify=True)
+            self._starting[r] = pid
+        self._ready_deadline = time.time() + self._ready_timeout
+        return True
+
+    # 读取新worker的就绪通知：全部就绪后切换到新一代并让旧worker退出；有新worker就绪前退出或超时则放弃这次重启
+    def _check_ready(self, timeout):
+        if not self._starting:
+            time.sleep(timeout)
+            return
+        readable, _, _ = select.select(list(self._starting), [], [], timeout)
+        failed = False
+        for r in readable:
+            ok = os.read(r, 1)
+            os.close(r)
+            pid = self._starting.pop(r)
+            if not ok:  # 管道被关闭但没有写入：worker在就绪前退出了
+                logging.error('new worker (pid %s) exited before it was ready' % pid)
+                failed = True
+            else:
+                self._ready.add(pid)
+        if not failed and time.time() > self._ready_deadline:
+            logging.error('new workers not ready after %ss' % self._ready_timeout)
+            failed = True
+        if failed:
+            self._abort_restart()
+        elif not self._starting:
+            old, self._current, self._ready = self._current, self._ready, set()
+            logging.info('new workers ready, stopping %s old workers...' % len(old))
+            self._kill(old)
+
+    def _abort_restart(self):
+        pids = list(self._ready) + list(self._starting.values())
+        for r in self._starting:
+            os.close(r)
+        self._starting.clear()
+        self._ready = set()
+        logging.error('restart aborted, keeping the running workers.')
+        self._kill(pids)
+
+    # 回收已退出的子进程，非主动停止的worker按原编号重新拉起
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._children.clear()
+                return
+            if pid == 0:
+                return
+            slot = self._children.pop(pid, None)
+            if slot is None:
+                continue
+            logging.info('worker %s exited (pid %s, status %s)' % (slot, pid, status))
+            if pid in self._current:
+                self._current.discard(pid)
+                if not self._stopping and status != 0:  # 编号的原主人已经退出，可以直接复用
+                    self._current.add(self._spawn(slot)[0])
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        for slot in range(self._workers):
+            self._current.add(self._spawn(slot)[0])
+        while not self._stopping:
+            if self._reload and self._restart():
+                self._reload = False
+            self._reap()
+            self._check_ready(0.2)
+        if self._starting:
+            self._abort_restart()
+        logging.info('stopping %s workers...' % len(self._children))
+        self._kill(list(self._children.keys()))
+        deadline = time.time() + self._shutdown_timeout
+        while self._children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        if self._children:  # 超时仍未退出的worker直接杀掉
+            self._kill(list(self._children.keys()), signal.SIGKILL)
+            while self._children:
+                self._reap()
+                time.sleep(0.1)
+        logging.info('all workers stopped.')
@@ -0,0 +1,187 @@
+import logging, asyncio, bisect, time
+
+import orm, ipc, metrics, counters
+from config import configs
+from models import Blog, Comment, BLOG_LIST_FIELDS
+
+# 首页和/api/blogs的内存索引：按(created_at, id)倒序保存最新的N篇日志的列表字段（不含正文）以及日志总数
+# 启动时从数据库加载一次，之后由Blog的save/update/remove和Comment的save/remove（评论数）增量更新，其他worker的写入经ipc同步
+# 前几页和总数直接从内存返回，不查询数据库；超出N篇的页返回None，由调用方回退到数据库查询
+# 这N篇日志的浏览量也保存在内存中：counters表中的值每隔counters.flush_interval秒重新读取一次，再加上本进程尚未写入的增量
+
+_items = []  # [Blog]，按(created_at, id)升序排列，最新的在最后
+_keys = []  # 与_items对应的排序键(created_at, id)，用于二分查找插入位置
+_count = None  # 日志总数，None表示尚未加载
+_loader = None
+_views = dict()  # 日志id --> counters表中的浏览量（不含本进程尚未写入的增量）
+_refresher = None
+
+HITS = metrics.counter('recent_blogs_hits', 'Blog list pages served from the in-memory index.')
+MISSES = metrics.counter('recent_blogs_misses', 'Blog list pages that fell back to the database.')
+metrics.gauge('recent_blogs_size', 'Blogs held in the in-memory index.', fn=lambda: len(_items))
+
+def _key(blog):
+    return (blog.created_at, blog.id)
+
+def _list_view(blog):
+    b = Blog(id=blog.id)
+    for f in BLOG_LIST_FIELDS:
+        b[f] = blog.get(f, 0 if f == 'comment_count' else None)
+    return b
+
+def _find(id):
+    id = str(id)
+    for i in range(len(_items) - 1, -1, -1):  # 新日志和新评论多集中在最近的日志上
+        if str(_items[i].id) == id:
+            return i
+    return -1
+
+# complete：数据库中的日志是否全部在内存中，否则比内存中最旧的一篇还旧的日志不能加入（中间可能缺了其他日志）
+def _insert(blog, complete):
+    b = _list_view(blog)
+    k = _key(b)
+    i = bisect.bisect_left(_keys, k)
+    if i == 0 and not complete:
+        return
+    _keys.insert(i, k)
+    _items.insert(i, b)
+    if len(_items) > configs.recent.size:
+        del _keys[0]
+        del _items[0]
+
+def _remove(id):
+    i = _find(id)
+    if i >= 0:
+        del _keys[i]
+        del _items[i]
+    return i >= 0
+
+# 总数: None表示索引不可用
+def count():
+    return _count
+
+# 内存中日志的浏览量
+def views(id):
+    return _views.get(str(id), 0) + counters.pending(counters.BLOG_VIEWS, id)
+
+# 返回第offset条起的limit篇日志（副本，调用方可以修改），内存中的日志不足以覆盖这一页时返回None
+def page(offset, limit):
+    if _count is None or (offset + limit > len(_items) and len(_items) < _count):
+        MISSES.inc()
+        return None
+    HITS.inc()
+    end = len(_items) - offset
+    return [Blog(**b) for b in reversed(_items[max(0, end - limit):max(0, end)])]
+
+async def _load():
+    global _items, _keys, _count
+    start = time.time()
+    try:
+        num = await Blog.findNumber('count(id)')
+        blogs = await Blog.findAll(orderBy='`created_at` desc, `id` desc', limit=configs.recent.size, fields=BLOG_LIST_FIELDS)
+    except Exception as e:
+        logging.warning('failed to load recent blogs: %s' % e)
+        return
+    _items = [_list_view(b) for b in reversed(blogs)]
+    _keys = [_key(b) for b in _items]
+    _count = num or 0
+    await _load_views()
+    logging.info('recent blogs loaded: %s of %s in %.2fs' % (len(_items), _count, time.time() - start))
+
+async def _load_views():
+    global _views
+    try:
+        _views = await counters.get_stored(counters.BLOG_VIEWS, [b.id for b in _items])
+    except Exception as e:
+        logging.warning('failed to load views of recent blogs: %s' % e)
+
+# 其他worker的浏览量写入counters表后，最多延迟一个周期可见
+async def _refresh_views(interval):
+    while True:
+        await asyncio.sleep(interval)
+        if _count is not None:
+            await _load_views()
+
+# 在后台重新加载（删除日志后内存中的日志少于N篇、对账评论数之后等）
+def reload():
+    global _loader
+    if _loader is None or _loader.done():
+        _loader = asyncio.ensure_future(_load())
+
+def _apply_blog(event, blog):
+    global _count
+    if _count is None:
+        return
+    if event == 'remove':
+        _remove(blog.id)
+        _count -= 1
+        if len(_items) < min(_count, configs.recent.size):
+            reload()
+    else:
+        existed = _remove(blog.id)
+        complete = len(_items) + (1 if existed else 0) >= _count
+        if event == 'save' and not existed:
+            _count += 1
+        _insert(blog, complete)
+
+def _apply_comment(blog_id, delta):
+    i = _find(blog_id)
+    if i >= 0:
+        b = _items[i]
+        b.comment_count = (b.comment_count or 0) + delta
+
+# 本进程写入时直接更新，再通知其他worker
+def _on_blog(event, blog):
+    _apply_blog(event, blog)
+    ipc.publish_peers('recent', kind='blog', id=str(blog.id), event=event)
+
+def _on_comment(event, comment):
+    if event in ('save', 'remove'):
+        delta = 1 if event == 'save' else -1
+        _apply_comment(comment.blog_id, delta)
+        ipc.publish_peers('recent', kind='comment', id=str(comment.blog_id), event=event)
+
+# 其他worker写入后：删除直接生效，新增和修改从数据库读取列表字段
+def _on_peer_change(kind, id, event):
+    if kind == 'comment':
+        _apply_comment(id, 1 if event == 'save' else -1)
+    elif kind == 'reload':
+        reload()
+    elif event == 'remove':
+        _apply_blog(event, Blog(id=id))
+    else:
+        asyncio.ensure_future(_fetch(id, event))
+
+async def _fetch(id, event):
+    try:
+        blogs = await Blog.findAll('`id`=?', [id], fields=BLOG_LIST_FIELDS)
+    except Exception as e:
+        logging.warning('failed to fetch blog %s for recent index, reload: %s' % (id, e))
+        reload()
+        return
+    if blogs:
+        _apply_blog(event, blogs[0])
+
+# 在所有worker中重新加载（直接修改了数据库，例如对账评论数之后）
+def reload_all():
+    reload()
+    ipc.publish_peers('recent', kind='reload', id='', event='reload')
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调
+async def start(app):
+    global _refresher
+    orm.listen(Blog, _on_blog)
+    orm.listen(Comment, _on_comment)
+    ipc.subscribe('recent', _on_peer_change)
+    await _load()
+    _refresher = asyncio.ensure_future(_refresh_views(configs.counters.flush_interval))
+
+async def stop(app):
+    global _items, _keys, _count, _loader, _views, _refresher
+    orm.unlisten(Blog, _on_blog)
+    orm.unlisten(Comment, _on_comment)
+    ipc.unsubscribe('recent', _on_peer_change)
+    for task in (_loader, _refresher):
+        if task is not None and not task.done():
+            task.cancel()
+    _items, _keys, _count, _loader, _views, _refresher = [], [], None, None, dict(), None
@@ -0,0 +1,319 @@
+import logging, asyncio, hashlib, heapq, math, os, pickle, re, time
+
+import orm, ipc, metrics
+from config import configs
+from models import Blog, Comment
+
+# 站内全文搜索：进程内的倒排索引，覆盖日志（标题、摘要、正文）和评论
+# 分词：英文和数字按单词切分并转为小写；中日韩文字不依赖分词词典，建索引时单字和相邻两个字（bigram）都作为词，
+#       查询时单字直接查，多字按bigram查
+# 排序：BM25
+# 更新：Blog和Comment的save/update/remove通过orm.listen增量更新本进程的索引，并经ipc通知其他worker从数据库重新读取
+# 持久化：退出时（以及全量构建完成后）把索引写入快照文件，启动时加载快照，再和数据库对账补齐差异：
+#       日志按标题、摘要、正文的摘要（digest）对账，快照写入后被修改过的日志重新索引；评论写入后不会修改，只按id对账
+
+BLOG, COMMENT = 'blog', 'comment'
+SNAPSHOT_VERSION = 2
+TITLE_BOOST = 3  # 标题中的词重复计入的次数
+SNIPPET_CHARS = 120
+
+# 英文单词和数字，或连续的中日韩文字
+_RE_TOKEN = re.compile(r'[a-z0-9]+|[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+')
+
+QUERIES = metrics.histogram('search_query_seconds', 'Time spent ranking a search query.')
+metrics.gauge('search_documents', 'Documents in the search index.', fn=lambda: len(_index.docs) if _index else 0)
+metrics.gauge('search_terms', 'Distinct terms in the search index.', fn=lambda: len(_index.postings) if _index else 0)
+
+# query为True时按查询分词：多字的中日韩文字只切成bigram，不再拆成单字
+def tokenize(text, query=False):
+    tokens = []
+    for m in _RE_TOKEN.finditer(text.lower()):
+        w = m.group()
+        if w[0] >= '぀':  # 中日韩文字
+            if len(w) == 1:
+                tokens.append(w)
+            else:
+                if not query:
+                    tokens.extend(w)
+                tokens.extend(w[i:i+2] for i in range(len(w) - 1))
+        elif len(w) <= 40:
+            tokens.append(w)
+    return tokens
+
+def _digest(*fields):
+    return hashlib.md5('\0'.join(fields).encode('utf-8')).digest()
+
+def _snippet(text):
+    text = ' '.join(text.split())
+    return text if len(text) <= SNIPPET_CHARS else text[:SNIPPET_CHARS] + '...'
+
+# 倒排索引：term --> {docno: 词频}
+class InvertedIndex(object):
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = dict()  # term --> {docno: tf}
+        self.docs = dict()  # docno --> (kind, id, 文档长度, 词列表, 展示信息dict)
+        self.keys = dict()  # (kind, id) --> docno
+        self.digests = dict()  # (kind, id) --> 文档内容的摘要，用于启动时对账
+        self.total_length = 0
+        self._next_docno = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, kind, id, tokens, info, digest=None):
+        key = (kind, str(id))
+        self.remove(kind, id)
+        docno = self._next_docno
+        self._next_docno += 1
+        tf = dict()
+        for t in tokens:
+            tf[t] = tf.get(t, 0) + 1
+        for t, n in tf.items():
+            self.postings.setdefault(t, {})[docno] = n
+        self.docs[docno] = (kind, key[1], len(tokens), tuple(tf.keys()), info)
+        self.keys[key] = docno
+        if digest is not None:
+            self.digests[key] = digest
+        self.total_length += len(tokens)
+
+    def remove(self, kind, id):
+        docno = self.keys.pop((kind, str(id)), None)
+        self.digests.pop((kind, str(id)), None)
+        if docno is None:
+            return False
+        _, _, length, terms, _ = self.docs.pop(docno)
+        for t in terms:
+            p = self.postings.get(t)
+            if p is not None:
+                p.pop(docno, None)
+                if not p:
+                    del self.postings[t]
+        self.total_length -= length
+        return True
+
+    def ids(self, kind):
+        return set(id for k, id in self.keys if k == kind)
+
+    def digest(self, kind, id):
+        return self.digests.get((kind, str(id)))
+
+    # 按BM25打分，返回(总命中数, [(score, docno), ...])，结果按得分从高到低排列
+    def search(self, query, limit=10, offset=0, kind=None):
+        terms = set(tokenize(query, query=True))
+        n = len(self.docs)
+        if not terms or n == 0:
+            return 0, []
+        avgdl = self.total_length / n if n else 1
+        scores = dict()
+        for t in terms:
+            p = self.postings.get(t)
+            if not p:
+                continue
+            idf = math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            for docno, tf in p.items():
+                dl = self.docs[docno][2]
+                s = idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * dl / avgdl))
+                scores[docno] = scores.get(docno, 0.0) + s
+        if kind is not None:
+            scores = dict((d, s) for d, s in scores.items() if self.docs[d][0] == kind)
+        top = heapq.nlargest(offset + limit, ((s, d) for d, s in scores.items()))
+        return len(scores), top[offset:]
+
+    def result(self, docno, score):
+        kind, id, _, _, info = self.docs[docno]
+        r = dict(kind=kind, id=id, score=round(score, 4))
+        r.update(info)
+        return r
+
+    def dump(self, path):
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(dict(version=SNAPSHOT_VERSION, postings=self.postings, docs=self.docs, keys=self.keys, digests=self.digests, total_length=self.total_length, next_docno=self._next_docno), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)  # 原子替换，多个worker同时写也不会损坏文件
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('unsupported search snapshot version: %s' % data.get('version'))
+        index = cls()
+        index.postings = data['postings']
+        index.docs = data['docs']
+        index.keys = data['keys']
+        index.digests = data['digests']
+        index.total_length = data['total_length']
+        index._next_docno = data['next_docno']
+        return index
+
+_index = None
+_ready = False
+_builder = None
+_deferred = None  # 正在写快照时为待应用的修改列表：[(fn, args)]
+
+# 对账时与数据库比较的日志字段
+BLOG_DIGEST_FIELDS = ('name', 'summary', 'content')
+
+def _blog_doc(blog):
+    tokens = tokenize(blog.name) * TITLE_BOOST + tokenize(blog.summary) + tokenize(blog.content)
+    return tokens, dict(name=blog.name, summary=_snippet(blog.summary), created_at=blog.created_at), _digest(*(getattr(blog, f) for f in BLOG_DIGEST_FIELDS))
+
+def _comment_doc(comment):
+    return tokenize(comment.content), dict(blog_id=str(comment.blog_id), user_name=comment.user_name, summary=_snippet(comment.content), created_at=comment.created_at)
+
+# 写快照期间索引由线程池中的线程读取，这期间的修改先排队，写完后再应用
+def _apply(fn, *args):
+    if _deferred is not None:
+        _deferred.append((fn, args))
+    else:
+        fn(*args)
+
+def index_blog(blog):
+    _apply(_index.add, BLOG, blog.id, *_blog_doc(blog))
+
+def index_comment(comment):
+    _apply(_index.add, COMMENT, comment.id, *_comment_doc(comment))
+
+def _remove(kind, id):
+    _apply(_index.remove, kind, id)
+
+# 本进程写入时直接更新索引，再通知其他worker
+def _on_blog(event, blog):
+    if event == 'remove':
+        _remove(BLOG, blog.id)
+    else:
+        index_blog(blog)
+    ipc.publish_peers('search', kind=BLOG, id=str(blog.id), event=event)
+
+def _on_comment(event, comment):
+    if event == 'remove':
+        _remove(COMMENT, comment.id)
+    else:
+        index_comment(comment)
+    ipc.publish_peers('search', kind=COMMENT, id=str(comment.id), event=event)
+
+# 其他worker写入后，从数据库重新读取该文档
+def _on_peer_change(kind, id, event):
+    if event == 'remove':
+        _remove(kind, id)
+    else:
+        asyncio.ensure_future(_reload(kind, id))
+
+async def _reload(kind, id):
+    try:
+        if kind == BLOG:
+            blog = await Blog.find(id)
+            if blog is not None:
+                index_blog(blog)
+        else:
+            comment = await Comment.find(id)
+            if comment is not None:
+                index_comment(comment)
+    except Exception as e:
+        logging.warning('failed to reload %s %s into search index: %s' % (kind, id, e))
+
+# 把数据库中有而索引中没有的文档加入索引，删除索引中有而数据库中已不存在的文档
+# fields：逐批读取这些字段计算摘要，与索引中的摘要不同（快照写入后被修改过）的文档重新索引
+async def _sync(model, kind, index_fn, fields=()):
+    batch = configs.search.batch_size
+    indexed = _index.ids(kind)
+    db_ids, missing = set(), []
+    columns = ', '.join('`%s`' % f for f in ('id',) + tuple(fields))
+    last = None
+    while True:
+        if last is None:
+            rs = await orm.select('select %s from `%s` order by `id` limit ?' % (columns, model.__table__), [batch])
+        else:
+            rs = await orm.select('select %s from `%s` where `id`>? order by `id` limit ?' % (columns, model.__table__), [last, batch])
+        for r in rs:
+            id = str(r['id'])
+            db_ids.add(id)
+            if id not in indexed or (fields and _index.digest(kind, id) != _digest(*(r[f] for f in fields))):
+                missing.append(id)
+        if len(rs) < batch:
+            break
+        last = rs[-1]['id']
+        await asyncio.sleep(0)
+    for id in indexed - db_ids:
+        _remove(kind, id)
+    for i in range(0, len(missing), batch):
+        chunk = missing[i:i+batch]
+        for obj in (await model.findAll('`id` in (%s)' % ', '.join(['?'] * len(chunk)), chunk)):
+            index_fn(obj)
+        await asyncio.sleep(0)  # 让出事件循环，避免启动时长时间阻塞请求
+    return len(missing), len(indexed - db_ids)
+
+async def _build():
+    global _ready
+    start = time.time()
+    try:
+        added_blogs, removed_blogs = await _sync(Blog, BLOG, index_blog, BLOG_DIGEST_FIELDS)
+        added_comments, removed_comments = await _sync(Comment, COMMENT, index_comment)
+        _ready = True
+        logging.info('search index ready: %s docs (+%s/-%s blogs, +%s/-%s comments) in %.2fs' % (len(_index), added_blogs, removed_blogs, added_comments, removed_comments, time.time() - start))
+        if added_blogs + removed_blogs + added_comments + removed_comments > 0:
+            await save_snapshot()
+    except Exception as e:
+        logging.exception(e)
+
+# 在线程池中序列化整个索引（可能需要几秒），期间的修改排队，写完后应用
+async def save_snapshot():
+    global _deferred
+    path = configs.search.snapshot
+    if not path or _index is None or _deferred is not None:
+        return
+    start = time.time()
+    _deferred = []
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, _write_snapshot, _index, path)
+    finally:
+        deferred, _deferred = _deferred, None
+        for fn, args in deferred:
+            fn(*args)
+    logging.info('search snapshot saved to %s in %.2fs (%s changes deferred)' % (path, time.time() - start, len(deferred)))
+
+def _write_snapshot(index, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    index.dump(path)
+
+# 搜索：返回(总命中数, 结果列表)
+def search(q, limit=10, offset=0, kind=None):
+    start = time.perf_counter()
+    total, top = _index.search(q, limit, offset, kind)
+    QUERIES.observe(time.perf_counter() - start)
+    return total, [_index.result(docno, score) for score, docno in top]
+
+def is_ready():
+    return _ready
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调
+async def start(app):
+    global _index, _builder
+    path = configs.search.snapshot
+    _index = None
+    if path and os.path.exists(path):
+        try:
+            _index = InvertedIndex.load(path)
+            logging.info('search snapshot loaded: %s docs' % len(_index))
+        except Exception as e:
+            logging.warning('failed to load search snapshot %s: %s' % (path, e))
+    if _index is None:
+        _index = InvertedIndex()
+    orm.listen(Blog, _on_blog)
+    orm.listen(Comment, _on_comment)
+    ipc.subscribe('search', _on_peer_change)
+    _builder = asyncio.ensure_future(_build())  # 在后台与数据库对账，不阻塞启动
+
+async def stop(app):
+    global _builder, _ready
+    orm.unlisten(Blog, _on_blog)
+    orm.unlisten(Comment, _on_comment)
+    ipc.unsubscribe('search', _on_peer_change)
+    if _builder is not None and not _builder.done():
+        _builder.cancel()
+    elif _ready:
+        await save_snapshot()
+    _builder, _ready = None, False
@@ -0,0 +1,199 @@
+import logging, asyncio, contextvars, time
+
+from aiohttp import web
+
+import orm, ipc, metrics
+from cache import LRUCache
+from config import configs
+from models import Blog, Comment
+
+# 公开页面的stale-while-revalidate：匿名用户访问首页和日志详情页时直接返回缓存的渲染结果
+#     未超过ttl秒：直接返回
+#     超过ttl秒：仍然立即返回旧页面，同时在后台刷新（同一页面同一时间只有一个刷新）
+#     没有缓存：当场渲染，超过budget秒或数据库出错时返回503，渲染在后台继续完成并放入缓存
+#     数据库熔断期间不刷新，一直返回旧页面（最多max_stale秒）
+# 返回缓存的页面都带Age头，已过期的还带Warning: 110 - "Response is Stale"
+# 登录用户（带cookie）看到的页面包含自己的用户名，不使用缓存
+# 日志或评论变化时把相关页面标记为过期，下一次访问触发刷新，日志删除时直接丢弃它的页面
+# 缓存的key为路径加上路由声明的查询参数（其他参数忽略），任意的查询字符串不会挤掉缓存中的页面
+
+HITS = metrics.counter('swr_hits', 'Public pages served from the render cache within ttl.')
+STALE = metrics.counter('swr_stale', 'Public pages served stale from the render cache.')
+MISSES = metrics.counter('swr_misses', 'Public pages rendered because nothing was cached.')
+REFRESHES = metrics.counter('swr_refreshes', 'Background refreshes of cached pages.')
+REFRESH_ERRORS = metrics.counter('swr_refresh_errors', 'Background refreshes that failed.')
+BUDGET_EXCEEDED = metrics.counter('swr_budget_exceeded', 'Uncached renders that exceeded the latency budget.')
+
+_routes = dict()  # 使用缓存的路由 --> (on_hit(request)或None, 参数名 --> 规范化函数)
+_pages = None  # key --> (body, content_type, rendered_at, expired)
+_refreshing = dict()  # key --> 正在渲染的task
+_refresh = contextvars.ContextVar('swr_refresh', default=False)
+_cookie_name = None  # 登录cookie的名字，带这个cookie的请求不使用缓存
+
+# 装饰器：放在@get之上，该路由的页面对匿名用户使用缓存
+# on_hit(request)：经过缓存返回页面（200的html）时调用，例如累加浏览量（缓存的页面由后台渲染，url处理函数应当用is_refresh跳过这些操作）
+# params：参与缓存key的查询参数 --> 规范化函数（如int），规范化失败的请求不使用缓存
+def cached(on_hit=None, params=None):
+    def decorator(fn):
+        _routes[fn.__route__] = (on_hit, dict(params or {}))
+        return fn
+    return decorator
+
+# 当前是否在后台刷新缓存：url处理函数据此跳过只应该在用户真实访问时执行的操作（例如累加浏览量）
+def is_refresh():
+    return _refresh.get()
+
+def _route(request):
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else None
+
+# 缓存的key：路径 + 按名称排序的声明过的参数，无法规范化时返回None
+def _key(request, params):
+    args = []
+    for name in sorted(params):
+        value = request.query.get(name)
+        if value is not None:
+            try:
+                args.append('%s=%s' % (name, params[name](value)))
+            except ValueError:
+                return None
+    return request.path + ('?' + '&'.join(args) if args else '')
+
+def _fresh(entry, now):
+    return not entry[3] and now - entry[2] < configs.swr.ttl
+
+def _response(entry, now):
+    body, content_type, rendered_at, expired = entry
+    resp = web.Response(body=body, headers={'Content-Type': content_type, 'Age': str(int(now - rendered_at))})
+    if not _fresh(entry, now):
+        resp.headers['Warning'] = '110 - "Response is Stale"'
+    return resp
+
+# 复制一个不放入缓存的响应，同时等待同一次渲染的多个请求各自返回一个对象
+def _copy(resp):
+    headers = dict((k, v) for k, v in resp.headers.items() if k.lower() != 'content-length')
+    return web.Response(status=resp.status, reason=resp.reason, body=resp.body, headers=headers)
+
+def _cacheable(resp):
+    return type(resp) is web.Response and resp.status == 200 and resp.content_type == 'text/html'
+
+async def _render(key, handler, request):
+    _refresh.set(True)
+    try:
+        resp = await handler(request)
+        if _cacheable(resp) and _pages is not None:
+            _pages.set(key, (resp.body, resp.headers['Content-Type'], time.time(), False))
+        return resp
+    except Exception as e:
+        REFRESH_ERRORS.inc()
+        logging.warning('render %s for cache failed: %s' % (key, e))
+        raise
+    finally:
+        _refreshing.pop(key, None)
+
+# 同一页面同一时间只渲染一次
+# 渲染使用请求的副本：后台刷新在原请求返回之后才结束，那时原请求的连接可能已经关闭
+def _start(key, handler, request):
+    task = _refreshing.get(key)
+    if task is None:
+        task = _refreshing[key] = asyncio.ensure_future(_render(key, handler, request.clone(remote=request.remote)))
+        task.add_done_callback(_consume)
+    return task
+
+def _consume(task):
+    if not task.cancelled():
+        task.exception()  # 后台刷新的异常已经记录，不再由asyncio报告
+
+# 使用@web.middleware：旧式的middleware工厂每个请求都会被调用一次
+@web.middleware
+async def swr_middleware(request, handler):
+    if _pages is None or request.method != 'GET' or request.cookies.get(_cookie_name):
+        return (await handler(request))
+    route = _route(request)
+    if route not in _routes:
+        return (await handler(request))
+    on_hit, params = _routes[route]
+    key = _key(request, params)
+    if key is None:
+        return (await handler(request))
+    now = time.time()
+    entry = _pages.get(key)
+    if entry is not None and now - entry[2] < configs.swr.max_stale:
+        if _fresh(entry, now):
+            HITS.inc()
+        else:
+            STALE.inc()
+            if orm.healthy():
+                REFRESHES.inc()
+                _start(key, handler, request)
+        if on_hit is not None:
+            on_hit(request)
+        return _response(entry, now)
+    MISSES.inc()
+    task = _start(key, handler, request)
+    try:
+        resp = await asyncio.wait_for(asyncio.shield(task), configs.swr.budget)
+    except asyncio.TimeoutError:
+        BUDGET_EXCEEDED.inc()
+        return web.HTTPServiceUnavailable(headers={'Retry-After': '1'}, text='Server busy, please retry later.')
+    if on_hit is not None and _cacheable(resp):  # 渲染出页面才调用，例如不给不存在的日志累加浏览量
+        on_hit(request)
+    entry = _pages.get(key)
+    if entry is not None and _cacheable(resp):
+        return _response(entry, time.time())
+    return _copy(resp)
+
+########################################################################################################################
+# 失效：日志或评论变化后把相关页面标记为已过期（保留旧页面，数据库不可用时仍然可以返回）
+
+def expire(pred):
+    if _pages is None:
+        return
+    for key in _pages.keys():
+        entry = _pages.get(key) if pred(key) else None
+        if entry is not None:
+            _pages.set(key, entry[:3] + (True,))
+
+def _is_index(key):
+    return key == '/' or key.startswith('/?')
+
+def _on_blog(event, blog):
+    _expire_blog(str(blog.id), event == 'remove')
+    ipc.publish_peers('swr', blog_id=str(blog.id), removed=(event == 'remove'))
+
+def _on_comment(event, comment):
+    _expire_blog(str(comment.blog_id))
+    ipc.publish_peers('swr', blog_id=str(comment.blog_id))
+
+def _expire_blog(blog_id, removed=False):
+    path = '/blog/%s' % blog_id
+    if removed and _pages is not None:
+        _pages.pop_matching(lambda key: key == path or key.startswith(path + '?'))
+    expire(lambda key: _is_index(key) or key == path or key.startswith(path + '?'))
+
+def _on_peer_change(blog_id, removed=False):
+    _expire_blog(blog_id, removed)
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调，configs.swr.ttl为0时不使用缓存
+async def start(app):
+    global _pages, _cookie_name
+    if not configs.swr.ttl:
+        return
+    from handlers import COOKIE_NAME  # handlers导入了本模块，在这里导入避免循环导入
+    _cookie_name = COOKIE_NAME
+    _pages = LRUCache(configs.swr.maxsize)
+    orm.listen(Blog, _on_blog)
+    orm.listen(Comment, _on_comment)
+    ipc.subscribe('swr', _on_peer_change)
+
+async def stop(app):
+    global _pages
+    if _pages is None:
+        return
+    orm.unlisten(Blog, _on_blog)
+    orm.unlisten(Comment, _on_comment)
+    ipc.unsubscribe('swr', _on_peer_change)
+    for task in list(_refreshing.values()):
+        task.cancel()
+    _refreshing.clear()
+    _pages = None
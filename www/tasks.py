@@ -0,0 +1,182 @@
+import logging, asyncio, json, time, os
+
+import orm, metrics
+from config import configs
+from models import Job, next_id
+
+# 进程内的异步任务队列：url处理函数把写入后的后续工作（markdown预渲染、缓存失效、批量更新等）交给后台执行，写入完成即可返回
+# 任务先写入jobs表（durable=True时）再放入内存队列，由固定数量的worker协程执行；失败按指数退避重试
+# 队列满、进程重启或其他worker进程崩溃留下的任务由定时轮询从jobs表中取回，每个任务通过条件update认领，只会被一个进程执行
+# 用法：
+#     @task('relabel_user_comments')
+#     async def relabel_user_comments(*, user_id): ...
+#
+#     await defer('relabel_user_comments', user_id=id)
+
+PENDING, RUNNING, FAILED = 'pending', 'running', 'failed'
+
+_registry = dict()  # name --> (fn, retries)
+_queue = None
+_workers = []
+_poller = None
+_queued = set()  # 已在本进程内存队列中的durable任务id，避免重复放入
+
+DEPTH = metrics.gauge('tasks_queue_depth', 'Jobs waiting in the in-memory queue.', fn=lambda: _queue.qsize() if _queue else 0)
+LATENCY = metrics.histogram('tasks_job_latency_seconds', 'Time from defer() to job completion.')
+RUN_TIME = metrics.histogram('tasks_run_seconds', 'Time spent running a job.')
+DONE = metrics.counter('tasks_done', 'Jobs finished successfully.')
+RETRIED = metrics.counter('tasks_retried', 'Job attempts that failed and were scheduled again.')
+FAILED_JOBS = metrics.counter('tasks_failed', 'Jobs that failed after all retries.')
+DROPPED = metrics.counter('tasks_dropped', 'Non-durable jobs dropped because the queue was full.')
+
+# 装饰器：注册一个任务，retries为最多执行次数，缺省使用configs.tasks.retries
+def task(name, retries=None):
+    def decorator(fn):
+        _registry[name] = (fn, retries)
+        fn.__task__ = name
+        return fn
+    return decorator
+
+# 延后执行任务name(**kw)
+# durable：是否写入jobs表，进程退出后仍会被执行；只影响本进程缓存的任务可设为False
+# delay：延迟多少秒后执行
+async def defer(name, durable=True, delay=0, **kw):
+    if name not in _registry:
+        raise ValueError('unknown task: %s' % name)
+    job = Job(id=next_id(), name=name, args=json.dumps(kw, ensure_ascii=False), status=PENDING, attempts=0, run_at=time.time() + delay, error='', created_at=time.time())
+    if durable:
+        await job.save()
+    job.durable = durable
+    if delay:
+        asyncio.get_running_loop().call_later(delay, _enqueue, job)
+    else:
+        _enqueue(job)
+    return job
+
+def _enqueue(job):
+    if _queue is None:  # 队列未启动（例如在脚本中使用），durable任务留在jobs表中等待执行
+        if not job.durable:
+            DROPPED.inc()
+        return
+    if job.durable and job.id in _queued:
+        return
+    try:
+        _queue.put_nowait(job)
+    except asyncio.QueueFull:
+        if job.durable:
+            logging.info('task queue full, job %s left for the poller.' % job.id)
+        else:
+            DROPPED.inc()
+            logging.warning('task queue full, dropped job: %s' % job.name)
+        return
+    if job.durable:
+        _queued.add(job.id)
+
+# 认领durable任务：只有把状态从pending改为running成功的进程才能执行
+async def _claim(job):
+    rows = await orm.execute('update `jobs` set `status`=?, `updated_at`=? where `id`=? and `status`=?', [RUNNING, time.time(), job.id, PENDING])
+    return rows == 1
+
+async def _run(job):
+    fn, retries = _registry.get(job.name, (None, None))
+    if retries is None:
+        retries = configs.tasks.retries
+    if job.durable and job.attempts >= retries:  # 执行时进程崩溃的次数已经用完重试次数
+        FAILED_JOBS.inc()
+        logging.error('job %s (%s) failed after %s attempts: %s' % (job.name, job.id, job.attempts, job.error))
+        job.status = FAILED
+        job.updated_at = time.time()
+        await job.update()
+        return
+    start = time.time()
+    try:
+        if fn is None:
+            raise ValueError('unknown task: %s' % job.name)
+        await fn(**json.loads(job.args))
+    except Exception as e:
+        job.attempts += 1
+        job.error = '%s: %s' % (e.__class__.__name__, e)
+        if fn is not None and job.attempts < retries:
+            RETRIED.inc()
+            delay = configs.tasks.retry_delay * (2 ** (job.attempts - 1))
+            logging.warning('job %s (%s) failed, retry in %ss: %s' % (job.name, job.id, delay, job.error))
+            job.status = PENDING
+            job.run_at = time.time() + delay
+            asyncio.get_running_loop().call_later(delay, _enqueue, job)
+        else:
+            FAILED_JOBS.inc()
+            logging.error('job %s (%s) failed after %s attempts: %s' % (job.name, job.id, job.attempts, job.error))
+            job.status = FAILED
+        if job.durable:
+            job.updated_at = time.time()
+            await job.update()
+    else:
+        DONE.inc()
+        LATENCY.observe(time.time() - job.created_at)
+        if job.durable:
+            await job.remove()  # 成功的任务直接删除，失败的任务保留在表中便于排查
+    finally:
+        RUN_TIME.observe(time.time() - start)
+
+async def _worker():
+    while True:
+        job = await _queue.get()
+        try:
+            if job.durable:
+                _queued.discard(job.id)
+                if not (await _claim(job)):
+                    continue
+            await _run(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            _queue.task_done()
+
+# 定时从jobs表取回到期的任务，并把长时间处于running状态（执行它的进程已崩溃）的任务重置为pending
+async def _poll():
+    c = configs.tasks
+    while True:
+        await asyncio.sleep(c.poll_interval)
+        try:
+            now = time.time()
+            # 重置也算一次失败，否则每次都让进程崩溃的任务会无限重试
+            await orm.execute('update `jobs` set `status`=?, `attempts`=`attempts`+1, `error`=?, `updated_at`=? where `status`=? and `updated_at`<?', [PENDING, 'stale: not finished within %ss' % c.stale_timeout, now, RUNNING, now - c.stale_timeout])
+            free = c.queue_size - _queue.qsize()
+            if free <= 0:
+                continue
+            for job in (await Job.findAll('`status`=? and `run_at`<=?', [PENDING, now], orderBy='`run_at`', limit=free)):
+                job.durable = True
+                _enqueue(job)
+        except orm.PoolBusyError as e:
+            logging.warning('task poller skipped: %s' % e)
+        except Exception as e:
+            logging.exception(e)
+
+# 随app启动/清理：app.on_startup和app.on_cleanup的回调
+async def start(app):
+    global _queue, _poller
+    c = configs.tasks
+    _queue = asyncio.Queue(c.queue_size)
+    for i in range(c.workers):
+        _workers.append(asyncio.ensure_future(_worker()))
+    _poller = asyncio.ensure_future(_poll())
+    logging.info('task queue started with %s workers (pid %s).' % (c.workers, os.getpid()))
+
+# 等待队列中的任务执行完（最多shutdown_timeout秒），未执行完的durable任务留在jobs表中由下次启动的进程执行
+async def stop(app):
+    global _queue, _poller
+    if _queue is None:
+        return
+    _poller.cancel()
+    try:
+        await asyncio.wait_for(_queue.join(), configs.tasks.shutdown_timeout)
+    except asyncio.TimeoutError:
+        logging.warning('task queue shutdown timeout, %s jobs left.' % _queue.qsize())
+    for w in _workers:
+        w.cancel()
+    await asyncio.gather(_poller, *_workers, return_exceptions=True)
+    _workers.clear()
+    _queued.clear()
+    _queue, _poller = None, None
@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+import admission
+from admission import AdmissionController, RateLimiter, HIGH, NORMAL, LOW
+
+SHARES = {HIGH: 1.0, NORMAL: 0.5, LOW: 0.5}
+
+@pytest.mark.parametrize('method, path, priority', [
+    ('GET', '/', HIGH),
+    ('GET', '/blog/1', HIGH),
+    ('GET', '/api/blogs', NORMAL),
+    ('POST', '/api/blogs', NORMAL),
+    ('GET', '/api/comments', LOW),
+    ('POST', '/api/comments', NORMAL),
+    ('GET', '/manage/blogs', LOW),
+    ('GET', '/sitemap-2.xml', LOW),
+    ('GET', '/static/js/awesome.js', None),
+    ('GET', '/api/metrics', None),
+])
+def test_classify(method, path, priority):
+    assert admission.classify(make_mocked_request(method, path)) == priority
+
+########################################################################################################################
+# 令牌桶
+
+def test_rate_limiter():
+    r = RateLimiter(rate=2, burst=4)
+    assert r.take('a', 3, now=0) == 0
+    assert r.take('a', 3, now=0) == 1.0  # 差2个令牌，每秒补充2个
+    assert r.take('b', 1, now=0) == 0  # 每个key一个桶
+    assert r.take('a', 3, now=1) == 0
+    assert r.take('a', 100, now=10) == 0  # cost不超过容量，否则永远无法通过
+
+def test_rate_limiter_evicts_least_recently_used():
+    r = RateLimiter(rate=1, burst=1, max_entries=2)
+    r.take('a', now=0)
+    r.take('b', now=0)
+    r.take('a', now=0)
+    r.take('c', now=0)  # 淘汰b
+    assert len(r) == 2
+    assert r.take('b', now=0) == 0  # 被淘汰的桶重新装满
+    assert r.take('a', now=0) == 0  # a也被c之后的b淘汰了
+    assert r.take('a', now=0) > 0
+
+########################################################################################################################
+# 准入控制
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_share_limits():
+    c = AdmissionController(4, SHARES)
+    assert c.limits == {HIGH: 4, NORMAL: 2, LOW: 2}
+
+def test_queued_request_admitted_on_release():
+    async def main():
+        c = AdmissionController(1, SHARES, queue_timeout=1)
+        assert (await c.acquire(NORMAL))
+        task = asyncio.ensure_future(c.acquire(NORMAL))
+        await asyncio.sleep(0)
+        assert c.waiting() == 1 and not task.done()
+        c.release()
+        assert (await task)
+        assert c.inflight == 1 and c.waiting() == 0
+    run(main())
+
+def test_higher_priority_admitted_first():
+    async def main():
+        c = AdmissionController(2, SHARES, queue_timeout=1)
+        assert (await c.acquire(HIGH)) and (await c.acquire(HIGH))
+        low = asyncio.ensure_future(c.acquire(LOW))
+        high = asyncio.ensure_future(c.acquire(HIGH))
+        await asyncio.sleep(0)
+        c.release()
+        assert (await high)
+        assert not low.done()
+        c.release()
+        await asyncio.sleep(0.01)
+        assert not low.done()  # inflight还是1，已经用满low的份额
+        c.release()
+        assert (await low)
+    run(main())
+
+def test_new_request_does_not_jump_the_queue():
+    async def main():
+        c = AdmissionController(2, SHARES, queue_timeout=0.05)
+        assert (await c.acquire(HIGH)) and (await c.acquire(HIGH))
+        queued = asyncio.ensure_future(c.acquire(NORMAL))
+        await asyncio.sleep(0)
+        c.release()  # inflight 1，但normal的份额是1，仍在排队
+        assert not (await c.acquire(LOW))  # 有更高优先级的请求在排队，low不能直接进入
+        assert not (await queued)
+    run(main())
+
+def test_shed_when_queue_full():
+    async def main():
+        c = AdmissionController(1, SHARES, max_queue=1, queue_timeout=1)
+        assert (await c.acquire(HIGH))
+        queued = asyncio.ensure_future(c.acquire(HIGH))
+        await asyncio.sleep(0)
+        assert not (await c.acquire(HIGH))  # 队列已满，立即拒绝
+        c.release()
+        assert (await queued)
+    run(main())
+
+def test_queue_timeout_removes_waiter():
+    async def main():
+        c = AdmissionController(1, SHARES, max_queue=1, queue_timeout=0.01)
+        assert (await c.acquire(HIGH))
+        assert not (await c.acquire(HIGH))
+        assert c.waiting() == 0 and c._waiters == []
+        assert c.inflight == 1
+        queued = asyncio.ensure_future(c.acquire(HIGH))  # 超时的请求不再占用队列
+        await asyncio.sleep(0)
+        c.release()
+        assert (await queued)
+    run(main())
+
+def test_cancelled_waiter_removed():
+    async def main():
+        c = AdmissionController(1, SHARES, queue_timeout=1)
+        assert (await c.acquire(HIGH))
+        task = asyncio.ensure_future(c.acquire(HIGH))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert c._waiters == []
+        c.release()
+        assert c.inflight == 0
+    run(main())
+
+def test_slot_granted_then_cancelled_is_returned():
+    async def main():
+        c = AdmissionController(1, SHARES, queue_timeout=1)
+        assert (await c.acquire(HIGH))
+        task = asyncio.ensure_future(c.acquire(HIGH))
+        await asyncio.sleep(0)
+        c.release()  # 分到名额，但请求在被唤醒之前取消
+        task.cancel()
+        admitted = (await asyncio.gather(task, return_exceptions=True))[0]
+        if admitted is True:  # wait_for在结果已经就绪时返回结果而不是抛出CancelledError，由调用方归还名额
+            c.release()
+        assert c.inflight == 0
+    run(main())
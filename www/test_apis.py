@@ -0,0 +1,25 @@
+import pytest
+
+from apis import Page, APIValueError, encode_cursor, decode_cursor
+
+def test_cursor_round_trip():
+    for created_at, id in ((1700000000.123, '0017000000001230abc000'), (1700000000.0, 123456789012345)):
+        cursor = encode_cursor(created_at, id)
+        assert '=' not in cursor and '/' not in cursor and '+' not in cursor  # 可以直接放在url中
+        assert decode_cursor(cursor) == (created_at, id)
+
+def test_cursor_created_at_is_float():
+    created_at, _ = decode_cursor(encode_cursor(1700000000, 'x'))
+    assert isinstance(created_at, float)
+
+@pytest.mark.parametrize('cursor', ['', 'not a cursor', encode_cursor(1, 2)[:-3], 'WzFd', 'eyJhIjogMX0'])
+def test_invalid_cursor(cursor):
+    with pytest.raises(APIValueError) as e:
+        decode_cursor(cursor)
+    assert e.value.data == 'cursor'
+
+def test_page():
+    p = Page(13, 3)
+    assert (p.page_count, p.offset, p.limit, p.has_next, p.has_previous) == (3, 12, 6, False, True)
+    p = Page(13, 4)  # 超出范围的页码回到第一页
+    assert (p.page_index, p.offset, p.limit) == (1, 0, 0)
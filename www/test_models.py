@@ -0,0 +1,56 @@
+import time
+
+import pytest
+
+from models import Snowflake
+
+# 雪花算法ID：41位毫秒时间 + 5位机器号 + 7位序列号
+
+def test_layout():
+    s = Snowflake(worker_id=3)
+    t = 1700000000.123
+    id = s.id_from_time(t, sequence=5)
+    assert id >> 12 == int(t * 1000) - Snowflake.EPOCH
+    assert (id >> 7) & 31 == 3
+    assert id & 127 == 5
+    assert s.time_of(id) == int(t * 1000) / 1000.0
+    assert id < 2 ** 53  # 前端JavaScript的Number不丢失精度
+
+def test_id_from_time_orders_by_time_then_sequence():
+    s = Snowflake()
+    assert s.id_from_time(1700000000.0) < s.id_from_time(1700000000.0, 1) < s.id_from_time(1700000000.001)
+    assert s.id_from_time(1700000000.0, Snowflake.SEQUENCE_MASK + 1) == s.id_from_time(1700000000.0)  # 序列号只取低7位
+
+def test_id_from_time_before_epoch():
+    with pytest.raises(ValueError):
+        Snowflake().id_from_time(Snowflake.EPOCH / 1000.0 - 1)
+
+@pytest.mark.parametrize('worker_id', [-1, Snowflake.MAX_WORKER + 1])
+def test_worker_out_of_range(worker_id):
+    with pytest.raises(ValueError):
+        Snowflake(worker_id)
+
+def test_next_id_monotonic_with_clock_going_back(monkeypatch):
+    now = [1700000000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    s = Snowflake(1)
+    a = s.next_id()
+    now[0] -= 5  # 时钟回拨
+    b = s.next_id()
+    assert b > a
+    assert s.time_of(b) == s.time_of(a)
+
+def test_sequence_exhausted_borrows_next_millisecond(monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: 1700000000.0)
+    s = Snowflake()
+    ids = [s.next_id() for _ in range(Snowflake.SEQUENCE_MASK + 2)]
+    assert ids == sorted(set(ids))
+    assert s.time_of(ids[-1]) == s.time_of(ids[0]) + 0.001
+    assert ids[-1] & Snowflake.SEQUENCE_MASK == 0
+
+def test_too_far_ahead_of_clock(monkeypatch):
+    monkeypatch.setattr(time, 'time', lambda: 1700000000.0)
+    s = Snowflake()
+    with pytest.raises(RuntimeError):
+        for _ in range((Snowflake.SEQUENCE_MASK + 1) * (Snowflake.MAX_DRIFT + 2)):
+            s.next_id()
@@ -0,0 +1,143 @@
+import asyncio, time
+
+import pytest
+
+import orm, models
+from models import Blog
+
+# 数据库相关的测试使用SQLite，每个测试一个新的数据库文件
+
+def run(tmp_path, fn):
+    async def main():
+        await orm.create_pool(backend='sqlite', path=str(tmp_path / 'test.db'))
+        try:
+            await models.create_schema()
+            return (await fn())
+        finally:
+            await orm.close_pool()
+    return asyncio.run(main())
+
+def new_blog():
+    return Blog(user_id='u1', user_name='n', user_image='', name='t', summary='s', content='c')
+
+def test_incr(tmp_path):
+    async def fn():
+        blog = new_blog()
+        await blog.save()
+        assert (await Blog.incr(blog.id, 'comment_count')) == 1
+        await Blog.incr(blog.id, 'comment_count', 2)
+        await Blog.incr(blog.id, 'comment_count', -1)
+        assert (await Blog.find(blog.id)).comment_count == 2
+        assert (await Blog.incr('missing', 'comment_count')) == 0
+    run(tmp_path, fn)
+
+def test_incr_rejects_non_counter_field(tmp_path):
+    async def fn():
+        with pytest.raises(ValueError):
+            await Blog.incr('x', 'name')
+    run(tmp_path, fn)
+
+def test_transaction_commit_notifies_after_commit(tmp_path):
+    events = []
+    def listener(event, blog):
+        events.append((event, blog.id))
+    async def fn():
+        blog = new_blog()
+        async with orm.transaction():
+            await blog.save()
+            await Blog.incr(blog.id, 'comment_count')
+            assert events == []
+        assert events == [('save', blog.id)]
+        assert (await Blog.find(blog.id)).comment_count == 1
+    orm.listen(Blog, listener)
+    try:
+        run(tmp_path, fn)
+    finally:
+        orm.unlisten(Blog, listener)
+
+def test_transaction_rollback(tmp_path):
+    events = []
+    def listener(event, blog):
+        events.append(event)
+    async def fn():
+        kept = new_blog()
+        await kept.save()
+        blog = new_blog()
+        with pytest.raises(RuntimeError):
+            async with orm.transaction():
+                await blog.save()
+                async with orm.transaction():  # 嵌套的事务并入外层事务，一起回滚
+                    await Blog.incr(kept.id, 'comment_count', 5)
+                raise RuntimeError('abort')
+        assert (await Blog.find(blog.id)) is None
+        assert (await Blog.find(kept.id)).comment_count == 0
+        assert events == ['save']  # 只有事务外的kept
+    orm.listen(Blog, listener)
+    try:
+        run(tmp_path, fn)
+    finally:
+        orm.unlisten(Blog, listener)
+
+########################################################################################################################
+# 熔断器
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    b = orm.CircuitBreaker(failures=3, reset_timeout=5, latency=1)
+    b.failure()
+    b.failure()
+    b.success()  # 成功后重新计数
+    b.failure()
+    b.failure()
+    assert b.allow()
+    b.failure()
+    assert b.state == 'open'
+    assert not b.allow()
+
+def test_breaker_slow_statement_counts_as_failure(clock):
+    b = orm.CircuitBreaker(failures=2, reset_timeout=5, latency=1)
+    b.record(0.5)
+    b.record(1.5)
+    assert b.state == 'closed'
+    b.record(1.5)
+    assert b.state == 'open'
+
+def test_breaker_half_open_probe(clock):
+    b = orm.CircuitBreaker(failures=1, reset_timeout=5, latency=1)
+    b.failure()
+    clock[0] += 4.9
+    assert not b.allow()
+    clock[0] += 0.1
+    assert b.allow()  # 放行一个探测请求
+    assert b.state == 'half-open'
+    assert not b.allow()
+    b.failure()  # 探测失败，继续断开
+    assert b.state == 'open'
+    assert not b.allow()
+    clock[0] += 5
+    assert b.allow()
+    b.success()
+    assert b.state == 'closed'
+    assert b.allow() and b.allow()
+
+def test_breaker_probe_without_result_lets_next_probe_through(clock):
+    b = orm.CircuitBreaker(failures=1, reset_timeout=5, latency=1)
+    b.failure()
+    clock[0] += 5
+    assert b.allow()
+    clock[0] += 5  # 探测请求没有执行语句就结束了
+    assert b.allow()
+
+def test_acquire_rejected_while_open(tmp_path):
+    async def fn():
+        for _ in range(orm._breaker.failures):
+            orm._breaker.failure()
+        with pytest.raises(orm.CircuitOpenError):
+            await orm.select('select 1', None)
+        assert not orm.healthy()
+    run(tmp_path, fn)
@@ -0,0 +1,86 @@
+import pytest
+
+import search
+from search import InvertedIndex, tokenize, BLOG, COMMENT
+
+def test_tokenize_words():
+    assert tokenize('Hello, World! aiohttp 3.14') == ['hello', 'world', 'aiohttp', '3', '14']
+    assert tokenize('a' * 41 + ' ok') == ['ok']  # 过长的"单词"不进索引
+
+def test_tokenize_cjk():
+    assert tokenize('数据库') == ['数', '据', '库', '数据', '据库']
+    assert tokenize('数据库', query=True) == ['数据', '据库']
+    assert tokenize('库', query=True) == ['库']
+    assert tokenize('用Python写博客') == ['用', 'python', '写', '博', '客', '写博', '博客']
+
+def test_tokenize_japanese_and_korean():
+    assert tokenize('テスト', query=True) == ['テス', 'スト']
+    assert tokenize('한국어', query=True) == ['한국', '국어']
+
+def index(*docs):
+    idx = InvertedIndex()
+    for kind, id, text in docs:
+        idx.add(kind, id, tokenize(text), dict(title=text))
+    return idx
+
+def ranked(idx, q, **kw):
+    total, top = idx.search(q, **kw)
+    return [idx.docs[docno][1] for _, docno in top]
+
+def test_bm25_term_frequency_and_length():
+    idx = index(
+        (BLOG, '1', 'python asyncio'),
+        (BLOG, '2', 'python python asyncio'),
+        (BLOG, '3', 'python asyncio aiohttp jinja2 sqlite mysql markdown'),
+        (BLOG, '4', 'rust'),
+    )
+    assert ranked(idx, 'python') == ['2', '1', '3']  # 词频高的在前，同样词频时短文档在前
+
+def test_bm25_rare_terms_weigh_more():
+    idx = index(
+        (BLOG, '1', 'python common'),
+        (BLOG, '2', 'python rare'),
+        (BLOG, '3', 'python common'),
+        (BLOG, '4', 'common'),
+    )
+    assert ranked(idx, 'common rare')[0] == '2'
+
+def test_search_cjk():
+    idx = index((BLOG, '1', '分布式数据库'), (BLOG, '2', '数学'), (COMMENT, '3', '数据结构'))
+    assert ranked(idx, '数据库') == ['1', '3']  # 两个bigram都命中的排在前面
+    assert set(ranked(idx, '数据')) == {'1', '3'}
+    assert set(ranked(idx, '数')) == {'1', '2', '3'}  # 单字查询匹配建索引时的单字
+
+def test_search_kind_limit_offset():
+    idx = index(*[(BLOG if i % 2 else COMMENT, str(i), 'python ' * i) for i in range(1, 7)])
+    total, top = idx.search('python', kind=BLOG)
+    assert total == 3
+    assert ranked(idx, 'python', kind=BLOG) == ['5', '3', '1']
+    assert ranked(idx, 'python', limit=2, offset=1) == ['5', '4']
+    assert idx.search('', limit=2) == (0, [])
+
+def test_remove_and_replace():
+    idx = index((BLOG, '1', 'python'), (BLOG, '2', 'python rust'))
+    idx.add(BLOG, '2', tokenize('rust only'), dict())  # 同一id重新索引，旧的词不再命中
+    assert ranked(idx, 'python') == ['1']
+    assert idx.remove(BLOG, '1')
+    assert not idx.remove(BLOG, '1')
+    assert 'python' not in idx.postings
+    assert len(idx) == 1 and idx.total_length == 2
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'search.snapshot')
+    idx = index((BLOG, '1', '搜索引擎'), (COMMENT, '2', 'bm25'))
+    idx.digests[(BLOG, '1')] = search._digest('a', 'b')
+    idx.dump(path)
+    loaded = InvertedIndex.load(path)
+    assert ranked(loaded, '搜索') == ['1']
+    assert loaded.digest(BLOG, 1) == search._digest('a', 'b')
+    assert loaded.ids(COMMENT) == {'2'}
+
+def test_snapshot_version_mismatch(tmp_path, monkeypatch):
+    path = str(tmp_path / 'search.snapshot')
+    index((BLOG, '1', 'x')).dump(path)
+    monkeypatch.setattr(search, 'SNAPSHOT_VERSION', search.SNAPSHOT_VERSION + 1)
+    with pytest.raises(ValueError):
+        InvertedIndex.load(path)
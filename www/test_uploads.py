@@ -0,0 +1,125 @@
+import asyncio, hashlib, io, os
+
+import pytest
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import uploads
+from config import configs
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(configs.uploads, 'dir', str(tmp_path))
+    monkeypatch.setattr(configs.uploads, 'max_bytes', 1000)
+    monkeypatch.setattr(configs.uploads, 'chunk_size', 256)
+    return tmp_path
+
+@pytest.mark.parametrize('head, ext', [
+    (PNG + b'\0' * 8, 'png'),
+    (b'\xff\xd8\xff\xe0', 'jpg'),
+    (b'GIF89a', 'gif'),
+    (b'RIFF\0\0\0\0WEBPVP8 ', 'webp'),
+    (b'<svg xmlns="http://www.w3.org/2000/svg">', None),
+    (b'', None),
+])
+def test_sniff(head, ext):
+    assert uploads.sniff(head) == ext
+
+# 用一个只调用uploads.receive（save为True时调用uploads.save_image）的app上传data，返回(状态码, 响应文本)
+def post(data, field='file', save=False):
+    async def handler(request):
+        try:
+            if save:
+                return web.json_response(await uploads.save_image(request, (50,)))
+            digest, ext = await uploads.receive(request)
+        except uploads.UploadError as e:
+            return web.Response(status=400, text=str(e))
+        return web.Response(text='%s.%s' % (digest, ext))
+    async def main():
+        app = web.Application()
+        app.router.add_post('/upload', handler)
+        async with TestClient(TestServer(app)) as client:
+            form = aiohttp.FormData()
+            form.add_field(field, data, filename='x.png', content_type='image/png')
+            r = await client.post('/upload', data=form)
+            return r.status, (await r.text())
+    return asyncio.run(main())
+
+def stored_files(root):
+    return sorted(os.path.relpath(os.path.join(d, f), root) for d, _, files in os.walk(root) for f in files)
+
+def test_receive_stores_by_content(upload_dir):
+    data = PNG + b'\1' * 100
+    digest = hashlib.sha256(data).hexdigest()
+    assert post(data) == (200, '%s.png' % digest)
+    assert post(data) == (200, '%s.png' % digest)  # 相同内容只保存一份
+    assert stored_files(upload_dir) == [os.path.join(digest[:2], digest[2:4], '%s.png' % digest)]
+
+def test_receive_at_size_limit(upload_dir):
+    assert post(PNG + b'\0' * (1000 - len(PNG)))[0] == 200
+
+def test_receive_over_size_limit_while_streaming(upload_dir):
+    status, text = post(PNG + b'\0' * 1000)  # Content-Length没有超过max_bytes + 65536，读取时才发现超出
+    assert status == 400 and 'larger than 1000 bytes' in text
+    assert stored_files(upload_dir) == []  # 临时文件已删除
+
+def test_receive_rejects_large_content_length(upload_dir):
+    status, text = post(PNG + b'\0' * 100000)
+    assert status == 400 and 'larger than 1000 bytes' in text
+    assert not os.path.exists(os.path.join(str(upload_dir), 'tmp'))  # 没有读取请求体
+
+def test_receive_rejects_unknown_format(upload_dir):
+    status, text = post(b'<svg onload="alert(1)"></svg>')
+    assert status == 400 and 'unsupported image format' in text
+    assert stored_files(upload_dir) == []
+
+def test_receive_missing_field(upload_dir):
+    assert post(PNG, field='other') == (400, 'missing file field: file')
+
+########################################################################################################################
+# 缩略图（需要Pillow）
+
+def store(root, data, ext):
+    digest = hashlib.sha256(data).hexdigest()
+    path = os.path.join(str(root), uploads._relpath(digest, '%s.%s' % (digest, ext)))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return digest
+
+def png(Image, size, mode='RGB'):
+    buf = io.BytesIO()
+    Image.new(mode, size).save(buf, 'PNG')
+    return buf.getvalue()
+
+def test_make_thumbnails(tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    digest = store(tmp_path, png(Image, (1000, 500)), 'png')
+    thumbs = uploads.make_thumbnails(str(tmp_path), digest, 'png', (800, 50), 1000000)
+    assert sorted(thumbs) == [50, 800]
+    with Image.open(os.path.join(str(tmp_path), thumbs[50])) as im:
+        assert im.size == (50, 25)
+    assert not [f for f in stored_files(tmp_path) if f.endswith('.tmp')]
+
+def test_make_thumbnails_rejects_undecodable_image(tmp_path):
+    pytest.importorskip('PIL.Image')
+    digest = store(tmp_path, PNG + b'junk' * 100, 'png')
+    with pytest.raises(uploads.UploadError):
+        uploads.make_thumbnails(str(tmp_path), digest, 'png', (800,), 1000000)
+    assert len(stored_files(tmp_path)) == 1  # 只有原图，原图由save_image删除
+
+def test_make_thumbnails_rejects_too_many_pixels(tmp_path):
+    Image = pytest.importorskip('PIL.Image')
+    digest = store(tmp_path, png(Image, (2000, 1000), '1'), 'png')
+    with pytest.raises(uploads.UploadError):
+        uploads.make_thumbnails(str(tmp_path), digest, 'png', (800,), 1000000)
+    assert len(stored_files(tmp_path)) == 1
+
+def test_save_image_removes_undecodable_original(upload_dir):
+    pytest.importorskip('PIL.Image')
+    status, text = post(PNG + b'junk' * 100, save=True)
+    assert status == 400 and 'invalid image' in text
+    assert stored_files(upload_dir) == []
@@ -0,0 +1,197 @@
+import logging, asyncio, hashlib, os, tempfile, warnings
+
+import metrics, executors
+from config import configs
+
+# 图片上传：头像和日志中的图片保存在本地，不再依赖外部网站（gravatar）
+# 1. 上传：multipart请求体按块读取，边计算sha256边写入临时文件，不把整个请求体读入内存，超过max_bytes立即中止
+# 2. 存储：按内容寻址，原图保存为<sha256>.<ext>，缩略图为<sha256>-<宽度>.<ext>，放在sha256前四位组成的两级子目录下，
+#    内容相同的图片只保存一份；文件一旦写入就不再改变
+# 3. 缩略图：在进程池中用Pillow生成（没有安装Pillow时缩略图直接使用原图），无法解码或像素数超过max_pixels的图片返回400并删除原图
+# 4. 访问：url前缀configs.uploads.url注册为静态文件路由，响应带一年的Cache-Control: immutable
+
+# 支持的图片格式：文件头 --> 扩展名，不支持SVG（可以内嵌脚本）
+_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+UPLOADS = metrics.counter('uploads_stored', 'Images uploaded and stored.')
+DUPLICATES = metrics.counter('uploads_duplicates', 'Uploaded images that were already stored.')
+REJECTED = metrics.counter('uploads_rejected', 'Uploads rejected for size or format.')
+THUMBNAIL_TIME = metrics.histogram('uploads_thumbnail_seconds', 'Time to generate the thumbnails of an image.')
+
+class UploadError(Exception):
+    pass
+
+def sniff(head):
+    for signature, ext in _SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def _relpath(digest, name):
+    return '/'.join((digest[:2], digest[2:4], name))
+
+def url(relpath):
+    return configs.uploads.url.rstrip('/') + '/' + relpath
+
+########################################################################################################################
+# 以下函数在进程池的子进程（或线程池）中执行
+
+# 在tmp_dir中创建唯一的临时文件，返回(文件对象, 路径)
+def _open_tmp(tmp_dir):
+    os.makedirs(tmp_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=tmp_dir, suffix='.part')
+    return os.fdopen(fd, 'wb'), path
+
+def _close(f):
+    f.close()
+
+# 把临时文件移动到按内容寻址的位置，已经存在则删除临时文件，返回是否新保存
+def _store(tmp, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(tmp)
+        return False
+    os.chmod(tmp, 0o644)  # mkstemp创建的文件只有本用户可读，静态文件服务器也要能读取
+    os.replace(tmp, path)
+    return True
+
+# 缩略图先写入同目录下mkstemp创建的临时文件再替换，多个worker同时为同一张图片生成缩略图也不会互相覆盖写了一半的文件
+def _save_thumbnail(thumb, target, format):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            thumb.save(f, format=format)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, target)
+    except BaseException:
+        _remove(tmp)
+        raise
+
+# 生成宽度不超过各个size的缩略图（不放大），已经存在的缩略图跳过，返回 size --> 相对路径
+# 文件头合法但无法解码、像素数超过max_pixels（解压炸弹）的图片抛出UploadError，已生成的缩略图删除
+def make_thumbnails(root, digest, ext, sizes, max_pixels):
+    source = os.path.join(root, _relpath(digest, '%s.%s' % (digest, ext)))
+    result = dict()
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning('Pillow is not installed, thumbnails use the original image.')
+        return dict((size, _relpath(digest, '%s.%s' % (digest, ext))) for size in sizes)
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    created = []
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', Image.DecompressionBombWarning)  # 超过max_pixels时Image.open直接抛出，不只是警告
+            im = Image.open(source)  # 只读取文件头，im.copy()时才解码
+        with im:
+            for size in sizes:
+                rel = _relpath(digest, '%s-%s.%s' % (digest, size, ext))
+                target = os.path.join(root, rel)
+                if not os.path.exists(target):
+                    thumb = im.copy()  # gif只取第一帧
+                    thumb.thumbnail((size, size * 4))
+                    _save_thumbnail(thumb, target, im.format)
+                    created.append(target)
+                result[size] = rel
+    except (Image.UnidentifiedImageError, Image.DecompressionBombWarning, Image.DecompressionBombError, OSError) as e:
+        for target in created:
+            _remove(target)
+        raise UploadError('invalid image: %s' % e)
+    return result
+
+########################################################################################################################
+
+# 从multipart请求中读取名为field的文件，流式写入存储目录，返回(sha256, 扩展名)
+async def receive(request, field='file'):
+    c = configs.uploads
+    if request.content_length is not None and request.content_length > c.max_bytes + 65536:
+        REJECTED.inc()
+        raise UploadError('file is larger than %s bytes' % c.max_bytes)
+    reader = await request.multipart()
+    part = await reader.next()
+    while part is not None and part.name != field:
+        await part.release()
+        part = await reader.next()
+    if part is None:
+        raise UploadError('missing file field: %s' % field)
+    loop = asyncio.get_running_loop()
+    # 临时文件名唯一，整个上传过程只打开一次，不会接着写入崩溃后残留的同名文件
+    f, tmp = await loop.run_in_executor(None, _open_tmp, os.path.join(c.dir, 'tmp'))
+    h, size, ext = hashlib.sha256(), 0, None
+    try:
+        while True:
+            chunk = await part.read_chunk(c.chunk_size)
+            if not chunk:
+                break
+            if ext is None:
+                ext = sniff(chunk)
+                if ext is None:
+                    REJECTED.inc()
+                    raise UploadError('unsupported image format, use png, jpg, gif or webp')
+            size += len(chunk)
+            if size > c.max_bytes:
+                REJECTED.inc()
+                raise UploadError('file is larger than %s bytes' % c.max_bytes)
+            h.update(chunk)
+            await loop.run_in_executor(None, f.write, chunk)
+        await loop.run_in_executor(None, _close, f)
+        if ext is None:
+            raise UploadError('empty file')
+        digest = h.hexdigest()
+        stored = await loop.run_in_executor(None, _store, tmp, os.path.join(c.dir, _relpath(digest, '%s.%s' % (digest, ext))))
+    except BaseException:
+        await loop.run_in_executor(None, _close, f)
+        await loop.run_in_executor(None, _remove, tmp)
+        raise
+    if stored:
+        UPLOADS.inc()
+    else:
+        DUPLICATES.inc()
+    return digest, ext
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+# 接收一张图片并生成缩略图，返回原图和各尺寸缩略图的url
+async def save_image(request, sizes, field='file'):
+    digest, ext = await receive(request, field)
+    start = asyncio.get_running_loop().time()
+    c = configs.uploads
+    try:
+        thumbs = await executors.run_in_process(make_thumbnails, c.dir, digest, ext, tuple(sizes), c.max_pixels)
+    except UploadError:
+        # 无法解码的图片不保留原图；内容相同的图片只保存一份，之前上传的同一文件同样无法解码，一并删除
+        REJECTED.inc()
+        await asyncio.get_running_loop().run_in_executor(None, _remove, os.path.join(c.dir, _relpath(digest, '%s.%s' % (digest, ext))))
+        raise
+    THUMBNAIL_TIME.observe(asyncio.get_running_loop().time() - start)
+    return dict(
+        id=digest,
+        url=url(_relpath(digest, '%s.%s' % (digest, ext))),
+        thumbnails=dict((str(size), url(rel)) for size, rel in thumbs.items())
+    )
+
+########################################################################################################################
+
+# 注册上传文件的静态路由，要在/static/之前注册，否则被/static/的路由先匹配
+def add_static(app):
+    c = configs.uploads
+    os.makedirs(c.dir, exist_ok=True)
+    app.router.add_static(c.url, c.dir)
+    app.on_response_prepare.append(_cache_headers)
+    logging.info('add static %s => %s' % (c.url, c.dir))
+
+# 文件内容不会改变，浏览器和CDN可以一直缓存
+async def _cache_headers(request, response):
+    if request.path.startswith(configs.uploads.url) and response.status == 200:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'